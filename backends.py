@@ -0,0 +1,153 @@
+"""
+Talks Hippy backends of the bridge and the routing of rooms to them
+"""
+
+import asyncio
+from typing import Optional
+
+from matcher import PatternMatcher
+from metrics import MetricsRegistry
+from talks_client import CircuitBreaker, TalksBatcher, TalksClient
+
+
+class TalksBackend:
+    """
+    One Talks Hippy bot: its endpoint URLs, its own client and connection pool, and the state of its message fetcher
+    and confirmer tasks, and its own ready queue of rooms served by its own workers, so a slow or dead backend only
+    delays its own rooms.
+    A backend is unhealthy while the circuit breaker of its client is not closed. The rooms whose messages could
+    not be sent meanwhile are parked in `parked_rooms` until it closes again
+    """
+
+    def __init__(self, name: str, settings: dict, metrics: MetricsRegistry):
+        """
+        :param settings: the backend settings, named as the `talks_*` config keys without the `talks_` prefix
+        """
+        self.name = name
+        self.base_url = f"{settings['protocol']}://{settings['server']}:{settings['port']}"
+        self.receive_message_url = f"{self.base_url}{settings['receive_message']}"
+        self.receive_message_batch_url = None
+        if settings["receive_message_batch"]:
+            self.receive_message_batch_url = f"{self.base_url}{settings['receive_message_batch']}"
+        self.get_messages_url = f"{self.base_url}{settings['get_messages']}"
+        self.confirm_messages_url = f"{self.base_url}{settings['confirm_messages']}"
+        self.tag_room_url = f"{self.base_url}{settings['tag_room']}" if settings["tag_room"] else None
+        self.breaker = CircuitBreaker(settings["unhealthy_after"], settings["circuit_open_timeout"],
+                                      settings["circuit_max_open_timeout"])
+        self.parked_rooms = list()
+
+        self.client = TalksClient(settings["api_key"], settings["pool_size"], settings["fixed_timeout"],
+                                  timeouts=settings["timeouts"], concurrency=settings["concurrency"],
+                                  metrics=metrics, labels={"backend": name}, breaker=self.breaker)
+        self.client.add_endpoint(TalksClient.RECEIVE_MESSAGE, self.receive_message_url)
+        self.client.add_endpoint(TalksClient.GET_MESSAGES, self.get_messages_url)
+        self.client.add_endpoint(TalksClient.CONFIRM_MESSAGES, self.confirm_messages_url)
+        if self.tag_room_url:
+            self.client.add_endpoint(TalksClient.TAG_ROOM, self.tag_room_url)
+        self.batcher: Optional[TalksBatcher] = None
+        if self.receive_message_batch_url:
+            self.client.add_endpoint(TalksClient.RECEIVE_MESSAGE_BATCH, self.receive_message_batch_url)
+            self.batcher = TalksBatcher(self.client, self.receive_message_batch_url,
+                                        settings["receive_message_batch_size"], settings["receive_message_batch_linger"])
+
+        self.receive_message_workers = settings["receive_message_workers"]
+        self.ready_rooms = asyncio.Queue()
+        self.worker_tasks = list()
+
+        self.fetcher_task = None
+        self.fetcher_delay = 0.0
+        self.fetcher_wakeup = asyncio.Event()
+        self.confirmations = list()
+        self.confirmations_queued = set()
+        self.confirmations_ready = asyncio.Event()
+        self.confirmer_task = None
+        self.unconfirmed = dict()
+        self.confirm_retries = 0
+        self.confirm_retry_handle = None
+
+        self.metric_messages_to_talks = metrics.counter(
+            "talks_messages_total", "Messages exchanged with each Talks backend, by direction",
+            backend=name, direction="to_talks")
+        self.metric_messages_from_talks = metrics.counter(
+            "talks_messages_total", "Messages exchanged with each Talks backend, by direction",
+            backend=name, direction="from_talks")
+        self.reported = self.snapshot()
+
+    @property
+    def healthy(self) -> bool:
+        return self.breaker.closed
+
+    def snapshot(self):
+        latency = self.client.endpoints[self.receive_message_url].latency
+        return (self.metric_messages_to_talks.value, self.metric_messages_from_talks.value,
+                latency.count, latency.sum)
+
+    def report(self) -> str:
+        """
+        :return: the backend throughput and latency since the previous report, for the logs
+        """
+        current = self.snapshot()
+        to_talks, from_talks, calls, seconds = (now - before for now, before in zip(current, self.reported))
+        self.reported = current
+        mean_latency = f"{seconds / calls * 1000:.1f} ms" if calls > 0 else "n/a"
+        return f"{to_talks} messages to Talks, {from_talks} messages from Talks, " \
+               f"receiveMessage mean latency {mean_latency}, {'healthy' if self.healthy else 'unhealthy'}"
+
+
+class RoomRouter:
+    """
+    Routes each room to a backend by, in order of precedence: explicit assignment of the room ID, the tag
+    last set on the room by the `room_tags` rules, the first regular expression matching the room ID,
+    or the default backend
+    """
+
+    def __init__(self, routes, default: str):
+        self.default = default
+        self.assigned = dict()
+        self.tag_routes = dict()
+        self.tagged = dict()
+        regex_routes = list()
+
+        for route in routes:
+            backend = route["backend"]
+            for room_id in route.get("rooms") or ():
+                self.assigned[room_id] = backend
+            if route.get("tag") is not None:
+                self.tag_routes[(route["tag"], route.get("value"))] = backend
+            if route.get("room_regex") is not None:
+                regex_routes.append((route["room_regex"], backend))
+
+        self.regex_backends = [backend for _, backend in regex_routes]
+        self.regex_matcher = PatternMatcher([regex for regex, _ in regex_routes], flags=0)
+
+    def backends(self):
+        return set(self.assigned.values()) | set(self.tag_routes.values()) | set(self.regex_backends)
+
+    def tag(self, room_id: str, tag: str, value) -> bool:
+        """
+        Records a tag set on the room
+        :return: True if the room is routed to another backend from now on
+        """
+        backend = self.tag_routes.get((tag, value)) or self.tag_routes.get((tag, None))
+        if backend is None:
+            return False
+        previous = self.route(room_id)
+        self.tagged[room_id] = backend
+        return self.route(room_id) != previous
+
+    def restore(self, tagged: dict):
+        """
+        Restores the tag assignments of a previous run, except those to backends no tag rule routes to any more
+        """
+        backends = set(self.tag_routes.values())
+        self.tagged.update((room_id, backend) for room_id, backend in tagged.items() if backend in backends)
+
+    def route(self, room_id: str) -> str:
+        backend = self.assigned.get(room_id) or self.tagged.get(room_id)
+        if backend is not None:
+            return backend
+        if len(self.regex_backends) > 0:
+            index = self.regex_matcher.match(room_id)
+            if index is not None:
+                return self.regex_backends[index]
+        return self.default
@@ -0,0 +1,599 @@
+#!/usr/bin/env python3
+"""
+Load test and benchmark harness for the bridge.
+
+Runs BridgeBot in-process against a fake Talks Hippy HTTP server and a fake Matrix client, backed by a fake
+homeserver HTTP server for the media downloads, and prints one JSON document with the results of every scenario,
+so runs can be compared with each other.
+Needs the plugin runtime dependencies (maubot, mautrix, aiohttp, cachetools) installed.
+
+Every user message sent to the bridge makes the fake Talks bot answer with one message to the same room,
+so both directions are measured:
+- inbound: from the Matrix event being handled by the bridge to Talks receiving it
+- outbound: from Talks creating a message to the bridge sending it to the homeserver
+
+With `--instances N`, N bridge instances share the rooms through sharding, all of them receiving every event,
+and the results also count the Talks messages sent to Matrix more than once.
+
+Usage:
+  bin/benchmark.py [--scenario NAME ...] [--duration SECONDS] [--instances N] [--output FILE] [--set key=value ...]
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+import uuid
+
+import aiohttp
+from aiohttp import web
+from yarl import URL
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bridge import BridgeBot  # noqa: E402
+from mautrix.errors import make_request_error  # noqa: E402
+from mautrix.types import EventType, ImageInfo, MediaMessageEventContent, MessageType, \
+    TextMessageEventContent  # noqa: E402
+from mautrix.util.config import RecursiveDict  # noqa: E402
+from ruamel.yaml import YAML  # noqa: E402
+from sharding import HashRing  # noqa: E402
+
+BOT_USER = "@bot:bench.local"
+
+SCENARIOS = {
+    "text-1-room": dict(rooms=1, rate=2, media=False, html=False, outage=False),
+    "text-100-rooms": dict(rooms=100, rate=100, media=False, html=False, outage=False),
+    "text-10000-rooms": dict(rooms=10000, rate=500, media=False, html=False, outage=False),
+    "media-100-rooms": dict(rooms=100, rate=20, media=True, html=False, outage=False),
+    "media-streaming-100-rooms": dict(rooms=100, rate=20, media=True, html=False, outage=False,
+                                      config={"talks_media_streaming": True}),
+    "media-proxy-100-rooms": dict(rooms=100, rate=20, media=True, html=False, outage=False,
+                                  config={"talks_media_proxy": True}),
+    "media-mxc-replies-100-rooms": dict(rooms=100, rate=20, media=True, html=False, outage=False, reply_mxc=True),
+    "html-hints-100-rooms": dict(rooms=100, rate=100, media=False, html=True, outage=False),
+    "outage-100-rooms": dict(rooms=100, rate=100, media=False, html=False, outage=True),
+    "rate-limited-100-rooms": dict(rooms=100, rate=100, media=False, html=False, outage=False, rate_limited=True),
+    # a broadcast survey answered at once, to compare the inbound events/s of single and batched receiveMessage
+    "burst-1000-rooms": dict(rooms=1000, rate=5000, media=False, html=False, outage=False),
+    "burst-1000-rooms-batched": dict(rooms=1000, rate=5000, media=False, html=False, outage=False,
+                                     config={"talks_receive_message_batch": "/matrix/receiveMessages"}),
+    # mostly idle traffic, to compare the getMessages requests and the reply latency of the delivery modes
+    "idle-fixed-polling-10-rooms": dict(rooms=10, rate=0.5, media=False, html=False, outage=False,
+                                        config={"talks_delivery_mode": "poll", "message_fetcher_max_delay": 0.2}),
+    "idle-adaptive-polling-10-rooms": dict(rooms=10, rate=0.5, media=False, html=False, outage=False,
+                                           config={"talks_delivery_mode": "poll"}),
+    "idle-long-poll-10-rooms": dict(rooms=10, rate=0.5, media=False, html=False, outage=False,
+                                    config={"talks_delivery_mode": "long_poll"}),
+    "idle-webhook-10-rooms": dict(rooms=10, rate=0.5, media=False, html=False, outage=False,
+                                  config={"talks_delivery_mode": "webhook"}),
+}
+
+MEDIA_SIZE = 256 * 1024
+PRE_LINES = 500
+HINTS = {"1": "Yes", "2": "No", "3": "Talk to a human", "4": "Back to the menu"}
+PNG_HEADER = b"\x89PNG\r\n\x1a\n" + b"\x00\x00\x00\rIHDR" + (64).to_bytes(4, "big") * 2 + b"\x08\x02\x00\x00\x00"
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_summary(values):
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 2) if values else None,
+        "p99_ms": round(percentile(values, 0.99) * 1000, 2) if values else None,
+        "max_ms": round(max(values) * 1000, 2) if values else None,
+    }
+
+
+def current_rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class FakeTalks:
+    """
+    Talks Hippy stand-in: answers every received message with one message to the same room
+    """
+
+    def __init__(self, media: bool, html: bool, reply_mxc: bool = False, api_key: str = None):
+        self.media = media
+        self.html = html
+        self.reply_mxc = reply_mxc
+        self.api_key = api_key
+        self.session = None
+        self.media_fetches = set()
+        self.media_bytes_fetched = 0
+        self.webhooks = list()
+        self.notifications = set()
+        self.get_messages_requests = 0
+        self.receive_requests = 0
+        self.down = False
+        self.requests = 0
+        self.requests_while_down = 0
+        self.received = dict()
+        self.pending = dict()
+        self.created = dict()
+        self.ready = asyncio.Event()
+        self.media_body = base64.b64encode(PNG_HEADER + b"\x00" * MEDIA_SIZE).decode("ascii")
+
+    def app(self, config):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post(config["talks_receive_message"], self.receive_message)
+        if config["talks_receive_message_batch"]:
+            app.router.add_post(config["talks_receive_message_batch"], self.receive_messages)
+        app.router.add_get(config["talks_get_messages"], self.get_messages)
+        app.router.add_post(config["talks_confirm_messages"], self.confirm_messages)
+        if config["talks_tag_room"]:
+            app.router.add_post(config["talks_tag_room"], self.tag_room)
+        return app
+
+    def count(self):
+        self.requests += 1
+        if self.down:
+            self.requests_while_down += 1
+        return self.down
+
+    @staticmethod
+    async def read_json(request):
+        payload = json.loads(await request.text())
+        return json.loads(payload) if isinstance(payload, str) else payload
+
+    def accept(self, message):
+        now = time.perf_counter()
+        self.received.setdefault(message["eventId"], now)
+        talks_id = str(uuid.uuid4())
+        reply = {"id": talks_id, "roomId": message["roomId"], "messageType": "m.text", "bodyType": "TEXT",
+                 "body": talks_id, "actions": None, "mimeType": None, "mxcUri": None, "filename": None}
+        if message.get("mediaUrl"):
+            task = asyncio.create_task(self.fetch_media(message["mediaUrl"]))
+            self.media_fetches.add(task)
+            task.add_done_callback(self.media_fetches.discard)
+        if self.media and self.reply_mxc:
+            # media already on the homeserver, sent back by URI, e.g. a file of the Talks bot sent to every user
+            reply.update(bodyType="IMAGE", body=None, mimeType="image/png", mxcUri="mxc://bench.local/talks")
+        elif self.media:
+            reply.update(bodyType="IMAGE", body=self.media_body, mimeType="image/png", filename=talks_id)
+        elif self.html:
+            preformatted = "\n".join(f"line {i}" for i in range(PRE_LINES))
+            reply.update(bodyType="HTML", body=f"{talks_id}\n<pre>{preformatted}</pre>", actions=HINTS)
+        self.pending[talks_id] = reply
+        self.created[talks_id] = now
+        self.ready.set()
+        for url in self.webhooks:
+            task = asyncio.create_task(self.notify(url))
+            self.notifications.add(task)
+            task.add_done_callback(self.notifications.discard)
+
+    async def notify(self, url):
+        """
+        Calls the messages_ready webhook of a bridge instance, as Talks does in the webhook delivery mode
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        async with self.session.post(url, headers={"Authorization": f"Bearer {self.api_key}"}) as r:
+            await r.read()
+
+    async def fetch_media(self, url):
+        """
+        Pulls media from the media proxy of the bridge, as the Talks bot does when it needs the bytes
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        async with self.session.get(url, headers={"Authorization": f"Bearer {self.api_key}"}) as r:
+            self.media_bytes_fetched += len(await r.read())
+
+    async def close(self):
+        if len(self.media_fetches) > 0:
+            await asyncio.wait(list(self.media_fetches))
+        if len(self.notifications) > 0:
+            await asyncio.wait(list(self.notifications))
+        if self.session is not None:
+            await self.session.close()
+
+    async def receive_message(self, request):
+        self.receive_requests += 1
+        if self.count():
+            return web.json_response({"description": "down"}, status=503)
+        self.accept(await self.read_json(request))
+        return web.json_response({"description": "ok"})
+
+    async def receive_messages(self, request):
+        self.receive_requests += 1
+        if self.count():
+            return web.json_response({"description": "down"}, status=503)
+        messages = (await self.read_json(request))["messages"]
+        for message in messages:
+            self.accept(message)
+        return web.json_response({"results": [{"status": 200, "description": "ok"} for _ in messages]})
+
+    async def get_messages(self, request):
+        self.get_messages_requests += 1
+        if self.count():
+            return web.json_response({"description": "down"}, status=503)
+        wait = float(request.query.get("wait", 0))
+        if len(self.pending) == 0 and wait > 0:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+        messages = self.pending.values()
+        if "shard" in request.query:
+            ring = HashRing(request.query["shards"].split(","))
+            messages = (message for message in messages if ring.owner(message["roomId"]) == request.query["shard"])
+        return web.json_response({"description": "ok", "messages": list(messages)[:1000]})
+
+    async def confirm_messages(self, request):
+        if self.count():
+            return web.json_response({"description": "down"}, status=503)
+        for message in (await self.read_json(request))["messages"]:
+            self.pending.pop(message["sourceId"], None)
+        return web.json_response({"description": "ok"})
+
+    async def tag_room(self, request):
+        self.count()
+        return web.json_response({"description": "ok"})
+
+
+class FakeHomeserver:
+    """
+    Homeserver stand-in for the client API calls the bridge makes over HTTP: sending events, recording when each
+    Talks message reaches Matrix for each bot access token, and media downloads, with range requests.
+    With `rate_limited`, one event out of `RATE_LIMIT_EVERY` is rejected with a 429 response
+    """
+
+    RATE_LIMIT_EVERY = 50
+    RETRY_AFTER_MS = 200
+
+    def __init__(self, rate_limited: bool = False):
+        self.rate_limited = rate_limited
+        self.media = PNG_HEADER + b"\x00" * MEDIA_SIZE
+        self.delivered = dict()
+        self.transactions = dict()
+        self.account_data = dict()
+        self.sends = 0
+        self.rate_limited_sends = 0
+        self.downloads = 0
+        self.bytes_downloaded = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_put("/_matrix/client/v3/rooms/{room_id}/send/{event_type}/{txn_id}", self.send)
+        app.router.add_get("/_matrix/media/v3/download/{server_name}/{media_id}", self.download)
+        return app
+
+    async def send(self, request):
+        self.sends += 1
+        if self.rate_limited and self.sends % self.RATE_LIMIT_EVERY == 0:
+            self.rate_limited_sends += 1
+            return web.json_response({"errcode": "M_LIMIT_EXCEEDED", "error": "Too Many Requests",
+                                      "retry_after_ms": self.RETRY_AFTER_MS}, status=429)
+        token = request.headers["Authorization"].split(" ", 1)[1]
+        transaction = (token, request.match_info["txn_id"])
+        event_id = self.transactions.get(transaction)
+        if event_id is None:
+            event_id = self.transactions[transaction] = f"$bench{len(self.transactions)}"
+            body = (await request.json()).get("body") or ""
+            self.delivered.setdefault(token, dict()).setdefault(body.split("\n", 1)[0], time.perf_counter())
+        return web.json_response({"event_id": event_id})
+
+    async def download(self, request):
+        self.downloads += 1
+        if "Range" not in request.headers:
+            self.bytes_downloaded += len(self.media)
+            return web.Response(body=self.media, content_type="image/png")
+        start, stop, _ = request.http_range.indices(len(self.media))
+        self.bytes_downloaded += stop - start
+        return web.Response(status=206, body=self.media[start:stop], content_type="image/png",
+                            headers={"Content-Range": f"bytes {start}-{stop - 1}/{len(self.media)}"})
+
+
+class FakeApi:
+    def __init__(self, base_url, session, token):
+        self.base_url = URL(base_url)
+        self.session = session
+        self.token = token
+        self.txn_id = 0
+
+    def get_txn_id(self):
+        self.txn_id += 1
+        return f"bench{self.txn_id}"
+
+    def get_download_url(self, url):
+        return f"{self.base_url}/_matrix/media/v3/download/{url[len('mxc://'):]}"
+
+
+class FakeMatrixClient:
+    """
+    Matrix client stand-in for the calls the bridge makes through mautrix, over the fake homeserver
+    """
+
+    def __init__(self, homeserver: FakeHomeserver, base_url, session, token):
+        self.api = FakeApi(base_url, session, token)
+        self.homeserver = homeserver
+        self.uploads = 0
+        self.media = homeserver.media
+
+    @property
+    def delivered(self):
+        return self.homeserver.delivered.get(self.api.token, dict())
+
+    async def upload_media(self, data, mime_type=None):
+        self.uploads += 1
+        return f"mxc://bench.local/{self.uploads}"
+
+    async def download_media(self, url):
+        return self.media
+
+    async def redact(self, room_id, event_id, reason=None):
+        return f"$redaction{event_id}"
+
+    async def get_event(self, room_id, event_id):
+        return {"content": {}}
+
+    async def get_account_data(self, event_type):
+        # all the instances stand for the same bot user, so they share its account data
+        if event_type not in self.homeserver.account_data:
+            raise make_request_error(404, "", "M_NOT_FOUND", "Account data not found")
+        return self.homeserver.account_data[event_type]
+
+    async def set_account_data(self, event_type, content):
+        self.homeserver.account_data[event_type] = content
+
+
+class FakeEvent:
+    read_receipts = 0
+
+    def __init__(self, room_id, media):
+        self.event_id = f"${uuid.uuid4()}"
+        self.room_id = room_id
+        self.sender = "@user:bench.local"
+        self.timestamp = int(time.time() * 1000)
+        self.type = EventType.ROOM_MESSAGE
+        if media:
+            self.content = MediaMessageEventContent(msgtype=MessageType.IMAGE, body="image.png",
+                                                    url="mxc://bench.local/inbound",
+                                                    info=ImageInfo(mimetype="image/png", size=len(PNG_HEADER) + MEDIA_SIZE))
+        else:
+            self.content = TextMessageEventContent(msgtype=MessageType.TEXT, body=f"hello {self.event_id}")
+
+    async def mark_read(self):
+        FakeEvent.read_receipts += 1
+
+    def serialize(self):
+        return {"event_id": self.event_id, "room_id": self.room_id, "sender": self.sender,
+                "origin_server_ts": self.timestamp, "type": "m.room.message", "content": self.content.serialize()}
+
+
+class BenchConfig(RecursiveDict):
+    def load_and_update(self):
+        pass
+
+
+def load_config(overrides, scenario_config=None):
+    """
+    :param scenario_config: values of the scenario, applied before the `--set` overrides
+    """
+    base_config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "base-config.yaml")
+    with open(base_config_path) as f:
+        config = YAML(typ="safe").load(f)
+    config.update(matrix_bot_user=BOT_USER, talks_server="127.0.0.1", talks_protocol="http")
+    config.update(scenario_config or {})
+    for override in overrides:
+        key, value = override.split("=", 1)
+        config[key] = YAML(typ="safe").load(value)
+    return BenchConfig(config)
+
+
+async def monitor(samples, stop):
+    """
+    Samples the event loop lag and the resident memory until `stop` is set
+    """
+    loop = asyncio.get_running_loop()
+    interval = 0.01
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples["lag"].append(max(0.0, loop.time() - started - interval))
+        samples["rss_kb"] = max(samples["rss_kb"], current_rss_kb())
+
+
+async def start_site(app):
+    """
+    :return: the runner of the app served on a free local port, and its base URL
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+
+async def start_bot(name, config, homeserver: FakeHomeserver, homeserver_url):
+    bot = BridgeBot.__new__(BridgeBot)
+    bot.config = config
+    bot.client = FakeMatrixClient(homeserver, homeserver_url, aiohttp.ClientSession(), token=f"bench-{name}")
+    bot.log = logging.getLogger(f"bench.{name}")
+    # the web app of the plugin, only the media proxy and messages_ready endpoints
+    webapp = web.Application()
+    webapp.router.add_get("/media/{server_name}/{media_id}", bot.media_proxy)
+    webapp.router.add_post("/messages_ready", bot.messages_ready)
+    bot.webapp_runner, bot.webapp_url = await start_site(webapp)
+    await bot.start()
+    bot.log.setLevel(logging.WARNING)
+    return bot
+
+
+async def stop_bot(bot):
+    await bot.stop()
+    await bot.webapp_runner.cleanup()
+    await bot.client.api.session.close()
+
+
+def delivered_messages(bots):
+    """
+    :return: the first time each Talks message reached Matrix, and how many times it was sent again
+    """
+    delivered = dict()
+    for bot in bots:
+        for talks_id, delivered_at in bot.client.delivered.items():
+            delivered[talks_id] = min(delivered_at, delivered.get(talks_id, delivered_at))
+    return delivered, sum(len(bot.client.delivered) for bot in bots) - len(delivered)
+
+
+async def run_scenario(name, rooms, rate, media, html, outage, duration, drain_timeout, overrides, instances=1,
+                       reply_mxc=False, rate_limited=False, config=None):
+    scenario_config = config
+    talks_config = load_config(overrides, scenario_config)
+    talks = FakeTalks(media, html, reply_mxc=reply_mxc, api_key=talks_config["talks_api_key"])
+    runner, talks_url = await start_site(talks.app(talks_config))
+    port = int(talks_url.rsplit(":", 1)[1])
+    homeserver = FakeHomeserver(rate_limited)
+    homeserver_runner, homeserver_url = await start_site(homeserver.app())
+
+    bots = list()
+    shard_instances = [f"bench-{i}" for i in range(instances)]
+    for shard_instance in shard_instances:
+        config = load_config(overrides, scenario_config)
+        config["talks_port"] = port
+        if instances > 1:
+            config["shard_instance"] = shard_instance
+            config["shard_instances"] = shard_instances
+            config["shard_handoff_delay"] = 0
+        bots.append(await start_bot(f"{name}.{shard_instance}", config, homeserver, homeserver_url))
+        if config["talks_delivery_mode"] == "webhook":
+            talks.webhooks.append(f"{bots[-1].webapp_url}/messages_ready")
+
+    samples = {"lag": list(), "rss_kb": current_rss_kb()}
+    stop_monitor = asyncio.Event()
+    monitor_task = asyncio.create_task(monitor(samples, stop_monitor))
+
+    FakeEvent.read_receipts = 0
+    sent = dict()
+    room_ids = [f"!room{i}:bench.local" for i in range(rooms)]
+    interval = 1.0 / rate
+    started = time.perf_counter()
+    outage_start = started + duration / 3
+    outage_end = started + 2 * duration / 3
+    recovered_at = None
+    i = 0
+
+    while time.perf_counter() - started < duration:
+        now = time.perf_counter()
+        if outage:
+            talks.down = outage_start <= now < outage_end
+        evt = FakeEvent(room_ids[i % rooms], media)
+        sent[evt.event_id] = now
+        for bot in bots:
+            await bot.handle_custom_event(evt)
+        i += 1
+        await asyncio.sleep(max(0.0, started + i * interval - time.perf_counter()))
+    talks.down = False
+    generation_time = time.perf_counter() - started
+
+    deadline = time.perf_counter() + drain_timeout
+    while time.perf_counter() < deadline:
+        if outage and recovered_at is None and all(
+                event_id in talks.received for event_id, sent_at in sent.items() if sent_at < outage_end):
+            recovered_at = time.perf_counter()
+        if len(talks.received) >= len(sent) and len(delivered_messages(bots)[0]) >= len(talks.created):
+            break
+        await asyncio.sleep(0.05)
+    total_time = time.perf_counter() - started
+
+    stop_monitor.set()
+    await monitor_task
+    for bot in bots:
+        await stop_bot(bot)
+    await talks.close()
+    await runner.cleanup()
+    await homeserver_runner.cleanup()
+
+    delivered, redelivered = delivered_messages(bots)
+    inbound = [talks.received[event_id] - sent_at for event_id, sent_at in sent.items() if event_id in talks.received]
+    outbound = [delivered[talks_id] - created_at for talks_id, created_at in talks.created.items()
+                if talks_id in delivered]
+    result = {
+        "scenario": name,
+        "instances": instances,
+        "rooms": rooms,
+        "rate": rate,
+        "media": media,
+        "html": html,
+        "duration_s": round(generation_time, 3),
+        "sent": len(sent),
+        "received_by_talks": len(talks.received),
+        "delivered_to_matrix": len(delivered),
+        "delivered_more_than_once": redelivered,
+        "inbound_messages_per_s": round(len(inbound) / total_time, 2),
+        "outbound_messages_per_s": round(len(outbound) / total_time, 2),
+        "inbound_latency": latency_summary(inbound),
+        "outbound_latency": latency_summary(outbound),
+        "event_loop_lag": latency_summary(samples["lag"]),
+        "rss_high_water_kb": samples["rss_kb"],
+        "talks_requests": talks.requests,
+        "talks_receive_requests": talks.receive_requests,
+        "talks_get_messages_requests_per_s": round(talks.get_messages_requests / total_time, 2),
+        "read_receipts": FakeEvent.read_receipts,
+        "homeserver_rate_limited_sends": homeserver.rate_limited_sends,
+        "homeserver_media_downloads": homeserver.downloads,
+        "homeserver_media_bytes": homeserver.bytes_downloaded,
+        "talks_media_bytes_fetched": talks.media_bytes_fetched,
+    }
+    if outage:
+        result["talks_requests_during_outage"] = talks.requests_while_down
+        result["recovery_s"] = round(recovered_at - outage_end, 3) if recovered_at is not None else None
+    return result
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Bridge load test and benchmark harness")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="scenario to run (repeatable)")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of traffic per scenario")
+    parser.add_argument("--drain-timeout", type=float, default=60.0, help="seconds to wait for in-flight messages")
+    parser.add_argument("--rate", type=float, help="override the scenario message rate, in messages per second")
+    parser.add_argument("--instances", type=int, default=1, help="bridge instances sharing the rooms")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="override a config value")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        revision = None
+
+    results = []
+    for name in args.scenario or list(SCENARIOS):
+        scenario = dict(SCENARIOS[name])
+        if args.rate:
+            scenario["rate"] = args.rate
+        results.append(await run_scenario(name, duration=args.duration, drain_timeout=args.drain_timeout,
+                                          overrides=args.set, instances=args.instances, **scenario))
+
+    report = json.dumps({"revision": revision, "config_overrides": args.set, "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,7 +1,7 @@
 #!/bin/bash
 
-PACKAGES="cachetools jsonpickle requests"
-ALL_PACKAGES="cachetools certifi charset_normalizer idna jsonpickle requests urllib3"
+PACKAGES="cachetools"
+ALL_PACKAGES="cachetools"
 
 set -e
 
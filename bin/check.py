@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+"""
+Behavior checks of the bridge modules that do not depend on the plugin runtime. Runs every check, or the ones
+given on the command line, and exits with a non-zero status on the first failing assertion.
+
+Usage:
+  bin/check.py [NAME ...]
+"""
+
+import asyncio
+import base64
+import json
+import logging
+import os
+import re
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from indexes import DeduplicationIndex, EchoIndex  # noqa: E402
+from matcher import PatternMatcher  # noqa: E402
+from aiohttp import web  # noqa: E402
+from media import ByteBudget, MediaDiskCache, base64_chunks, container_info, container_tail_size, streamed_json_body  # noqa: E402
+from ratelimit import OutboundScheduler, TokenBucket  # noqa: E402
+from sharding import HashRing, ShardMembership  # noqa: E402
+from store import DurableStore  # noqa: E402
+from talks_client import CircuitBreaker, RequestBodyError, TalksBatcher, TalksClient, TalksHttpResponse  # noqa: E402
+
+
+def check_matcher():
+    rules = [".*end user.*", ".*service provider.*", "help"]
+    matcher = PatternMatcher(rules)
+    assert matcher.combined is not None
+    assert matcher.match("I am an END USER") == 0
+    assert matcher.match("service provider and end user") == 0, "the first rule wins, as with one re.match per rule"
+    assert matcher.match("a service provider") == 1
+    assert matcher.match("help me") == 2
+    assert matcher.match("please help") is None, "re.match semantics: anchored at the start"
+    assert matcher.match("nothing") is None
+
+    # rules with groups of their own are still matched by index
+    assert PatternMatcher(["(a|b)c", "(d)+"]).match("dd") == 1
+
+    # named groups, backreferences and global inline flags can not be combined, but match the same way
+    for patterns, text, expected in ((["(?P<x>a)b", "c"], "c", 1), ([r"(a)\1", "b"], "aa", 0),
+                                     (["(?s)a.b", "c"], "a\nb", 0), (["x", "(<)?a(?(1)>|)$"], "<a>", 1),
+                                     (["x", "(<)?a(?(1)>|)$"], "<a", None)):
+        matcher = PatternMatcher(patterns)
+        assert matcher.combined is None, patterns
+        assert matcher.match(text) == expected, patterns
+
+    assert PatternMatcher(["!abc.*"], flags=0).match("!ABC:server") is None
+    assert PatternMatcher([]).match("anything") is None
+
+
+async def iterate(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def collect(chunks) -> bytes:
+    return b"".join([chunk async for chunk in chunks])
+
+
+async def start_site(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+
+def check_media_streaming():
+    data = bytes(range(256)) * 40
+
+    async def run():
+        for sizes in ((1,), (2, 5), (3, 3), (1000, 7, 1)):
+            chunks, pos = list(), 0
+            while pos < len(data):
+                for size in sizes:
+                    chunks.append(data[pos:pos + size])
+                    pos += size
+            assert await collect(base64_chunks(iterate(*chunks))) == base64.b64encode(data), sizes
+        assert await collect(base64_chunks(iterate())) == b""
+
+        fields = {"roomId": "!a:x", "body": "caf\u00e9 \"quoted\""}
+        body = await collect(streamed_json_body(fields, "bytes", iterate(data[:10], data[10:]), double_encoded=False))
+        assert json.loads(body) == dict(fields, bytes=base64.b64encode(data).decode("ascii"))
+        body = await collect(streamed_json_body(fields, "bytes", iterate(data), double_encoded=True))
+        assert json.loads(json.loads(body)) == dict(fields, bytes=base64.b64encode(data).decode("ascii"))
+        assert json.loads(await collect(streamed_json_body({}, "bytes", iterate(b"x"), double_encoded=False))) == \
+            {"bytes": "eA=="}
+
+        budget = ByteBudget(100)
+        order = list()
+
+        async def hold(name, size, seconds):
+            async with budget.reserve(size):
+                order.append(name)
+                await asyncio.sleep(seconds)
+
+        first = asyncio.create_task(hold("first", 60, 0.05))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(hold("second", 60, 0))
+        large = asyncio.create_task(hold("large", 1000, 0))
+        await asyncio.gather(first, second, large)
+        assert order[0] == "first" and set(order[1:]) == {"second", "large"}, order
+        assert budget.in_flight == 0
+        assert budget.reserve(1000).size == 100, "a reservation larger than the budget takes the whole budget"
+
+        # a failing body source is reported as such and does not count against the Talks circuit breaker
+        async def receive(request):
+            await request.read()
+            return web.json_response({"description": "ok"})
+
+        app = web.Application()
+        app.router.add_post("/receive", receive)
+        runner, url = await start_site(app)
+        # the server side of the interrupted request logs the lost connection
+        logging.getLogger("aiohttp.server").setLevel(logging.CRITICAL)
+        breaker = CircuitBreaker(failure_threshold=1, open_timeout=60, max_open_timeout=60)
+        client = TalksClient("key", pool_size=4, default_timeout=5, breaker=breaker)
+        client.add_endpoint(TalksClient.RECEIVE_MESSAGE, f"{url}/receive")
+        await client.start()
+
+        async def failing():
+            yield b"{"
+            raise ConnectionResetError("homeserver went away")
+
+        try:
+            await client.post_data(f"{url}/receive", failing())
+            raise AssertionError("the body source error is raised")
+        except RequestBodyError as e:
+            assert isinstance(e.__cause__, ConnectionResetError)
+        assert breaker.closed and breaker.failures == 0
+        r = await client.post_data(f"{url}/receive", iterate(b'{"a": ', b'1}'))
+        assert r.status_code == 200 and r.json() == {"description": "ok"}
+        await client.close()
+        await runner.cleanup()
+
+    asyncio.run(run())
+
+
+class ScriptedTalksClient:
+    """
+    Answers the batched calls with the given responses, recording the bodies
+    """
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.bodies = list()
+
+    async def post_data(self, url, data):
+        self.bodies.append(json.loads(data))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def check_media_disk_cache():
+    async def run(directory):
+        cache = MediaDiskCache(directory, max_bytes=10)
+        downloads = list()
+
+        async def download(*chunks):
+            downloads.append(chunks)
+            await asyncio.sleep(0.01)
+            for chunk in chunks:
+                yield chunk
+
+        first, second = await asyncio.gather(cache.fill("a", download(b"aaa", b"a")), cache.fill("a", download(b"x")))
+        assert first == second == cache.path("a") and downloads == [(b"aaa", b"a")], "concurrent fills share one"
+        with open(first, "rb") as f:
+            assert f.read() == b"aaaa"
+
+        await cache.fill("b", download(b"bbbb"))
+        assert cache.get("a") is not None, "a is now the most recently used"
+        await cache.fill("c", download(b"cccc"))
+        assert cache.get("b") is None and not os.path.exists(cache.path("b")), "the least recently used is evicted"
+        assert list(cache.files) == ["a", "c"] and cache.total_bytes == 8
+        await cache.fill("d", download(b"d" * 20))
+        assert list(cache.files) == ["d"], "a file larger than the cache is kept alone"
+
+        async def failing():
+            yield b"partial"
+            await asyncio.sleep(0.01)
+            raise OSError("download failed")
+
+        results = await asyncio.gather(cache.fill("e", failing()), cache.fill("e", download(b"e")),
+                                       return_exceptions=True)
+        assert all(isinstance(result, OSError) for result in results), "waiters get the error of the shared fill"
+        assert cache.get("e") is None and not os.path.exists(f"{cache.path('e')}.tmp")
+        assert cache.filling == {}
+        await cache.fill("e", download(b"e"))
+        assert list(cache.files) == ["e"], "filled again after a failure"
+
+        with open(f"{cache.path('f')}.tmp", "wb") as f:
+            f.write(b"left by a crash")
+        reloaded = MediaDiskCache(directory, max_bytes=100)
+        assert reloaded.load() == 1 and reloaded.files == {"e": 1}
+        assert not os.path.exists(f"{cache.path('f')}.tmp")
+
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(run(directory))
+
+
+def check_talks_batcher():
+    def ok(results):
+        return TalksHttpResponse(200, json.dumps({"results": results}))
+
+    async def run():
+        client = ScriptedTalksClient(ok([{"status": 200, "description": "ok"}, {"status": 503, "description": "busy"}]))
+        batcher = TalksBatcher(client, "/batch", max_size=10, linger=0.01)
+        first, second = await asyncio.gather(batcher.submit('{"n": 1}'), batcher.submit('{"n": 2}'))
+        assert (first.status_code, second.status_code) == (200, 503)
+        assert second.json()["description"] == "busy"
+        assert client.bodies == [{"messages": [{"n": 1}, {"n": 2}]}]
+
+        # invalid or short results are retryable failures, never taken as delivered
+        for response, expected in ((ok(["ok", "ok"]), [502, 502]),
+                                   (TalksHttpResponse(200, json.dumps({"results": {"0": {}}})), [502, 502]),
+                                   (TalksHttpResponse(200, "not json"), [502, 502]),
+                                   (ok([{"status": 200}]), [200, 502]),
+                                   (ok([{"status": "200"}, {}]), [502, 200])):
+            batcher = TalksBatcher(ScriptedTalksClient(response), "/batch", max_size=10, linger=0.01)
+            statuses = [r.status_code for r in await asyncio.wait_for(
+                batcher.submit_many(['{"n": 1}', '{"n": 2}']), timeout=1)]
+            assert statuses == expected, (response.text, statuses)
+
+        # a failed call is the response of every item, an error is raised to every submitter
+        batcher = TalksBatcher(ScriptedTalksClient(TalksHttpResponse(500, '{"description": "down"}')), "/batch",
+                               max_size=10, linger=0.01)
+        assert [r.status_code for r in await batcher.submit_many(['{"n": 1}', '{"n": 2}'])] == [500, 500]
+        batcher = TalksBatcher(ScriptedTalksClient(ConnectionResetError()), "/batch", max_size=10, linger=0.01)
+        results = await asyncio.gather(batcher.submit('{"n": 1}'), batcher.submit('{"n": 2}'), return_exceptions=True)
+        assert all(isinstance(result, ConnectionResetError) for result in results)
+
+        # the items of one submission stay together and in order, a full batch is sent without lingering
+        client = ScriptedTalksClient(ok([{"status": 200}] * 3), ok([{"status": 200}] * 3))
+        batcher = TalksBatcher(client, "/batch", max_size=3, linger=60)
+        await asyncio.wait_for(asyncio.gather(batcher.submit('{"n": 1}'),
+                                              batcher.submit_many(['{"n": 2}', '{"n": 3}', '{"n": 4}'])), timeout=1)
+        assert client.bodies[1] == {"messages": [{"n": 2}, {"n": 3}, {"n": 4}]}, client.bodies
+        assert client.bodies[0] == {"messages": [{"n": 1}]}
+
+    asyncio.run(run())
+
+
+def check_circuit_breaker():
+    closed = list()
+    breaker = CircuitBreaker(failure_threshold=3, open_timeout=0.05, max_open_timeout=0.1,
+                             on_close=lambda: closed.append(True))
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.closed and breaker.allow(), "a success resets the consecutive failures"
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and breaker.opened == 1
+    assert not breaker.allow() and breaker.rejected == 1
+    assert 0 < breaker.seconds_to_probe() <= 0.05
+
+    time.sleep(0.06)
+    assert breaker.allow() and breaker.state == CircuitBreaker.HALF_OPEN, "one probe once the timeout is over"
+    assert not breaker.allow(), "a single probe at a time"
+    breaker.release_probe()
+    assert breaker.state == CircuitBreaker.OPEN and breaker.allow(), "a cancelled probe gives its slot back"
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and breaker.current_open_timeout == 0.1, "a failed probe doubles it"
+    breaker.record_failure()
+    assert breaker.current_open_timeout == 0.1 and breaker.opened == 2, "failures while open change nothing"
+
+    time.sleep(0.11)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.current_open_timeout == 0.1, "up to max_open_timeout"
+    time.sleep(0.11)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.closed and closed == [True] and breaker.current_open_timeout == 0.05
+    assert breaker.seconds_to_probe() == 0.0
+
+
+def check_store():
+    async def run(path):
+        log = logging.getLogger("check")
+        store = DurableStore(path, 0.01, log)
+        await store.start()
+        assert await store.load() == ([], [])
+        assert await store.load_room_routes() == {}
+        first = store.add_inbound("!a:x", "{}", "one")
+        second = store.add_inbound("!b:x", "{}", None)
+        third = store.add_inbound("!a:x", "{}", "three")
+        assert (first, second, third) == (1, 2, 3)
+        store.remove_inbound(second)
+        store.add_outbound("t1", "$e1", None, "default")
+        store.add_outbound("t2", None, "mxc://x/y", "other")
+        store.add_outbound("t1", "$e1bis", None, "default")
+        store.remove_outbound("t2")
+        store.set_room_route("!a:x", "other")
+        store.set_room_route("!b:x", "other")
+        store.set_room_route("!a:x", "default")
+        # closing commits the pending writes
+        await store.close()
+
+        store = DurableStore(path, 0.01, log)
+        await store.start()
+        inbound, outbound = await store.load()
+        assert inbound == [(1, "!a:x", "{}", "one"), (3, "!a:x", "{}", "three")], inbound
+        assert outbound == [("t1", "$e1bis", None, "default")], outbound
+        assert await store.load_room_routes() == {"!a:x": "default", "!b:x": "other"}
+        assert store.add_inbound("!c:x", "{}", None) == 4, "sequence numbers continue after a restart"
+        await store.close()
+
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(run(os.path.join(directory, "store.sqlite")))
+
+
+def check_deduplication_index():
+    index = DeduplicationIndex(maxsize=80, ttl=600)
+    assert not index.check_and_add("$a")
+    assert index.check_and_add("$a")
+    assert not index.check_and_add("$b")
+
+    # memory stays around maxsize: whole buckets are dropped once all of them are in use
+    for i in range(1000):
+        index.check_and_add(f"$filler{i}")
+    assert len(index) <= 80 + index.bucket_size, len(index)
+    assert "$a" not in index and "$filler999" in index
+
+    expiring = DeduplicationIndex(maxsize=100, ttl=0.05, bucket_count=2)
+    expiring.check_and_add("$old")
+    time.sleep(0.1)
+    assert not expiring.check_and_add("$old"), "expired after the ttl"
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "deduplication.json")
+        assert DeduplicationIndex(100, 600, path=path).load() == 0, "a missing snapshot is not an error"
+        saved = DeduplicationIndex(100, 600, path=path)
+        for key in ("$x", "$y"):
+            saved.check_and_add(key)
+        assert saved.save(saved.snapshot()) == 2
+        loaded = DeduplicationIndex(100, 600, path=path)
+        assert loaded.load() == 2
+        assert loaded.check_and_add("$x") and not loaded.check_and_add("$z")
+        assert DeduplicationIndex(100, 0.0001, path=path).load() == 0, "expired entries are not loaded"
+
+
+def check_echo_index():
+    index = EchoIndex(maxsize=3, ttl=600)
+    key = EchoIndex.key("!a:x", "hello")
+    assert key == EchoIndex.key("!a:x", "hello") and key != EchoIndex.key("!b:x", "hello")
+    index.add(key)
+    index.add(key)
+    assert index.match(key) and index.match(key), "each registration suppresses one echo"
+    assert not index.match(key)
+    assert not index.match(EchoIndex.key("!b:x", "hello")), "identical messages to other rooms do not interfere"
+    assert (index.hits, index.misses) == (2, 2)
+
+    index.add(key)
+    index.discard(key)
+    assert not index.match(key), "a discarded registration matches no echo"
+
+    for body in ("1", "2", "3", "4"):
+        index.add(EchoIndex.key("!a:x", body))
+    assert not index.match(EchoIndex.key("!a:x", "1")), "the oldest registration is dropped beyond maxsize"
+    assert index.match(EchoIndex.key("!a:x", "4"))
+
+    expiring = EchoIndex(maxsize=10, ttl=0.05)
+    expiring.add(key)
+    time.sleep(0.1)
+    assert not expiring.match(key), "expired after the ttl"
+
+
+def check_ratelimit():
+    bucket = TokenBucket(rate=2, burst=3, now=0)
+    for _ in range(3):
+        assert bucket.delay(0) == 0
+        bucket.take()
+    assert bucket.delay(0) == 0.5, "one token every 1 / rate seconds"
+    assert bucket.delay(0.25) == 0.25
+    assert bucket.delay(10) == 0 and bucket.tokens == 3, "refilled up to the burst only"
+    assert bucket.full(10)
+    assert TokenBucket(rate=1, burst=0, now=0).burst == 1
+
+    async def run():
+        scheduler = OutboundScheduler(room_rate=20, room_burst=1)
+        waits = [await scheduler.acquire("!a:x") for _ in range(3)]
+        assert waits[0] < 0.01 and all(0.03 < wait < 0.1 for wait in waits[1:]), waits
+        assert await scheduler.acquire("!b:x") < 0.01, "rooms are paced independently"
+
+        scheduler.pause(0.1)
+        assert await scheduler.acquire("!c:x") >= 0.09, "pause holds every room"
+
+        scheduler.release("!c:x")
+        assert "!c:x" in scheduler.room_buckets, "a room that sent just now still has to wait for its bucket"
+        await asyncio.sleep(0.06)
+        scheduler.release("!c:x")
+        assert "!c:x" not in scheduler.room_buckets, "refilled buckets are dropped"
+
+        limited = OutboundScheduler(room_rate=1000, room_burst=10, global_rate=20, global_burst=1)
+        started = time.monotonic()
+        await asyncio.gather(*(limited.acquire(f"!room{i}:x") for i in range(5)))
+        assert time.monotonic() - started >= 0.19, "the global bucket paces all the rooms together"
+
+    asyncio.run(run())
+
+
+def wav_file(byte_rate: int, data_size: int) -> bytes:
+    fmt = struct.pack("<HHIIHH", 1, 1, byte_rate, byte_rate, 1, 8)
+    chunks = b"fmt " + struct.pack("<I", len(fmt)) + fmt + b"data" + struct.pack("<I", data_size) + bytes(data_size)
+    return b"RIFF" + struct.pack("<I", 4 + len(chunks)) + b"WAVE" + chunks
+
+
+def ogg_page(granule_position: int, payload: bytes) -> bytes:
+    return b"OggS" + struct.pack("<BBqIIIB", 0, 0, granule_position, 1, 0, 0, 1) + bytes([len(payload)]) + payload
+
+
+def opus_file(duration_ms: int, pre_skip: int = 312) -> bytes:
+    head = b"OpusHead" + struct.pack("<BBHIhB", 1, 1, pre_skip, 48000, 0, 0)
+    return ogg_page(0, head) + ogg_page(0, bytes(100)) + ogg_page(duration_ms * 48 + pre_skip, bytes(100))
+
+
+def ebml(element_id: int, payload: bytes) -> bytes:
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big") + bytes([0x80 | len(payload)]) + payload
+
+
+def webm_file(width: int, height: int, duration_ms: int) -> bytes:
+    info = ebml(0x2AD7B1, (1000000).to_bytes(3, "big")) + ebml(0x4489, struct.pack(">f", duration_ms))
+    video = ebml(0xB0, width.to_bytes(2, "big")) + ebml(0xBA, height.to_bytes(2, "big"))
+    tracks = ebml(0x1654AE6B, ebml(0xAE, ebml(0xE0, video)))
+    # a segment of unknown size, as written by live encoders
+    segment = bytes.fromhex("18538067") + bytes.fromhex("01ffffffffffffff") + ebml(0x1549A966, info) + tracks
+    return ebml(0x1A45DFA3, ebml(0x4282, b"webm")) + segment
+
+
+def mp4_box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I", 8 + len(payload)) + box_type + payload
+
+
+def mp4_file(width: int, height: int, duration_ms: int, timescale: int = 600) -> bytes:
+    mvhd = struct.pack(">IIIII", 0, 0, 0, timescale, duration_ms * timescale // 1000) + bytes(80)
+    tkhd = bytes(76) + struct.pack(">II", width << 16, height << 16)
+    moov = mp4_box(b"mvhd", mvhd) + mp4_box(b"trak", mp4_box(b"tkhd", tkhd))
+    return mp4_box(b"ftyp", b"isom" + bytes(4)) + mp4_box(b"moov", moov) + mp4_box(b"mdat", bytes(100))
+
+
+def check_media_containers():
+    assert container_info(wav_file(8000, 16000)) == (None, None, 2000)
+    assert container_info(wav_file(8000, 16000)[:-8000]) == (None, None, 1000), "truncated data is measured"
+    assert container_info(opus_file(3000)) == (None, None, 3000)
+    assert container_info(webm_file(640, 480, 5000)) == (640, 480, 5000)
+    assert container_info(mp4_file(1280, 720, 4000)) == (1280, 720, 4000)
+    assert container_info(b"\x89PNG\r\n\x1a\n" + bytes(100)) == (None, None, None), "not a container"
+    assert container_info(mp4_file(1280, 720, 4000)[:40]) == (None, None, None), "cut headers are not an error"
+    assert container_info(b"OggS" + bytes(10)) == (None, None, None)
+
+    # the beginning of the file only, as fetched with a range request, plus its tail for OGG
+    wav = wav_file(8000, 16000)
+    assert container_tail_size(wav) == 0
+    assert container_info(wav[:100], partial=True) == (None, None, 2000), "the declared data size is trusted"
+    opus = opus_file(3000)
+    tail_size = container_tail_size(opus)
+    assert tail_size > 0
+    assert container_info(opus[:50], tail=opus[-tail_size:], partial=True) == (None, None, 3000)
+    assert container_info(opus[:50], partial=True) == (None, None, None), "no duration without the tail"
+    assert container_info(opus[:50], tail=bytes(100), partial=True) == (None, None, None)
+
+
+def check_sharding():
+    rooms = [f"!room{i}:x" for i in range(3000)]
+    ring = HashRing(["a", "b", "c"])
+    owners = [ring.owner(room_id) for room_id in rooms]
+    assert owners == [HashRing(["c", "a", "b", "a"]).owner(room_id) for room_id in rooms], "order independent"
+    assert all(700 < owners.count(instance) < 1300 for instance in "abc"), "rooms spread evenly"
+    smaller = HashRing(["a", "b"])
+    assert all(smaller.owner(room_id) == owner for room_id, owner in zip(rooms, owners) if owner != "c"), \
+        "removing an instance only moves its rooms"
+
+    instances = ["a", "b", "c"]
+    membership = ShardMembership("a", instances, lease_timeout=30, now=0)
+    assert membership.update({}, now=10) == ([], []), "every instance is presumed alive at start"
+    assert membership.handed_off_since(10) == 0, "no live instance to wait for"
+    assert membership.update({"b": (35, instances, None, None)}, now=40) == ([], ["c"])
+    assert membership.alive == ["a", "b"] and membership.ring.owner(rooms[0]) in ("a", "b")
+    assert membership.alive_since == 40
+    assert membership.last_heartbeat("b") == 35 and membership.last_heartbeat("c") is None
+    assert membership.handed_off_since(40) is None, "b does not tell whether it counts a alive"
+    assert membership.update({"b": (45, instances, ["b"], 5)}, now=50) == ([], [])
+    assert membership.handed_off_since(50) is None, "b does not count a alive yet"
+    assert membership.update({"b": (55, instances, ["a", "b"], 52)}, now=60) == ([], [])
+    assert membership.handed_off_since(60) == 52, "b stopped handling the rooms of a at 52"
+    assert membership.update({"b": (35, instances, ["b"], 5), "c": (80, instances, ["a", "c"], 80)},
+                             now=90) == (["c"], ["b"]), "an older heartbeat is ignored"
+    assert membership.views["b"] == (["a", "b"], 52)
+    assert membership.handed_off_since(90) == 80
+    assert membership.mismatched({"b": (65, ["a", "b"], None, None), "c": (65, ["c", "b", "a"], None, None)},
+                                 now=70) == ["b"]
+    assert membership.mismatched({"b": (10, ["a", "b"], None, None)}, now=70) == [], \
+        "stopped instances do not matter"
+
+CHECKS = {name[len("check_"):]: check for name, check in globals().items() if re.match("check_", name)}
+
+
+def main():
+    names = sys.argv[1:] or list(CHECKS)
+    for name in names:
+        CHECKS[name]()
+        print(f"{name}: ok")
+
+
+if __name__ == "__main__":
+    main()
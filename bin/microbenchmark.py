@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks of the bridge building blocks, run in-process without any server, printing one JSON document with
+the results of every benchmark, so runs can be compared with each other.
+Only needs the dependencies of the modules each benchmark imports.
+
+Usage:
+  bin/microbenchmark.py [--benchmark NAME ...] [--output FILE]
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from indexes import DeduplicationIndex  # noqa: E402
+from matcher import PatternMatcher  # noqa: E402
+from store import DurableStore  # noqa: E402
+
+RULE_COUNTS = (1, 10, 100, 1000)
+DURABLE_STORE_MESSAGES = 20000
+DEDUPLICATION_IDS = 1000000
+
+
+def per_call_us(function, min_time=0.2):
+    """
+    :return: the mean time of one call, in microseconds, over enough calls to last at least `min_time` seconds
+    """
+    calls = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(calls):
+            function()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return round(elapsed / calls * 1e6, 3)
+        calls *= 2
+
+
+def peak_allocated_bytes(function) -> int:
+    """
+    :return: the peak memory allocated by one call, which includes its temporary objects
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def matcher_scaling():
+    """
+    Cost of matching a message against N room tag rules, with the compiled PatternMatcher and with one `re.match`
+    per raw pattern string as before. The message matches no rule, the worst case of both
+    """
+    text = "I would like to answer the survey later, thanks"
+    results = list()
+    for count in RULE_COUNTS:
+        patterns = [f".*rule number {i}.*" for i in range(count)]
+        matcher = PatternMatcher(patterns)
+        results.append({
+            "rules": count,
+            "combined": matcher.combined is not None,
+            "pattern_matcher_us": per_call_us(lambda: matcher.match(text)),
+            "re_match_per_rule_us": per_call_us(
+                lambda: next((i for i, pattern in enumerate(patterns) if re.match(pattern, text, re.IGNORECASE)),
+                             None)),
+        })
+    return results
+
+
+def talks_payloads():
+    """
+    Encode and decode cost of the Talks payloads, with the single JSON encoding and with the legacy double encoding
+    kept behind `talks_double_encoded_json`. Imports the plugin, so it needs `maubot` installed
+    """
+    from bridge import TalksConfirmMessageRequest, TalksReceiveMessageRequest, TalksResponse
+
+    def receive_message_request(media: bool):
+        event_id = f"${uuid.uuid4()}"
+        return TalksReceiveMessageRequest(
+            1700000000000, "!room:bench.local", event_id, "@user:bench.local", "m.room.message",
+            "image.png" if media else f"hello {event_id}", "m.image" if media else "m.text", None, None, None,
+            "image/png" if media else None, "mxc://bench.local/media" if media else None,
+            base64.b64encode(b"\x00" * 256 * 1024) if media else None)
+
+    confirm_request = TalksConfirmMessageRequest(
+        [TalksConfirmMessageRequest.Message(str(uuid.uuid4()), f"${uuid.uuid4()}", None) for _ in range(100)])
+    get_messages_response = json.dumps({"description": "ok", "messages": [
+        {"id": str(uuid.uuid4()), "roomId": f"!room{i}:bench.local", "messageType": "m.text", "bodyType": "TEXT",
+         "body": f"reply {i}", "actions": {"1": "Yes", "2": "No"}, "mimeType": None, "mxcUri": None,
+         "filename": None} for i in range(100)]})
+
+    cases = {
+        "encode_text_receive_message": receive_message_request(media=False).to_json,
+        "encode_media_receive_message": receive_message_request(media=True).to_json,
+        "encode_confirm_100_messages": confirm_request.to_json,
+        "decode_get_messages_100_messages": lambda: TalksResponse.from_json(get_messages_response),
+    }
+    results = dict()
+    for name, function in cases.items():
+        results[name] = {"us": per_call_us(function), "peak_allocated_bytes": peak_allocated_bytes(function)}
+        if name.startswith("encode"):
+            def double_encoded(encode=function):
+                return json.dumps(encode())
+
+            results[f"{name}_double_encoded"] = {"us": per_call_us(double_encoded),
+                                                 "peak_allocated_bytes": peak_allocated_bytes(double_encoded)}
+    return results
+
+
+def durable_store():
+    """
+    Messages per second persisted by DurableStore, each one inserted then deleted as when it is sent to Talks, with
+    the group commit of the writer task and with one transaction per write as a baseline
+    """
+    event = json.dumps({"type": "m.room.message", "content": {"msgtype": "m.text", "body": "x" * 200}})
+
+    async def group_committed(path):
+        store = DurableStore(path, 0.05, logging.getLogger("microbenchmark"))
+        await store.start()
+        started = time.perf_counter()
+        for i in range(DURABLE_STORE_MESSAGES):
+            store.remove_inbound(store.add_inbound(f"!room{i % 100}:bench.local", event, "x" * 200))
+            if i % 100 == 0:
+                # the messages arrive over time, letting the writer task run
+                await asyncio.sleep(0)
+        await store.close()
+        return time.perf_counter() - started
+
+    def transaction_per_write(path):
+        connection = sqlite3.connect(path, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        for statement in DurableStore.SCHEMA:
+            connection.execute(statement)
+        started = time.perf_counter()
+        for i in range(DURABLE_STORE_MESSAGES):
+            connection.execute("INSERT INTO inbound (seq, room_id, event, body) VALUES (?, ?, ?, ?)",
+                               (i, f"!room{i % 100}:bench.local", event, "x" * 200))
+            connection.execute("DELETE FROM inbound WHERE seq = ?", (i,))
+        connection.close()
+        return time.perf_counter() - started
+
+    with tempfile.TemporaryDirectory() as directory:
+        group_committed_s = asyncio.run(group_committed(os.path.join(directory, "group.sqlite")))
+        transaction_per_write_s = transaction_per_write(os.path.join(directory, "baseline.sqlite"))
+    return {
+        "messages": DURABLE_STORE_MESSAGES,
+        "group_committed_messages_per_s": round(DURABLE_STORE_MESSAGES / group_committed_s),
+        "transaction_per_write_messages_per_s": round(DURABLE_STORE_MESSAGES / transaction_per_write_s),
+    }
+
+
+def deduplication_index():
+    """
+    Memory held by the deduplication index for a million event IDs, not counting the ID strings themselves, and
+    the cost of a lookup, against the locked TTLCache it replaced
+    """
+    import cachetools
+
+    event_ids = [f"${base64.urlsafe_b64encode(os.urandom(32)).decode('ascii').rstrip('=')}"
+                 for _ in range(DEDUPLICATION_IDS)]
+    lock = threading.RLock()
+
+    def ttl_cache_check_and_add(cache, key):
+        with lock:
+            if key in cache:
+                return True
+            cache[key] = True
+            return False
+
+    results = dict()
+    for name, index, check_and_add in (
+            ("deduplication_index", DeduplicationIndex(DEDUPLICATION_IDS, 600), DeduplicationIndex.check_and_add),
+            ("locked_ttl_cache", cachetools.TTLCache(maxsize=DEDUPLICATION_IDS, ttl=600), ttl_cache_check_and_add)):
+        tracemalloc.start()
+        for event_id in event_ids:
+            check_and_add(index, event_id)
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        new_ids = iter([f"{event_id}new" for event_id in event_ids])
+        results[name] = {
+            "bytes_per_million_ids": round(allocated * 1000000 / DEDUPLICATION_IDS),
+            "duplicate_lookup_us": per_call_us(lambda: check_and_add(index, event_ids[0])),
+            "new_id_lookup_us": per_call_us(lambda: check_and_add(index, next(new_ids)), min_time=0.1),
+        }
+    return results
+
+
+BENCHMARKS = {
+    "matcher-scaling": matcher_scaling,
+    "talks-payloads": talks_payloads,
+    "durable-store": durable_store,
+    "deduplication-index": deduplication_index,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bridge micro-benchmarks")
+    parser.add_argument("--benchmark", action="append", choices=sorted(BENCHMARKS),
+                        help="benchmark to run (repeatable)")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        revision = None
+
+    results = {name: BENCHMARKS[name]() for name in args.benchmark or list(BENCHMARKS)}
+
+    report = json.dumps({"revision": revision, "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,26 +11,42 @@
 
 import asyncio
 import base64
-import functools
+import hmac
+import json
+import math
+import random
 import re
-from collections import defaultdict, deque
+import shutil
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from io import BytesIO
-from threading import RLock
 from typing import Type, Optional
 
+import aiohttp
 import cachetools
-import jsonpickle
-import requests
+from aiohttp.web import FileResponse, Request, Response, StreamResponse
+from backends import RoomRouter, TalksBackend
 from config import Config
+from indexes import DeduplicationIndex, EchoIndex
+from matcher import PatternMatcher
 from maubot import Plugin, MessageEvent
-from maubot.handlers import event
+from maubot.handlers import event, web
 from maubot.matrix import parse_formatted
+from mautrix.errors import MatrixRequestError, make_request_error
 from mautrix.types import EventType, TextMessageEventContent, MessageType, Format, LocationMessageEventContent, \
-    MediaMessageEventContent, ContentURI, ImageInfo, AudioInfo, VideoInfo, FileInfo, Event, RedactionEvent
+    MediaMessageEventContent, ContentURI, ImageInfo, AudioInfo, VideoInfo, FileInfo, Event, EventID, \
+    MessageEvent as MatrixMessageEvent
 from mautrix.util.config import BaseProxyConfig
-from requests.adapters import HTTPAdapter
-from urllib3.exceptions import NewConnectionError
+from media import ByteBudget, MediaDiskCache, MediaUploadCache, container_info, container_tail_size, \
+    streamed_json_body
+from metrics import MetricsRegistry
+from ratelimit import OutboundScheduler, TokenBucket
+from sharding import ShardMembership
+from store import DurableStore
+from talks_client import CircuitOpenError, RequestBodyError
 
 try:
     import magic
@@ -43,9 +59,26 @@ except ImportError:
     Image = None
 
 
-class TalksReceiveMessageRequest:
+class TalksPayload:
+    """
+    Slot-based Talks payload, serialized straight from its slots
+    """
+    __slots__ = ()
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict())
+
+
+class TalksReceiveMessageRequest(TalksPayload):
+    __slots__ = ("timestamp", "roomId", "eventId", "senderId", "eventType", "body", "messageType", "format",
+                 "formattedBody", "geoUri", "mimeType", "mxcUri", "bytes", "mediaUrl", "mediaInfo")
+
     def __init__(self, timestamp, room_id, event_id, sender_id, event_type, body, message_type,
-                 body_format, formatted_body, geo_uri, mime_type, mxc_uri, encoded_bytes: bytes):
+                 body_format, formatted_body, geo_uri, mime_type, mxc_uri, encoded_bytes: bytes,
+                 media_url=None, media_info=None):
         self.timestamp = timestamp
         self.roomId = room_id
         self.eventId = event_id
@@ -59,11 +92,16 @@ class TalksReceiveMessageRequest:
         self.mimeType = mime_type
         self.mxcUri = mxc_uri
         self.bytes = encoded_bytes.decode('utf-8') if encoded_bytes else None
+        self.mediaUrl = media_url
+        self.mediaInfo = media_info
 
 
-class TalksConfirmMessageRequest:
+class TalksConfirmMessageRequest(TalksPayload):
+    __slots__ = ("messages",)
+
+    class Message(TalksPayload):
+        __slots__ = ("sourceId", "matrixId", "mxcUri")
 
-    class Message:
         def __init__(self, source_id, matrix_id, mxc_uri):
             self.sourceId = source_id
             self.matrixId = matrix_id
@@ -72,8 +110,13 @@ class TalksConfirmMessageRequest:
     def __init__(self, messages):
         self.messages = messages
 
+    def to_dict(self) -> dict:
+        return {"messages": [message.to_dict() for message in self.messages]}
+
+
+class TalksTagRoomRequest(TalksPayload):
+    __slots__ = ("roomId", "tag", "value")
 
-class TalksTagRoomRequest:
     def __init__(self, room_id, tag, value):
         self.roomId = room_id
         self.tag = tag
@@ -102,23 +145,76 @@ class MediaCache:
 class TalksResponse:
 
     class Message:
-        def __init__(self, room_id, message_type, body_type, body, talks_id):
+        __slots__ = ("roomId", "messageType", "bodyType", "body", "id", "actions", "mimeType", "mxcUri", "filename")
+
+        def __init__(self, room_id, message_type, body_type, body, talks_id,
+                     actions=None, mime_type=None, mxc_uri=None, filename=None):
             self.roomId = room_id
             self.messageType = message_type
             self.bodyType = body_type
             self.body = body
             self.id = talks_id
+            self.actions = actions
+            self.mimeType = mime_type
+            self.mxcUri = mxc_uri
+            self.filename = filename
+
+        @classmethod
+        def from_dict(cls, message: dict):
+            get = message.get
+            return cls(get("roomId"), get("messageType"), get("bodyType"), get("body"), get("id"),
+                       get("actions"), get("mimeType"), get("mxcUri"), get("filename"))
 
     def __init__(self, description, messages):
         self.description = description
         self.messages = messages
 
+    @classmethod
+    def from_json(cls, text: str):
+        response = json.loads(text)
+        messages = [cls.Message.from_dict(message) for message in response.get("messages") or ()]
+        return cls(response.get("description"), messages)
+
+
+class InboundRoomQueue:
+    def __init__(self):
+        self.events = deque()
+        self.retries = 0
+
 
 class BridgeException(Exception):
     def __init__(self, message):
         self.message = message
 
 
+class MediaDownloadError(Exception):
+    """
+    Media of a user message could not be downloaded from the homeserver. A 4xx status other than 429, e.g. deleted
+    media, is permanent; connection errors and other statuses may be retried
+    """
+
+    def __init__(self, message, status=None):
+        self.message = message
+        self.status = status
+
+    @property
+    def permanent(self) -> bool:
+        return self.status is not None and 400 <= self.status < 500 and self.status != 429
+
+
+class HomeserverRateLimited(MatrixRequestError):
+    """
+    The homeserver rejected an event because the bot is rate limited, with the delay it asked for, if any
+    """
+
+    def __init__(self, retry_after_ms: Optional[int], message: str = ""):
+        super().__init__(message or "rate limited")
+        self.http_status = 429
+        self.errcode = "M_LIMIT_EXCEEDED"
+        self.message = message
+        self.retry_after_ms = retry_after_ms
+
+
 class BridgeBot(Plugin):
     """
      _________________________________________
@@ -137,49 +233,72 @@ class BridgeBot(Plugin):
     MATRIX_BOT_USER = None
     USER_ID_SKIP_LIST = None
 
-    TALKS_BASE_URL = None
     TALKS_API_KEY = None
-    TALKS_RECEIVE_MESSAGE = None
     TALKS_RECEIVE_MESSAGE_TIMEOUT= None
-    TALKS_GET_MESSAGES = None
-    TALKS_CONFIRM_MESSAGES = None
-    TALKS_TAG_ROOM = None
+    TALKS_DOUBLE_ENCODED_JSON = None
+    TALKS_DELIVERY_MODE = None
+    TALKS_LONG_POLL_WAIT = None
+    TALKS_MEDIA_STREAMING = None
+    TALKS_MEDIA_PROXY = None
+    MEDIA_CHUNK_SIZE = None
+    MEDIA_DOWNLOAD_RETRIES = None
+    MEDIA_HEADER_SIZE = None
+    SHARD_INSTANCE = None
+    SHARD_ACCOUNT_DATA_PREFIX = "xyz.maubot.talks_bridge_survey.shard."
 
     BOT_ON_REGEX = None
     BOT_OFF_REGEX = None
     ROOM_TAGS = None
+    ROOM_TAGS_MATCHER = None
 
     running = False
-    task = None
-    session = None
+    talks_backends = dict()
+    room_router = None
     activations = dict()
     hints = None
     forward_bot_messages = None
     deduplication_cache = None
-    deduplication_cache_lock = RLock()
     echo_cache = None
-    echo_cache_lock = RLock()
     talks_receive_message_queues = dict()
-    talks_receive_message_tasks = dict()
+    message_propagator_queues = dict()
+    message_propagator_tasks = dict()
+    message_ids_in_flight = set()
+    outbound_scheduler = None
+    retry_budget = None
+    pending_hints = dict()
+    hints_tasks = set()
+    room_sequences = dict()
+    hints_in_flight = dict()
+    shard_membership = None
+    shard_heartbeat_task = None
+    shard_standby = None
+    shard_handoff_since = None
+    shard_replay_tasks = set()
+    deduplication_snapshot_task = None
+    deduplication_snapshot_executor = None
+    pending_read_receipts = dict()
+    read_receipt_tasks = set()
+    html_render_cache = None
+    media_budget = None
+    media_upload_cache = None
+    media_inspection_executor = None
+    media_proxy_cache = None
+    durable_store = None
+    metrics = None
 
     media_cache: Type[MediaCache]
 
+    class DeliveryMode(Enum):
+        POLL = "poll"
+        LONG_POLL = "long_poll"
+        WEBHOOK = "webhook"
+
     class Channel(Enum):
         TELEGRAM = 1
         SIGNAL = 2
         WHATSAPP = 3
         MATRIX = 4
 
-    class TimeoutHTTPAdapter(HTTPAdapter):
-        fixed_timeout = None
-
-        def __init__(self, fixed_timeout):
-            super().__init__()
-            self.fixed_timeout = fixed_timeout
-
-        def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
-            return super().send(request, stream=stream, timeout=self.fixed_timeout, verify=verify, cert=cert, proxies=proxies)
-
     async def start(self):
         self.log.setLevel(10)  # DEBUG
         self.log.info("PLUGIN START")
@@ -187,54 +306,312 @@ class BridgeBot(Plugin):
         await super().start()
         self.config.load_and_update()
 
+        # per-run state, so nothing is inherited from a previous run of the plugin in the same process
+        self.activations = dict()
+        self.talks_receive_message_queues = dict()
+        self.message_propagator_queues = dict()
+        self.message_propagator_tasks = dict()
+        self.message_ids_in_flight = set()
+        self.pending_hints = dict()
+        self.hints_tasks = set()
+        self.room_sequences = dict()
+        self.hints_in_flight = dict()
+        self.shard_membership = None
+        self.shard_heartbeat_task = None
+        self.shard_standby = None
+        self.shard_handoff_since = None
+        self.shard_replay_tasks = set()
+        self.deduplication_snapshot_task = None
+        self.deduplication_snapshot_executor = None
+        self.pending_read_receipts = dict()
+        self.read_receipt_tasks = set()
+        self.durable_store = None
+        self.media_proxy_cache = None
+
         self.MATRIX_BOT_USER = self.config["matrix_bot_user"]
         self.USER_ID_SKIP_LIST = [self.MATRIX_BOT_USER]
-        self.BOT_ON_REGEX = self.config["bot_on_regex"]
-        self.BOT_OFF_REGEX = self.config["bot_off_regex"]
+        self.BOT_ON_REGEX = re.compile(self.config["bot_on_regex"], re.IGNORECASE)
+        self.BOT_OFF_REGEX = re.compile(self.config["bot_off_regex"], re.IGNORECASE)
         self.ROOM_TAGS = self.config["room_tags"]
-        talks_server = self.config["talks_server"]
-        talks_protocol = self.config["talks_protocol"]
-        talks_port = self.config["talks_port"]
-        self.TALKS_BASE_URL = f"{talks_protocol}://{talks_server}:{talks_port}"
+        self.ROOM_TAGS_MATCHER = PatternMatcher([tag_definition["regex"] for tag_definition in self.ROOM_TAGS])
         self.TALKS_API_KEY = self.config["talks_api_key"]
-        talks_receive_message_path = self.config["talks_receive_message"]
-        talks_get_messages_path = self.config["talks_get_messages"]
-        talks_confirm_messages_path = self.config["talks_confirm_messages"]
-        talks_tag_room_path = self.config["talks_tag_room"]
-        self.TALKS_RECEIVE_MESSAGE = f"{self.TALKS_BASE_URL}{talks_receive_message_path}"
         self.TALKS_RECEIVE_MESSAGE_TIMEOUT = self.config["talks_receive_message_timeout"]
-        self.TALKS_GET_MESSAGES = f"{self.TALKS_BASE_URL}{talks_get_messages_path}"
-        self.TALKS_CONFIRM_MESSAGES = f"{self.TALKS_BASE_URL}{talks_confirm_messages_path}"
-        if talks_tag_room_path:
-            self.TALKS_TAG_ROOM = f"{self.TALKS_BASE_URL}{talks_tag_room_path}"
+        self.TALKS_DOUBLE_ENCODED_JSON = self.config["talks_double_encoded_json"]
+        self.TALKS_DELIVERY_MODE = self.DeliveryMode(self.config["talks_delivery_mode"])
+        self.TALKS_LONG_POLL_WAIT = self.config["talks_long_poll_wait"]
+        self.TALKS_MEDIA_STREAMING = self.config["talks_media_streaming"]
+        self.TALKS_MEDIA_PROXY = self.config["talks_media_proxy"]
+        self.MEDIA_CHUNK_SIZE = self.config["media_chunk_size"]
+        self.MEDIA_DOWNLOAD_RETRIES = self.config["media_download_retries"]
+        self.MEDIA_HEADER_SIZE = self.config["media_header_size"]
+        self.SHARD_INSTANCE = self.config["shard_instance"]
+        if self.SHARD_INSTANCE:
+            await self.start_sharding()
         self.hints = self.config["hints"]
+        self.html_render_cache = cachetools.LRUCache(maxsize=self.config["html_render_cache_size"])
         self.forward_bot_messages = self.config["forward_bot_messages"]
         deduplication_cache_size = self.config["deduplication_cache_size"]
-        self.deduplication_cache = cachetools.TTLCache(maxsize=deduplication_cache_size, ttl=600)
+        deduplication_cache_ttl = self.config["deduplication_cache_ttl"]
+        deduplication_cache_path = self.config["deduplication_cache_path"]
+        self.deduplication_cache = DeduplicationIndex(deduplication_cache_size, deduplication_cache_ttl,
+                                                      path=deduplication_cache_path)
+        try:
+            self.log.info("Loaded %s deduplication cache entries", self.deduplication_cache.load())
+        except Exception as e:
+            self.log.error("Can not load deduplication cache from %s: %s", deduplication_cache_path, e)
         echo_cache_size = self.config["echo_cache_size"]
-        self.echo_cache = cachetools.TTLCache(maxsize=echo_cache_size, ttl=5)
-        fixed_timeout = self.config["fixed_timeout"]
-
-        self.session = requests.Session()
-        self.session.mount(self.TALKS_BASE_URL, BridgeBot.TimeoutHTTPAdapter(fixed_timeout))
-        self.task = asyncio.create_task(self.message_fetcher_task())
+        echo_cache_ttl = self.config["echo_cache_ttl"]
+        self.echo_cache = EchoIndex(echo_cache_size, echo_cache_ttl)
+
+        self.create_metrics()
+        self.create_talks_backends()
+        for backend in self.talks_backends.values():
+            await backend.client.start()
+        self.outbound_scheduler = OutboundScheduler(self.config["outbound_room_rate"],
+                                                    self.config["outbound_room_burst"],
+                                                    self.config["outbound_global_rate"],
+                                                    self.config["outbound_global_burst"])
+        self.retry_budget = TokenBucket(self.config["talks_retry_budget_rate"], self.config["talks_retry_budget_burst"],
+                                        time.monotonic())
+        await self.restore_durable_state()
+        for backend in self.talks_backends.values():
+            backend.worker_tasks = [asyncio.create_task(self.talks_receive_message_worker_task(backend))
+                                    for _ in range(backend.receive_message_workers)]
+            backend.fetcher_task = asyncio.create_task(self.message_fetcher_task(backend))
+            backend.confirmer_task = asyncio.create_task(self.message_confirmer_task(backend))
 
         self.media_cache = MediaCache
+        self.media_budget = ByteBudget(self.config["media_inflight_budget"])
+        self.media_inspection_executor = ThreadPoolExecutor(max_workers=self.config["media_inspection_workers"],
+                                                            thread_name_prefix="media_inspection")
+        self.media_upload_cache = MediaUploadCache(self.config["media_upload_cache_size"],
+                                                   self.config["media_upload_cache_path"])
+        try:
+            self.log.info("Loaded %s media upload cache entries", self.media_upload_cache.load())
+        except Exception as e:
+            self.log.error("Can not load media upload cache from %s: %s", self.media_upload_cache.path, e)
+        if self.TALKS_MEDIA_PROXY:
+            self.media_proxy_cache = MediaDiskCache(self.config["media_proxy_cache_path"]
+                                                    or tempfile.mkdtemp(prefix="talks_bridge_media_"),
+                                                    self.config["media_proxy_cache_size"])
+            self.log.info("Found %s media proxy cache files", self.media_proxy_cache.load())
 
         self.running = True
+        if self.shard_membership is not None:
+            self.shard_heartbeat_task = asyncio.create_task(self.shard_heartbeat_loop())
+        if self.deduplication_cache.path and self.config["deduplication_cache_snapshot_interval"] > 0:
+            self.deduplication_snapshot_executor = ThreadPoolExecutor(max_workers=1,
+                                                                      thread_name_prefix="deduplication_snapshot")
+            self.deduplication_snapshot_task = asyncio.create_task(self.deduplication_snapshot_loop())
 
         self.log.info("Task created")
 
     async def stop(self):
         self.running = False
-        await asyncio.wait([self.task])
-        tasks = self.talks_receive_message_tasks.copy().values()
-        self.talks_receive_message_tasks.clear()
-        if len(tasks) > 0:
-            await asyncio.wait(tasks)
+        if self.shard_heartbeat_task is not None:
+            self.shard_heartbeat_task.cancel()
+        if self.deduplication_snapshot_task is not None:
+            self.deduplication_snapshot_task.cancel()
+        for backend in self.talks_backends.values():
+            backend.fetcher_wakeup.set()
+        await asyncio.wait([backend.fetcher_task for backend in self.talks_backends.values()])
+        propagator_tasks = list(self.message_propagator_tasks.values())
+        if len(propagator_tasks) > 0:
+            await asyncio.wait(propagator_tasks)
+        for room_id in list(self.pending_hints):
+            self.send_pending_hints(room_id)
+        if len(self.hints_tasks) > 0:
+            await asyncio.wait(list(self.hints_tasks))
+        for backend in self.talks_backends.values():
+            if backend.confirm_retry_handle is not None:
+                backend.confirm_retry_handle.cancel()
+            backend.confirmations_ready.set()
+        await asyncio.wait([backend.confirmer_task for backend in self.talks_backends.values()])
+        if len(self.shard_replay_tasks) > 0:
+            await asyncio.wait(list(self.shard_replay_tasks))
+        for backend in self.talks_backends.values():
+            for _ in backend.worker_tasks:
+                backend.ready_rooms.put_nowait(None)
+        await asyncio.wait([task for backend in self.talks_backends.values() for task in backend.worker_tasks])
+        for room_id in list(self.pending_read_receipts):
+            self.send_read_receipt(room_id)
+        if len(self.read_receipt_tasks) > 0:
+            await asyncio.wait(list(self.read_receipt_tasks))
+        for backend in self.talks_backends.values():
+            await backend.client.close()
+        if self.durable_store is not None:
+            await self.durable_store.close()
+        self.media_inspection_executor.shutdown(wait=False)
+        if self.deduplication_snapshot_executor is not None:
+            self.deduplication_snapshot_executor.shutdown(wait=False)
+        try:
+            self.log.info("Saved %s media upload cache entries", self.media_upload_cache.save())
+        except Exception as e:
+            self.log.error("Can not save media upload cache to %s: %s", self.media_upload_cache.path, e)
+        if self.media_proxy_cache is not None and not self.config["media_proxy_cache_path"]:
+            shutil.rmtree(self.media_proxy_cache.directory, ignore_errors=True)
+        try:
+            self.log.info("Saved %s deduplication cache entries", self.deduplication_cache.save())
+        except Exception as e:
+            self.log.error("Can not save deduplication cache to %s: %s", self.deduplication_cache.path, e)
         await super().stop()
         self.log.info("PLUGIN STOP")
 
+    def create_metrics(self):
+        """
+        Registers all metrics once, so recording them on the hot paths does not allocate
+        """
+        self.metrics = MetricsRegistry("talks_bridge")
+        retry_delay_buckets = tuple(0.1 * 2 ** i for i in range(1, 15))
+        self.metric_inbound_retries = self.metrics.counter(
+            "inbound_retries_total", "Failed attempts to send a user message to Talks that were retried")
+        self.metric_inbound_retry_delay = self.metrics.histogram(
+            "inbound_retry_delay_seconds", "Backoff delays before retrying to send a user message to Talks",
+            bounds=retry_delay_buckets)
+        self.metric_inbound_discarded = self.metrics.counter(
+            "inbound_discarded_total", "User messages discarded without being sent to Talks")
+        self.metric_media_download_errors = self.metrics.counter(
+            "media_download_errors_total", "Failed homeserver downloads of the media of user messages")
+        self.metric_propagate_send = self.metrics.histogram(
+            "propagate_duration_seconds", "Time spent propagating Talks messages to Matrix, by phase", phase="send")
+        self.metric_propagate_hints = self.metrics.histogram(
+            "propagate_duration_seconds", "Time spent propagating Talks messages to Matrix, by phase", phase="hints")
+        self.metric_propagate_media_upload = self.metrics.histogram(
+            "propagate_duration_seconds", "Time spent propagating Talks messages to Matrix, by phase",
+            phase="media_upload")
+        self.metric_outbound_redelivered = self.metrics.counter(
+            "outbound_redelivered_total", "Talks messages fetched again after being propagated, confirmed again "
+                                          "instead of being sent again")
+        self.metric_outbound_throttle_wait = self.metrics.histogram(
+            "outbound_throttle_wait_seconds", "Time events waited for the outbound rate limits before being sent")
+        self.metric_outbound_rate_limited = self.metrics.counter(
+            "outbound_rate_limited_total", "Events the homeserver rejected because the bot was rate limited")
+        self.metric_media_bytes_to_talks = self.metrics.counter(
+            "media_bytes_total", "Media bytes moved by the bridge, by direction", direction="to_talks")
+        self.metric_media_bytes_to_matrix = self.metrics.counter(
+            "media_bytes_total", "Media bytes moved by the bridge, by direction", direction="to_matrix")
+        self.metric_read_receipts = self.metrics.counter(
+            "read_receipts_total", "Read receipts sent for user messages delivered to Talks")
+        self.metric_media_proxy_hits = self.metrics.counter(
+            "media_proxy_requests_total", "Media proxy requests, by result", result="hit")
+        self.metric_media_proxy_misses = self.metrics.counter(
+            "media_proxy_requests_total", "Media proxy requests, by result", result="miss")
+        self.metric_media_proxy_passthrough = self.metrics.counter(
+            "media_proxy_requests_total", "Media proxy requests, by result", result="passthrough")
+        self.metric_deduplication_hits = self.metrics.counter(
+            "deduplication_cache_lookups_total", "Deduplication cache lookups, by result", result="hit")
+        self.metric_deduplication_misses = self.metrics.counter(
+            "deduplication_cache_lookups_total", "Deduplication cache lookups, by result", result="miss")
+        self.metric_fetch_cycle = self.metrics.histogram(
+            "fetch_cycle_duration_seconds", "Duration of the message fetcher cycles, excluding the wait between them")
+        self.metrics.callback(
+            "echo_cache_lookups_total", "Echo cache lookups, by result", "counter",
+            lambda: (({"result": "hit"}, self.echo_cache.hits), ({"result": "miss"}, self.echo_cache.misses)))
+        self.metrics.callback(
+            "inbound_queue_depth", "User messages waiting to be sent to Talks, per room", "gauge",
+            lambda: (({"room_id": room_id}, len(room_queue.events))
+                     for room_id, room_queue in self.talks_receive_message_queues.items()))
+        self.metrics.callback(
+            "inbound_queue_depth_total", "User messages waiting to be sent to Talks", "gauge",
+            lambda: (({}, sum(len(room_queue.events) for room_queue in self.talks_receive_message_queues.values())),))
+        self.metrics.callback(
+            "talks_backend_healthy", "1 if the Talks backend is healthy, 0 if its calls keep failing", "gauge",
+            lambda: (({"backend": name}, int(backend.healthy)) for name, backend in self.talks_backends.items()))
+        self.metrics.callback(
+            "talks_circuit_opened_total", "Times the circuit breaker of each Talks backend opened", "counter",
+            lambda: (({"backend": name}, backend.breaker.opened) for name, backend in self.talks_backends.items()))
+        self.metrics.callback(
+            "talks_circuit_rejected_total", "Talks calls not made because the circuit breaker was open", "counter",
+            lambda: (({"backend": name}, backend.breaker.rejected) for name, backend in self.talks_backends.items()))
+        self.metrics.callback(
+            "inbound_parked_rooms", "Rooms waiting for the circuit breaker of their Talks backend to close", "gauge",
+            lambda: (({"backend": name}, len(backend.parked_rooms)) for name, backend in self.talks_backends.items()))
+        self.metrics.callback(
+            "outbound_unconfirmed", "Talks messages propagated to Matrix but not confirmed to Talks yet", "gauge",
+            lambda: (({"backend": name}, len(backend.unconfirmed)) for name, backend in self.talks_backends.items()))
+        self.metrics.callback(
+            "outbound_queue_depth_total", "Talks messages waiting to be propagated to Matrix", "gauge",
+            lambda: (({}, sum(len(queue) for queue in self.message_propagator_queues.values())),))
+
+    def create_talks_backends(self):
+        """
+        Creates the default backend from the `talks_*` settings and one more for each `talks_backends` entry,
+        which inherits the `talks_*` settings it does not override, and the router that assigns rooms to them
+        """
+        default_settings = {
+            "server": self.config["talks_server"],
+            "port": self.config["talks_port"],
+            "protocol": self.config["talks_protocol"],
+            "api_key": self.TALKS_API_KEY,
+            "receive_message": self.config["talks_receive_message"],
+            "receive_message_batch": self.config["talks_receive_message_batch"],
+            "receive_message_batch_size": self.config["talks_receive_message_batch_size"],
+            "receive_message_batch_linger": self.config["talks_receive_message_batch_linger"],
+            "receive_message_workers": self.config["talks_receive_message_workers"],
+            "get_messages": self.config["talks_get_messages"],
+            "confirm_messages": self.config["talks_confirm_messages"],
+            "tag_room": self.config["talks_tag_room"],
+            "pool_size": self.config["talks_pool_size"],
+            "fixed_timeout": self.config["fixed_timeout"],
+            "timeouts": self.config["talks_timeouts"],
+            "concurrency": self.config["talks_concurrency"],
+            "unhealthy_after": self.config["talks_unhealthy_after"],
+            "circuit_open_timeout": self.config["talks_circuit_open_timeout"],
+            "circuit_max_open_timeout": self.config["talks_circuit_max_open_timeout"],
+        }
+        self.talks_backends = {"default": TalksBackend("default", default_settings, self.metrics)}
+        for backend_config in self.config["talks_backends"] or ():
+            name = backend_config["name"]
+            settings = {**default_settings, **{key: value for key, value in backend_config.items() if key != "name"}}
+            self.talks_backends[name] = TalksBackend(name, settings, self.metrics)
+
+        self.room_router = RoomRouter(self.config["talks_routes"] or (), "default")
+        unknown_backends = self.room_router.backends() - set(self.talks_backends)
+        if len(unknown_backends) > 0:
+            raise ValueError(f"talks_routes use undefined backends: {', '.join(sorted(unknown_backends))}")
+        for backend in self.talks_backends.values():
+            backend.fetcher_delay = self.config["message_fetcher_delay"]
+            backend.breaker.on_close = lambda backend=backend: self.drain_parked_rooms(backend)
+            self.log.info("Talks backend %s at %s", backend.name, backend.base_url)
+
+    def backend_for_room(self, room_id) -> TalksBackend:
+        return self.talks_backends[self.room_router.route(room_id)]
+
+    async def restore_durable_state(self):
+        """
+        Opens the durable store, if configured, and resumes the state left by the previous run: the rooms routed
+        by a tag are routed again, inbound messages are enqueued again in arrival order, and propagated but
+        unconfirmed Talks messages are confirmed instead of being propagated again
+        """
+        durable_queue_path = self.config["durable_queue_path"]
+        if not durable_queue_path:
+            return
+
+        self.durable_store = DurableStore(durable_queue_path, self.config["durable_queue_commit_interval"], self.log)
+        await self.durable_store.start()
+        self.room_router.restore(await self.durable_store.load_room_routes())
+        inbound, outbound = await self.durable_store.load()
+
+        for seq, room_id, serialized_event, body in inbound:
+            try:
+                evt = MessageEvent(MatrixMessageEvent.deserialize(json.loads(serialized_event)), self.client)
+                self.talks_receive_message_enqueue(evt, body, seq=seq)
+            except Exception as e:
+                self.log.error("Can not restore inbound message %s in room %s, discarded: %s", seq, room_id, e)
+                self.durable_store.remove_inbound(seq)
+
+        for talks_id, event_id, mxc_uri, backend_name in outbound:
+            backend = self.talks_backends.get(backend_name or "default")
+            if backend is None:
+                self.log.error("Can not confirm message %s of removed backend %s, discarded", talks_id, backend_name)
+                self.durable_store.remove_outbound(talks_id)
+                continue
+            self.message_ids_in_flight.add((backend.name, talks_id))
+            self.confirm_message(backend, (talks_id, event_id, mxc_uri))
+
+        self.log.info("Restored %s tagged rooms, %s inbound and %s unconfirmed outbound messages from %s",
+                      len(self.room_router.tagged), len(inbound), len(outbound), durable_queue_path)
+
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
         return Config
@@ -251,13 +628,26 @@ class BridgeBot(Plugin):
 
     @staticmethod
     def html_format(text: str):
+        """
+        Turns new lines into `<br/>`, except the ones between the first `<pre>` and the last `</pre>`
+        """
         text = text.replace("\n", "<br/>")
-        changed = True
-        while changed:
-            new_text = re.sub(r'(?<=<pre>)(.*)<br/>(.*)(?=</pre>)', r'\1\n\2', text, flags=re.DOTALL)
-            changed = text != new_text
-            text = new_text
-        return text
+        pre_start = text.find("<pre>")
+        pre_end = text.rfind("</pre>")
+        if pre_start < 0 or pre_end < pre_start + len("<pre>"):
+            return text
+        pre_start += len("<pre>")
+        return text[:pre_start] + text[pre_start:pre_end].replace("<br/>", "\n") + text[pre_end:]
+
+    async def render_html(self, text: str):
+        """
+        :return: the `(body, formatted_body)` pair of an HTML text, rendered once per distinct text
+        """
+        rendered = self.html_render_cache.get(text)
+        if rendered is None:
+            rendered = await parse_formatted(self.html_format(text), render_markdown=False, allow_html=True)
+            self.html_render_cache[text] = rendered
+        return rendered
 
     @staticmethod
     def text_format(text: str):
@@ -272,10 +662,16 @@ class BridgeBot(Plugin):
         :return:
         """
 
-        if not await self.check_on_off(evt):
+        if not self.handles_room(evt.room_id):
+            self.keep_shard_standby(evt)
             return
 
-        await self.check_room_tags(evt)
+        echo = evt.sender == self.MATRIX_BOT_USER and self.event_is_echo(evt)
+
+        if not await self.check_on_off(evt, echo):
+            return
+
+        await self.check_room_tags(evt, echo)
 
         sender_id = evt.sender
         event_id = evt.event_id
@@ -288,16 +684,212 @@ class BridgeBot(Plugin):
 
         await self.receive_message(evt, None)
 
-    async def check_on_off(self, evt):
+    def owns_room(self, room_id) -> bool:
+        """
+        With sharding, every instance receives all the events but only handles the rooms it owns among the live
+        instances
+        """
+        return self.shard_membership is None or self.shard_membership.ring.owner(room_id) == self.SHARD_INSTANCE
+
+    def handles_room(self, room_id) -> bool:
+        """
+        Until the handoff, the previous owners of the rooms of a starting instance may still handle their events, so
+        it keeps them in standby
+        """
+        return self.owns_room(room_id) and (self.shard_membership is None or self.shard_handoff_since is not None)
+
+    def shard_params(self):
+        """
+        :return: the query parameters telling Talks which instance calls and which live instances share the rooms
+        """
+        if self.shard_membership is None:
+            return None
+        return {"shard": self.SHARD_INSTANCE, "shards": ",".join(self.shard_membership.alive)}
+
+    async def deduplication_snapshot_loop(self):
+        """
+        Saves the deduplication cache every `deduplication_cache_snapshot_interval` seconds, so a crash loses at most
+        the event IDs of the last interval. The buckets are copied on the event loop and written by a dedicated
+        thread, so a large snapshot does not hold up the media inspection workers
+        """
+        interval = self.config["deduplication_cache_snapshot_interval"]
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            snapshot = self.deduplication_cache.snapshot()
+            try:
+                await loop.run_in_executor(self.deduplication_snapshot_executor, self.deduplication_cache.save,
+                                           snapshot)
+            except Exception as e:
+                self.log.error("Can not save deduplication cache to %s: %s", self.deduplication_cache.path, e)
+
+    async def start_sharding(self):
+        """
+        Reads the heartbeats of the other instances and refuses to start if a live one is configured with another
+        `shard_instances` list, since the two rings would leave some rooms to no instance
+        """
+        shard_instances = self.config["shard_instances"]
+        if self.SHARD_INSTANCE not in shard_instances:
+            raise ValueError(f"shard_instance {self.SHARD_INSTANCE} is not in shard_instances")
+        if self.config["shard_lease_timeout"] <= 2 * self.config["shard_heartbeat_interval"]:
+            raise ValueError("shard_lease_timeout must be more than twice shard_heartbeat_interval, the time the "
+                             "running instances take to see a starting one and tell it")
+        self.shard_membership = ShardMembership(self.SHARD_INSTANCE, shard_instances,
+                                                self.config["shard_lease_timeout"], time.time())
+        self.shard_standby = deque(maxlen=self.config["shard_standby_size"])
+        heartbeats = await self.read_shard_heartbeats()
+        mismatched = self.shard_membership.mismatched(heartbeats, time.time())
+        if len(mismatched) > 0:
+            raise ValueError(f"shard_instances {self.shard_membership.instances} differs from the one of the running "
+                             f"instances {mismatched}: stop all the instances to change it")
+        self.shard_membership.update(heartbeats, time.time())
+        await self.write_shard_heartbeat()
+        self.check_shard_handoff()
+
+    async def write_shard_heartbeat(self):
+        membership = self.shard_membership
+        await self.client.set_account_data(f"{self.SHARD_ACCOUNT_DATA_PREFIX}{self.SHARD_INSTANCE}",
+                                           {"heartbeat": time.time(), "instances": membership.instances,
+                                            "alive": membership.alive, "alive_since": membership.alive_since})
+
+    async def read_shard_heartbeats(self) -> dict:
+        """
+        :return: the last heartbeat time, the instance list and the live instances seen by each other configured
+            instance that ever started, read from the global account data of the bot user, shared by all the instances
+        """
+        heartbeats = dict()
+        for instance in self.shard_membership.instances:
+            if instance == self.SHARD_INSTANCE:
+                continue
+            try:
+                data = await self.client.get_account_data(f"{self.SHARD_ACCOUNT_DATA_PREFIX}{instance}")
+            except MatrixRequestError as e:
+                if e.http_status != 404:
+                    raise
+                continue
+            heartbeats[instance] = (data["heartbeat"], data["instances"], data.get("alive"), data.get("alive_since"))
+        return heartbeats
+
+    async def shard_heartbeat_loop(self):
+        """
+        Publishes the heartbeat of this instance every `shard_heartbeat_interval` seconds and updates the live
+        instances from the heartbeats of the others. A change of the live instances is published right away, so a
+        starting instance learns without delay that the others stopped handling its rooms
+        """
+        interval = self.config["shard_heartbeat_interval"]
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.write_shard_heartbeat()
+                heartbeats = await self.read_shard_heartbeats()
+                if self.update_shard_membership(heartbeats):
+                    await self.write_shard_heartbeat()
+            except Exception as e:
+                self.log.error("Can not exchange shard heartbeats: %s", e)
+            self.check_shard_handoff()
+
+    def update_shard_membership(self, heartbeats) -> bool:
+        """
+        :return: True if the live instances changed
+        """
+        now = time.time()
+        mismatched = self.shard_membership.mismatched(heartbeats, now)
+        if len(mismatched) > 0:
+            self.log.error("Instances %s run with another shard_instances list, some rooms are handled by none of them",
+                           mismatched)
+        previous_ring = self.shard_membership.ring
+        joined, left = self.shard_membership.update(heartbeats, now)
+        if len(joined) == 0 and len(left) == 0:
+            return False
+        self.log.warning("Shard instances alive: %s (joined: %s, left: %s)", self.shard_membership.alive, joined, left)
+        self.notify_message_fetcher()
+        if len(left) > 0:
+            self.replay_shard_standby(previous_ring, left)
+        return True
+
+    def check_shard_handoff(self):
+        """
+        Completes the handoff of a starting instance once every live instance counts it alive, handling the standby
+        events of its rooms received since, which no instance handled. An instance that still does not count it alive
+        after `shard_lease_timeout` seconds is not waited for any longer
+        """
+        if self.shard_handoff_since is not None:
+            return
+        now = time.time()
+        since = self.shard_membership.handed_off_since(now)
+        if since is None:
+            if now - self.shard_membership.started < self.config["shard_lease_timeout"]:
+                return
+            self.log.warning("Some live shard instances do not count %s alive yet, taking over its rooms anyway",
+                             self.SHARD_INSTANCE)
+            since = now
+        self.shard_handoff_since = since
+        self.log.info("Shard %s of %s: rooms handed off", self.SHARD_INSTANCE, self.shard_membership.alive)
+        self.replay_standby(lambda received_at, evt: received_at >= since and self.owns_room(evt.room_id),
+                            "of this instance received during the handoff")
+        self.notify_message_fetcher()
+
+    def keep_shard_standby(self, evt):
+        """
+        Keeps the recent events of the rooms of other instances, to be handled here if their owner stops before
+        handling them
+        """
+        now = time.time()
+        window = self.config["shard_lease_timeout"] + self.config["shard_heartbeat_interval"]
+        while len(self.shard_standby) > 0 and self.shard_standby[0][0] < now - window:
+            self.shard_standby.popleft()
+        self.shard_standby.append((now, evt))
+
+    def replay_shard_standby(self, previous_ring, left):
+        """
+        Handles again the standby events of the rooms taken over from the instances that left, received since
+        one heartbeat interval before their last heartbeat, as those may never have been handled
+        """
+        interval = self.config["shard_heartbeat_interval"]
+        since = {instance: (self.shard_membership.last_heartbeat(instance) or -math.inf) - interval
+                 for instance in left}
+
+        def taken_over(received_at, evt):
+            previous_owner = previous_ring.owner(evt.room_id)
+            return previous_owner in since and received_at >= since[previous_owner] and self.owns_room(evt.room_id)
+
+        self.replay_standby(taken_over, f"taken over from {left}")
+
+    def replay_standby(self, selected, origin):
+        """
+        Handles the standby events for which `selected(received_at, evt)` is true, keeping the others
+        """
+        standby = self.shard_standby
+        self.shard_standby = deque(maxlen=standby.maxlen)
+        replayed = list()
+        for received_at, evt in standby:
+            if selected(received_at, evt):
+                replayed.append(evt)
+            else:
+                self.shard_standby.append((received_at, evt))
+        if len(replayed) > 0:
+            self.log.warning("Handling %s events of rooms %s", len(replayed), origin)
+            task = asyncio.create_task(self.handle_events(replayed))
+            self.shard_replay_tasks.add(task)
+            task.add_done_callback(self.shard_replay_tasks.discard)
+
+    async def handle_events(self, events):
+        for evt in events:
+            try:
+                await self.handle_custom_event(evt)
+            except Exception as e:
+                self.log.error("Can not handle event %s: %s", evt.event_id, e)
+
+    async def check_on_off(self, evt, echo):
         sender_id = evt.sender
         body = evt.content.body
         room_id = evt.room_id
 
-        if sender_id == self.MATRIX_BOT_USER and not self.event_is_echo(evt):
-            if re.match(self.BOT_OFF_REGEX, body, re.IGNORECASE) is not None:
+        if sender_id == self.MATRIX_BOT_USER and not echo:
+            if self.BOT_OFF_REGEX.match(body) is not None:
                 self.log.info("BOT OFF in room %s", room_id)
                 self.activations[room_id] = False
-            elif re.match(self.BOT_ON_REGEX, body, re.IGNORECASE) is not None:
+            elif self.BOT_ON_REGEX.match(body) is not None:
                 self.log.info("BOT ON in room %s", room_id)
                 self.activations[room_id] = True
 
@@ -306,43 +898,49 @@ class BridgeBot(Plugin):
         else:
             return True
 
-    async def check_room_tags(self, evt):
-        if not self.TALKS_TAG_ROOM:
+    async def check_room_tags(self, evt, echo):
+        backend = self.backend_for_room(evt.room_id)
+        if not backend.tag_room_url and len(self.room_router.tag_routes) == 0:
             return
 
         sender_id = evt.sender
         body = evt.content.body
         room_id = evt.room_id
 
-        if sender_id == self.MATRIX_BOT_USER and not self.event_is_echo(evt):
-            for tag_definition in self.ROOM_TAGS:
-                regex = tag_definition["regex"]
+        if sender_id == self.MATRIX_BOT_USER and not echo:
+            tag_index = self.ROOM_TAGS_MATCHER.match(body)
+            if tag_index is not None:
+                tag_definition = self.ROOM_TAGS[tag_index]
                 tag = tag_definition["tag"]
                 value = tag_definition["value"]
                 trigger = tag_definition["trigger"]
 
-                if re.match(regex, body, re.IGNORECASE) is not None:
-                    await self.tag_room(room_id, tag, value)
-                    if trigger is not None:
-                        await self.receive_message(evt, trigger)
-                    return
-
-    async def tag_room(self, room_id, tag, value):
+                if backend.tag_room_url:
+                    await self.tag_room(backend, room_id, tag, value)
+                tagged = self.room_router.tagged.get(room_id)
+                if self.room_router.tag(room_id, tag, value):
+                    self.log.info("Room %s routed from Talks backend %s to %s by tag %s=%s", room_id, backend.name,
+                                  self.backend_for_room(room_id).name, tag, value)
+                if self.durable_store is not None and self.room_router.tagged.get(room_id) != tagged:
+                    self.durable_store.set_room_route(room_id, self.room_router.tagged[room_id])
+                if trigger is not None:
+                    await self.receive_message(evt, trigger)
+
+    async def tag_room(self, backend, room_id, tag, value):
         self.log.info("setting tag %s=%s for room %s", tag, value, room_id)
         talks_tag_room_request = self.build_talks_tag_room_request(room_id, tag, value)
-        talks_tag_room_request_json = jsonpickle.encode(talks_tag_room_request, unpicklable=False)
 
         try:
-            r = await self.post(self.TALKS_TAG_ROOM, talks_tag_room_request_json)
+            r = await self.post(backend, backend.tag_room_url, talks_tag_room_request)
             if 400 <= r.status_code < 500:
                 self.log.warning(f"talks_tag_room: status_code={r.status_code} for room_id={room_id}, tag={tag}, value={value}")
             elif r.status_code != 200:
                 raise BridgeException(f"status={r.status_code} description={r.json()['description']}")
 
         except BridgeException as e:
-            self.log.error("%s: room tag unsuccessful: %s", self.TALKS_TAG_ROOM, e.message)
+            self.log.error("%s: room tag unsuccessful: %s", backend.tag_room_url, e.message)
         except Exception as e:
-            self.log.error("Can not access %s: %s", self.TALKS_TAG_ROOM, e)
+            self.log.error("Can not access %s: %s", backend.tag_room_url, e)
 
     @staticmethod
     def build_talks_tag_room_request(room_id, tag, value):
@@ -351,140 +949,332 @@ class BridgeBot(Plugin):
     async def receive_message(self, evt, body):
         self.talks_receive_message_enqueue(evt, body)
 
-    def talks_receive_message_enqueue(self, evt, body):
+    def talks_receive_message_enqueue(self, evt, body, seq=None):
         room_id = evt.room_id
-        queue = self.get_talks_receive_message_queue(room_id)
-        queue.appendleft([evt, body])
-
-    def get_talks_receive_message_queue(self, room_id):
-        if room_id not in self.talks_receive_message_queues:
-            self.talks_receive_message_queues[room_id] = deque()
-            self.create_talks_receive_message_task(room_id)
-        return self.talks_receive_message_queues[room_id]
-
-    def create_talks_receive_message_task(self, room_id):
-        if room_id not in self.talks_receive_message_tasks:
-            task = asyncio.create_task(self.talks_receive_message_per_room_task(room_id))
-            self.talks_receive_message_tasks[room_id] = task
-
-    async def talks_receive_message_per_room_task(self, room_id):
-        while room_id in self.talks_receive_message_tasks:
-            if room_id in self.talks_receive_message_queues:
-                queue = self.get_talks_receive_message_queue(room_id)
-                if len(queue) > 0:
-                    evt, body = queue[-1]
-                    sent = False
-                    i = 0
-                    delay = 0.1 * 2 ** i
-                    while room_id in self.talks_receive_message_tasks and delay <= self.TALKS_RECEIVE_MESSAGE_TIMEOUT:
-                        try:
-                            await self.do_receive_message(evt, body)
-                            queue.pop()
-                            sent = True
-                            break
-                        except BridgeException as e:
-                            i = i + 1
-                            delay = 0.1 * 2 ** i
-                            self.log.warning("%s: message %s failed Talks sending, will retry in %s seconds: %s", self.TALKS_RECEIVE_MESSAGE, evt.event_id, delay, e.message)
-                            await asyncio.sleep(delay)
-                    if not sent:
-                        self.log.error("%s: message %s failed Talks sending and discarded after exceeding %s seconds",self.TALKS_RECEIVE_MESSAGE, evt.event_id, self.TALKS_RECEIVE_MESSAGE_TIMEOUT)
+        if self.durable_store is not None and seq is None:
+            seq = self.durable_store.add_inbound(room_id, json.dumps(evt.serialize()), body)
+        room_queue = self.talks_receive_message_queues.get(room_id)
+        if room_queue is None:
+            room_queue = self.talks_receive_message_queues[room_id] = InboundRoomQueue()
+            room_queue.events.append([evt, body, seq])
+            self.backend_for_room(room_id).ready_rooms.put_nowait(room_id)
+        else:
+            # the room is already scheduled, being served or waiting for a retry
+            room_queue.events.append([evt, body, seq])
+
+    def talks_receive_message_dequeue(self, room_queue):
+        _, _, seq = room_queue.events.popleft()
+        room_queue.retries = 0
+        if seq is not None:
+            self.durable_store.remove_inbound(seq)
+
+    def talks_receive_message_dequeue_delivered(self, room_queue, entries, errors):
+        """
+        Removes the events of a batch that do not have to be sent again from the front of the room queue,
+        keeping the failed ones there in order
+        """
+        for _ in entries:
+            room_queue.events.popleft()
+        room_queue.events.extendleft(reversed([entry for entry, error in zip(entries, errors) if error is not None]))
+        for (_, _, seq), error in zip(entries, errors):
+            if error is None and seq is not None:
+                self.durable_store.remove_inbound(seq)
+        if all(error is None for error in errors):
+            room_queue.retries = 0
+
+    def batchable_entries(self, backend, room_queue):
+        """
+        :return: the first queued events of the room that can be sent together in one batched call, in order,
+            none if the backend does not batch or the first event must be sent on its own, e.g. media sent inline
+        """
+        if backend.batcher is None:
+            return []
+        entries = list()
+        for entry in room_queue.events:
+            if len(entries) >= backend.batcher.max_size or self.get_media_size(entry[0]) is not None:
+                break
+            entries.append(entry)
+        return entries
+
+    def schedule_talks_receive_message_room(self, room_id):
+        """
+        Hands the room back to the workers of its backend if it has pending events, otherwise reclaims its queue.
+        A room is in a ready queue, served by a worker or waiting for a retry, never more than one at once
+        """
+        room_queue = self.talks_receive_message_queues[room_id]
+        if len(room_queue.events) > 0:
+            self.backend_for_room(room_id).ready_rooms.put_nowait(room_id)
+        else:
+            del self.talks_receive_message_queues[room_id]
+
+    async def talks_receive_message_worker_task(self, backend):
+        """
+        One of the `talks_receive_message_workers` tasks of a backend that send user messages to Talks.
+        Each backend has its own ready queue and workers, so a slow backend does not hold the workers of the others.
+        Serves one event of a ready room at a time, or with batching all its queued events up to the batch size,
+        so rooms are served round-robin and in FIFO order within a room.
+        Retries are scheduled with a timer instead of keeping the worker busy, no sooner than the shared retry budget
+        allows. While the circuit breaker of the room backend is open, the room is parked until it closes
+        """
+        loop = asyncio.get_running_loop()
+
+        while True:
+            room_id = await backend.ready_rooms.get()
+            if room_id is None:
+                break
+
+            room_backend = self.backend_for_room(room_id)
+            if room_backend is not backend:
+                # the room was routed to another backend since it was scheduled
+                room_backend.ready_rooms.put_nowait(room_id)
+                continue
+            room_queue = self.talks_receive_message_queues[room_id]
+            evt, body, _ = room_queue.events[0]
+            entries = self.batchable_entries(backend, room_queue)
+            try:
+                if len(entries) > 0:
+                    errors = await self.do_receive_message_batch(backend, entries)
+                    self.talks_receive_message_dequeue_delivered(room_queue, entries, errors)
+                    failures = [error for error in errors if error is not None]
+                    if len(failures) > 0:
+                        # retried from the first failed event, which is now at the front of the queue
+                        evt = room_queue.events[0][0]
+                        raise failures[0]
                 else:
-                    del self.talks_receive_message_queues[room_id]
-                    del self.talks_receive_message_tasks[room_id]
-            await asyncio.sleep(0.1)
+                    await self.do_receive_message(backend, evt, body)
+                    self.talks_receive_message_dequeue(room_queue)
+            except CircuitOpenError:
+                backend.parked_rooms.append(room_id)
+                continue
+            except MediaDownloadError as e:
+                # a homeserver failure, neither counted against the Talks backend nor retried as a Talks error
+                self.metric_media_download_errors.inc()
+                room_queue.retries += 1
+                delay = 0.1 * 2 ** room_queue.retries
+                if not e.permanent and room_queue.retries <= self.MEDIA_DOWNLOAD_RETRIES:
+                    self.log.warning("Can not download the media of message %s, will retry in %s seconds: %s",
+                                     evt.event_id, delay, e.message)
+                    loop.call_later(delay, self.schedule_talks_receive_message_room, room_id)
+                    continue
+                self.log.error("Can not download the media of message %s, discarded: %s", evt.event_id, e.message)
+                self.metric_inbound_discarded.inc()
+                self.talks_receive_message_dequeue(room_queue)
+            except BridgeException as e:
+                room_queue.retries += 1
+                delay = 0.1 * 2 ** room_queue.retries
+                if delay <= self.TALKS_RECEIVE_MESSAGE_TIMEOUT:
+                    delay = max(delay, self.retry_budget.delay(time.monotonic()))
+                    self.retry_budget.take()
+                    self.metric_inbound_retries.inc()
+                    self.metric_inbound_retry_delay.observe(delay)
+                    self.log.warning("%s: message %s failed Talks sending, will retry in %s seconds: %s", backend.receive_message_url, evt.event_id, delay, e.message)
+                    loop.call_later(delay, self.schedule_talks_receive_message_room, room_id)
+                    continue
+                self.log.error("%s: message %s failed Talks sending and discarded after exceeding %s seconds", backend.receive_message_url, evt.event_id, self.TALKS_RECEIVE_MESSAGE_TIMEOUT)
+                self.metric_inbound_discarded.inc()
+                self.talks_receive_message_dequeue(room_queue)
+            except Exception as e:
+                self.log.error("%s: message %s discarded: [%s] %s", backend.receive_message_url, evt.event_id, e.__class__.__name__, e)
+                self.metric_inbound_discarded.inc()
+                self.talks_receive_message_dequeue(room_queue)
 
-    async def do_receive_message(self, evt, body):
-        from requests import exceptions as requests_exceptions
-        from urllib3 import exceptions as urllib3_exceptions
+            self.schedule_talks_receive_message_room(room_id)
+
+    async def do_receive_message(self, backend, evt, body):
+        """
+        Messages for an unhealthy backend fail right away with `CircuitOpenError`, so they do not hold
+        the workers of the backend while its rooms are parked
+        """
         event_id = evt.event_id
-        talks_receive_message_request = await self.build_talks_receive_message_request(evt, body)
-        if talks_receive_message_request is None:
-            return
-        talks_receive_message_request_json = jsonpickle.encode(talks_receive_message_request, unpicklable=False)
-        # self.log.debug("ReceiveMessage request: %s", talks_receive_message_request_json)
+        if not backend.healthy:
+            raise CircuitOpenError(f"Talks backend {backend.name} is unhealthy")
+        media_size = self.get_media_size(evt)
         try:
-            r = await self.post(self.TALKS_RECEIVE_MESSAGE, talks_receive_message_request_json)
-            if 400 <= r.status_code < 500:
-                self.log.warning(f"talks_receive_message: status_code={r.status_code} for event_id={event_id}")
-            elif r.status_code != 200:
-                raise BridgeException(f"status={r.status_code} description={r.json()['description']}")
-
-            await evt.mark_read()
-            # self.log.debug("ReceiveMessage response: %s", r.text)
+            if media_size is None:
+                r = await self.post_receive_message(backend, evt, body)
+            else:
+                async with self.media_budget.reserve(media_size):
+                    r = await self.post_receive_message(backend, evt, body)
+            if r is None:
+                return
+            self.handle_receive_message_response(backend, evt, r)
 
-        except BridgeException as e:
+        except (BridgeException, CircuitOpenError, MediaDownloadError) as e:
             raise e
         except ConnectionError as e:
             raise BridgeException("ConnectionError")
-        except requests_exceptions.ConnectionError as e:
-            raise BridgeException("requests::ConnectionError")
-        except urllib3_exceptions.ConnectionError as e:
-            raise BridgeException(f"urllib3::{e.message}")
-        except NewConnectionError as e:
-            raise BridgeException("NewConnectionError")
+        except aiohttp.ClientConnectionError as e:
+            raise BridgeException(f"aiohttp::{e.__class__.__name__}")
+        except asyncio.TimeoutError:
+            raise BridgeException("TimeoutError")
         except Exception as e:
-            self.log.error("Can not access %s, message %s discarded: [%s] %s", self.TALKS_RECEIVE_MESSAGE, event_id, e.__class__.__name__, e)
+            self.log.error("Can not access %s, message %s discarded: [%s] %s", backend.receive_message_url, event_id, e.__class__.__name__, e)
+            self.metric_inbound_discarded.inc()
 
-    def event_is_echo(self, evt: MessageEvent) -> bool:
-        echoed = False
-        sender_id = evt.sender
-        body = self.get_evt_cache_body(evt)
+    def handle_receive_message_response(self, backend, evt, r):
+        if 400 <= r.status_code < 500:
+            self.log.warning(f"talks_receive_message: status_code={r.status_code} for event_id={evt.event_id}")
+        elif r.status_code != 200:
+            raise BridgeException(f"status={r.status_code} description={r.json()['description']}")
 
-        if body is None:
-            return False
+        backend.metric_messages_to_talks.inc()
+        self.notify_message_fetcher(backend)
+        self.schedule_read_receipt(evt)
+        # self.log.debug("ReceiveMessage response: %s", r.text)
 
-        body_hash = hash(body)
-
-        if sender_id == self.MATRIX_BOT_USER:
+    async def do_receive_message_batch(self, backend, entries):
+        """
+        Sends queued events of a room in one batched call, in order
+        :return: for each event, None if it does not have to be sent again, or the `BridgeException` to retry it
+        """
+        if not backend.healthy:
+            raise CircuitOpenError(f"Talks backend {backend.name} is unhealthy")
+        requests = list()
+        for evt, body, _ in entries:
+            try:
+                requests.append(await self.build_talks_receive_message_request(evt, body))
+            except Exception as e:
+                self.log.error("Can not build the Talks request of message %s, discarded: [%s] %s", evt.event_id, e.__class__.__name__, e)
+                self.metric_inbound_discarded.inc()
+                requests.append(None)
+        items = [request.to_json() for request in requests if request is not None]
+        if len(items) == 0:
+            return [None] * len(entries)
+        try:
+            responses = iter(await backend.batcher.submit_many(items))
+        except CircuitOpenError as e:
+            raise e
+        except (ConnectionError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            error = BridgeException(f"{e.__class__.__name__}")
+            return [error if request is not None else None for request in requests]
+        except Exception as e:
+            self.log.error("Can not access %s, %s messages discarded: [%s] %s", backend.receive_message_batch_url, len(items), e.__class__.__name__, e)
+            self.metric_inbound_discarded.inc(len(items))
+            return [None] * len(entries)
+
+        errors = list()
+        for (evt, _, _), request in zip(entries, requests):
+            error = None
+            if request is not None:
+                try:
+                    self.handle_receive_message_response(backend, evt, next(responses))
+                except BridgeException as e:
+                    error = e
+                except Exception as e:
+                    self.log.error("Invalid Talks response for message %s, discarded: [%s] %s", evt.event_id, e.__class__.__name__, e)
+                    self.metric_inbound_discarded.inc()
+            errors.append(error)
+        return errors
 
-            self.echo_cache_lock.acquire()
+    def drain_parked_rooms(self, backend):
+        """
+        Called when the circuit breaker of a backend closes. Hands its parked rooms back to the workers in random
+        order, at most `talks_drain_rate` rooms per second with jitter, so the recovering backend is not hit by
+        all of them at once
+        """
+        rooms = backend.parked_rooms
+        backend.parked_rooms = list()
+        if len(rooms) == 0:
+            return
+        self.log.info("Talks backend %s recovered, releasing %s parked rooms", backend.name, len(rooms))
+        random.shuffle(rooms)
+        loop = asyncio.get_running_loop()
+        interval = 1.0 / self.config["talks_drain_rate"]
+        for i, room_id in enumerate(rooms):
+            loop.call_later((i + random.random()) * interval, self.schedule_talks_receive_message_room, room_id)
+
+    async def post_receive_message(self, backend, evt, body):
+        talks_receive_message_request = await self.build_talks_receive_message_request(evt, body)
+        if talks_receive_message_request is None:
+            return None
 
-            if self.echo_cache.get(body_hash) is not None:
-                # self.log.debug("echo cache hit for %s", body)
-                echoed = True
+        streamed = self.TALKS_MEDIA_STREAMING and not self.TALKS_MEDIA_PROXY
+        if streamed and talks_receive_message_request.mxcUri is not None:
+            fields = talks_receive_message_request.to_dict()
+            del fields["bytes"]
+            # the download is started and checked before the Talks call, so its errors are not taken for Talks ones
+            async with await self.open_media_download(talks_receive_message_request.mxcUri) as media:
+                chunks = self.media_response_chunks(media)
+                try:
+                    return await backend.client.post_data(
+                        backend.receive_message_url,
+                        streamed_json_body(fields, "bytes", chunks, double_encoded=self.TALKS_DOUBLE_ENCODED_JSON))
+                except RequestBodyError as e:
+                    raise MediaDownloadError(f"{talks_receive_message_request.mxcUri}: "
+                                             f"[{e.__cause__.__class__.__name__}] {e.__cause__}")
 
-            self.echo_cache_lock.release()
+        return await self.post(backend, backend.receive_message_url, talks_receive_message_request)
 
-        else:
-            self.cache_body(body, body_hash)
+    def schedule_read_receipt(self, evt):
+        """
+        Coalesces the read receipts of a room: the first message delivered to Talks starts an event loop timer of
+        `read_receipt_delay` seconds, and only the newest message delivered meanwhile is marked as read when it fires,
+        so bursts cost a single receipt and the inbound worker does not wait for the homeserver
+        """
+        pending = self.pending_read_receipts.get(evt.room_id)
+        if pending is not None:
+            self.pending_read_receipts[evt.room_id] = (pending[0], evt)
+            return
+        handle = asyncio.get_running_loop().call_later(self.config["read_receipt_delay"],
+                                                       self.send_read_receipt, evt.room_id)
+        self.pending_read_receipts[evt.room_id] = (handle, evt)
 
-        return echoed
+    def send_read_receipt(self, room_id):
+        pending = self.pending_read_receipts.pop(room_id, None)
+        if pending is None:
+            return
+        handle, evt = pending
+        handle.cancel()
+        task = asyncio.create_task(self.mark_read(evt))
+        self.read_receipt_tasks.add(task)
+        task.add_done_callback(self.read_receipt_tasks.discard)
 
-    def get_evt_cache_body(self, evt: Event):
-        if evt is MessageEvent:
-            return evt.content.body
-        elif evt is RedactionEvent:
-            return evt.content
-        else:
-            return evt.content.body if hasattr(evt, "content") and hasattr(evt.content, "body") else None
+    async def mark_read(self, evt):
+        try:
+            await evt.mark_read()
+            self.metric_read_receipts.inc()
+        except Exception as e:
+            self.log.warning("Can not mark event %s as read in room %s: %s", evt.event_id, evt.room_id, e)
 
-    def cache_body(self, body, url=None, body_hash=None):
-        if body_hash is None:
-            body_hash = hash(body)
-        if url is not None:
-            body_hash = f"url::body_hash"
+    def get_media_size(self, evt) -> Optional[int]:
+        """
+        :return: the bytes to reserve from the media budget while the event is sent to Talks, None for non-media events
+        """
+        if evt.content.msgtype not in (MessageType.IMAGE, MessageType.VIDEO, MessageType.AUDIO, MessageType.FILE):
+            return None
+        if self.TALKS_MEDIA_PROXY:
+            return None
+        if self.TALKS_MEDIA_STREAMING:
+            return self.MEDIA_CHUNK_SIZE
+        size = evt.content.info.size if hasattr(evt.content.info, "size") else None
+        return size or self.MEDIA_CHUNK_SIZE
 
-        self.echo_cache_lock.acquire()
+    def event_is_echo(self, evt: MessageEvent) -> bool:
+        """
+        Tells whether a message of the bot user was sent by the bridge, matching one of the registrations
+        made by `cache_body`. Call it once per event, since a match consumes the registration
+        """
+        body = self.get_evt_cache_body(evt)
 
-        self.echo_cache[body_hash] = True
+        if body is None:
+            return False
 
-        self.echo_cache_lock.release()
+        url = evt.content.url if hasattr(evt.content, "url") else None
+        return self.echo_cache.match(self.echo_cache.key(evt.room_id, body, url))
 
-    def event_is_duplicated(self, event_id) -> bool:
-        duplicated = False
+    @staticmethod
+    def get_evt_cache_body(evt: Event):
+        return evt.content.body if hasattr(evt, "content") and hasattr(evt.content, "body") else None
 
-        self.deduplication_cache_lock.acquire()
+    def cache_body(self, room_id, body, url=None):
+        self.echo_cache.add(self.echo_cache.key(room_id, body, url))
 
-        if self.deduplication_cache.get(event_id) is not None:
-            # self.log.debug("deduplication cache hit for %s", event_id)
-            duplicated = True
+    def event_is_duplicated(self, event_id) -> bool:
+        duplicated = self.deduplication_cache.check_and_add(event_id)
+        if duplicated:
+            self.metric_deduplication_hits.inc()
         else:
-            self.deduplication_cache[event_id] = True
-            # self.log.debug("deduplication cache set for %s", event_id)
-
-        self.deduplication_cache_lock.release()
-
+            self.metric_deduplication_misses.inc()
         return duplicated
 
     async def build_talks_receive_message_request(self, evt, body=None):
@@ -503,6 +1293,8 @@ class BridgeBot(Plugin):
         mime_type = None
         url = None
         base64bytes = None
+        media_url = None
+        media_info = None
 
         built = False
 
@@ -527,8 +1319,14 @@ class BridgeBot(Plugin):
             url = content.url
             self.log.debug(f"incoming message: {message_type} with MIME: {mime_type} and mxcUri: {url}")
             if url is not None:
-                downloaded_bytes = await self.download_media_content(url)
-                base64bytes = base64.b64encode(downloaded_bytes) if downloaded_bytes else None
+                self.remember_media_info(url, content.info)
+                if self.TALKS_MEDIA_PROXY:
+                    media_url = self.media_proxy_url(url)
+                    media_info = self.build_talks_media_info(url, content.info)
+                elif not self.TALKS_MEDIA_STREAMING:
+                    downloaded_bytes = await self.download_media_content(url)
+                    base64bytes = base64.b64encode(downloaded_bytes) if downloaded_bytes else None
+                    self.metric_media_bytes_to_talks.inc(len(downloaded_bytes) if downloaded_bytes else 0)
                 built = True
             else:
                 self.log.warning(f"{message_type} URL is not available, skipping sending to Talks (roomId={room_id}, sender_id={sender_id}, event_id={event_id})")
@@ -536,7 +1334,7 @@ class BridgeBot(Plugin):
         if built:
             return TalksReceiveMessageRequest(timestamp, room_id, event_id, sender_id, event_type, body,
                                               message_type, message_format, message_formatted_body, message_geo_uri,
-                                              mime_type, url, base64bytes)
+                                              mime_type, url, base64bytes, media_url, media_info)
         else:
             return None
 
@@ -549,168 +1347,575 @@ class BridgeBot(Plugin):
         else:
             return None
 
-    async def message_fetcher_task(self):
+    async def stream_media_content(self, url):
+        """
+        Downloads media in chunks of `media_chunk_size` bytes, without holding the whole file in memory
+        """
+        self.log.debug(f"stream_media_content: going to stream bytes from {url}")
+        async with await self.open_media_download(url) as r:
+            async for chunk in self.media_response_chunks(r):
+                yield chunk
+        self.log.debug(f"stream_media_content: streamed bytes from {url}.")
+
+    async def open_media_download(self, url):
+        """
+        Starts downloading media from the homeserver
+        :return: the response, once its status is known to be successful, to be released by the caller
+        :raise MediaDownloadError: if the homeserver can not be reached or does not serve the media
+        """
+        download_url = self.client.api.get_download_url(url)
+        headers = {"Authorization": f"Bearer {self.client.api.token}"}
+        try:
+            r = await self.client.api.session.get(download_url, headers=headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise MediaDownloadError(f"{url}: [{e.__class__.__name__}] {e}")
+        if r.status != 200:
+            r.release()
+            raise MediaDownloadError(f"{url}: status={r.status}", status=r.status)
+        return r
+
+    async def media_response_chunks(self, r):
+        async for chunk in r.content.iter_chunked(self.MEDIA_CHUNK_SIZE):
+            self.metric_media_bytes_to_talks.inc(len(chunk))
+            yield chunk
+
+    async def download_media_range(self, url, first: int, last: Optional[int] = None):
+        """
+        Downloads at most the bytes `first` to `last` (or to the end) of media with a range request.
+        A media repository that ignores the range answers with the whole media, of which only as many bytes
+        are read, from its beginning
+        :return: the HTTP status, the bytes read and the total size of the media, None if unknown
+        """
+        download_url = self.client.api.get_download_url(url)
+        headers = {"Authorization": f"Bearer {self.client.api.token}",
+                   "Range": f"bytes={first}-{last if last is not None else ''}"}
+        limit = last - first + 1 if last is not None else None
+        data = bytearray()
+        async with self.client.api.session.get(download_url, headers=headers) as r:
+            r.raise_for_status()
+            if r.status == 206:
+                total = r.headers.get("Content-Range", "").rpartition("/")[2]
+                size = int(total) if total.isdigit() else None
+            else:
+                size = r.content_length
+            async for chunk in r.content.iter_chunked(self.MEDIA_CHUNK_SIZE):
+                data += chunk
+                if limit is not None and len(data) >= limit:
+                    break
+        return r.status, bytes(data[:limit]), size
+
+    def media_proxy_url(self, url) -> str:
+        """
+        :return: the URL where Talks downloads the media from the media proxy endpoint of this plugin's web app
+        """
+        return f"{self.webapp_url}/media/{url[len('mxc://'):]}"
+
+    def build_talks_media_info(self, url, info) -> dict:
+        cached = self.media_upload_cache.get(self.media_upload_cache.uri_key(url))
+        if cached is not None:
+            return {field: cached[field] for field in ("size", "width", "height", "duration")}
+        return {field: getattr(info, field, None) for field in ("size", "width", "height", "duration")}
+
+    def remember_media_info(self, url, info):
+        """
+        Adds the metadata sent by the Matrix client along with media to the media metadata cache, unless already
+        known, so the media costs no download if Talks sends it back
         """
-        Sole task that moves messages from Talks to Matrix.
-        Calls the Talks Hippy endpoints /getMessages and /confirmMessages (by calling functions)
+        uri_key = self.media_upload_cache.uri_key(url)
+        if info is None or self.media_upload_cache.get(uri_key) is not None:
+            return
+        mime_type = getattr(info, "mimetype", None)
+        size = getattr(info, "size", None)
+        if mime_type and size:
+            self.media_upload_cache.put(uri_key, mxc_uri=url, mime_type=mime_type, size=size,
+                                        width=getattr(info, "width", None), height=getattr(info, "height", None),
+                                        duration=getattr(info, "duration", None))
+
+    async def message_fetcher_task(self, backend):
+        """
+        Sole task that fetches messages from a Talks backend.
+        Calls the Talks Hippy endpoint /getMessages and hands the messages to the per-room propagator tasks,
+        without waiting for them to be propagated. Logs the backend throughput and latency every
+        `talks_backend_report_interval` seconds
         :return:
         """
-        self.log.info("Started message_fetcher_task")
+        self.log.info("Started message_fetcher_task for backend %s (delivery mode: %s)", backend.name,
+                      self.TALKS_DELIVERY_MODE.value)
+        loop = asyncio.get_running_loop()
+        report_interval = self.config["talks_backend_report_interval"]
+        reported = loop.time()
+
+        if self.shard_membership is not None:
+            await self.wait_for_shard_handoff(backend)
 
         while self.running:
             # self.log.debug("LOOP start_message_fetcher")
-            messages = await self.fetch_messages()
+            backend.fetcher_wakeup.clear()
+            probe_delay = backend.breaker.seconds_to_probe()
+            if probe_delay > 0:
+                # the circuit is open: the next fetch, when it is due, probes the backend
+                try:
+                    await asyncio.wait_for(backend.fetcher_wakeup.wait(), timeout=probe_delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            started = loop.time()
+            messages = await self.fetch_messages(backend)
+            elapsed = loop.time() - started
             if messages is not None:
-                message_ids = await self.propagate_messages(messages)
-                await self.confirm_messages(message_ids)
-            message_fetcher_delay = self.config["message_fetcher_delay"]
-            await asyncio.sleep(message_fetcher_delay)
+                messages = self.dispatch_messages(backend, messages)
+            self.metric_fetch_cycle.observe(loop.time() - started)
+            if report_interval and loop.time() - reported >= report_interval:
+                reported = loop.time()
+                self.log.info("Talks backend %s: %s", backend.name, backend.report())
+            await self.wait_for_messages(backend, messages, elapsed)
+
+        self.log.info("Stopped message_fetcher_task for backend %s", backend.name)
+
+    async def wait_for_shard_handoff(self, backend):
+        """
+        Rooms that move to this instance may still have messages being propagated by their previous owner, which
+        confirms them as it stops. Fetching only `shard_handoff_delay` seconds after the handoff, when the last of the
+        live instances stopped handling them, keeps them from being sent twice; messages not confirmed by then stay in
+        Talks and are fetched here, so none is lost
+        """
+        delay = self.config["shard_handoff_delay"]
+        self.log.info("Shard %s of %s: waiting for the room handoff", self.SHARD_INSTANCE,
+                      self.shard_membership.alive)
+        while self.running:
+            backend.fetcher_wakeup.clear()
+            timeout = None
+            if self.shard_handoff_since is not None:
+                timeout = self.shard_handoff_since + delay - time.time()
+                if timeout <= 0:
+                    return
+            try:
+                await asyncio.wait_for(backend.fetcher_wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
 
-        self.log.info("Stopped message_fetcher_task")
+    async def wait_for_messages(self, backend, messages, elapsed):
+        """
+        Adaptive polling: the delay is reset to `message_fetcher_delay` after any activity and doubles
+        up to `message_fetcher_max_delay` while idle. The wait ends early when the fetcher is notified,
+        either by the Talks webhook or by a message just sent to Talks (a reply is likely to follow).
+        A long-poll request that was held open by Talks needs no extra wait.
+        """
+        min_delay = self.config["message_fetcher_delay"]
+        max_delay = self.config["message_fetcher_max_delay"]
+
+        if messages:
+            backend.fetcher_delay = min_delay
+        else:
+            if self.TALKS_DELIVERY_MODE == self.DeliveryMode.LONG_POLL and messages is not None \
+                    and elapsed >= self.TALKS_LONG_POLL_WAIT:
+                return
+            backend.fetcher_delay = min(max(backend.fetcher_delay, min_delay) * 2, max_delay)
+
+        try:
+            await asyncio.wait_for(backend.fetcher_wakeup.wait(), timeout=backend.fetcher_delay)
+        except asyncio.TimeoutError:
+            pass
+
+    def notify_message_fetcher(self, backend=None):
+        """
+        Wakes up the fetcher of a backend, or of all of them
+        """
+        backends = (backend,) if backend is not None else self.talks_backends.values()
+        for backend in backends:
+            backend.fetcher_delay = self.config["message_fetcher_delay"]
+            backend.fetcher_wakeup.set()
 
-    async def fetch_messages(self) -> object:
+    @web.post("/messages_ready")
+    async def messages_ready(self, req: Request) -> Response:
+        """
+        Webhook called by Talks when there are messages ready to be fetched. The optional `backend` query parameter
+        tells which backend is calling; without it all the backends are fetched
+        """
+        if not self.authorized(req):
+            return Response(status=401)
+        backend_name = req.query.get("backend")
+        if backend_name is not None and backend_name not in self.talks_backends:
+            return Response(status=404)
+        self.notify_message_fetcher(self.talks_backends.get(backend_name))
+        return Response(status=204)
+
+    @web.get("/metrics")
+    async def metrics_endpoint(self, req: Request) -> Response:
+        """
+        Bridge metrics in the Prometheus text format
+        """
+        if not self.config["metrics_enabled"]:
+            return Response(status=404)
+        if not self.authorized(req):
+            return Response(status=401)
+        return Response(body=self.metrics.render().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    @web.get("/media/{server_name}/{media_id}")
+    async def media_proxy(self, req: Request) -> StreamResponse:
+        """
+        Media proxy used by Talks when `talks_media_proxy` is enabled, with HTTP range request support.
+        Media is served from the bounded disk cache, downloaded there on a miss. Media known to be larger than
+        the whole cache is streamed from the homeserver instead, forwarding the range
+        """
+        if not self.TALKS_MEDIA_PROXY:
+            return Response(status=404)
+        if not self.authorized(req):
+            return Response(status=401)
+        url = f"mxc://{req.match_info['server_name']}/{req.match_info['media_id']}"
+        metadata = self.media_upload_cache.get(self.media_upload_cache.uri_key(url)) or {}
+        key = self.media_proxy_cache.key(url)
+        path = self.media_proxy_cache.get(key)
+        if path is not None:
+            self.metric_media_proxy_hits.inc()
+        elif (metadata.get("size") or 0) > self.media_proxy_cache.max_bytes:
+            self.metric_media_proxy_passthrough.inc()
+            return await self.stream_media_range(req, url)
+        else:
+            self.metric_media_proxy_misses.inc()
+            try:
+                path = await self.media_proxy_cache.fill(key, self.stream_media_content(url))
+            except (MediaDownloadError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.log.warning("Can not download %s for the media proxy: %s", url, e)
+                return Response(status=404 if getattr(e, "status", None) == 404 else 502)
+        return FileResponse(path, headers={"Content-Type": metadata.get("mime_type") or "application/octet-stream"})
+
+    async def stream_media_range(self, req: Request, url) -> StreamResponse:
+        """
+        Streams media from the homeserver to a media proxy client, forwarding its range request
+        """
+        download_url = self.client.api.get_download_url(url)
+        headers = {"Authorization": f"Bearer {self.client.api.token}"}
+        if "Range" in req.headers:
+            headers["Range"] = req.headers["Range"]
+        async with self.client.api.session.get(download_url, headers=headers) as r:
+            if r.status >= 400:
+                return Response(status=404 if r.status == 404 else 502)
+            response = StreamResponse(status=r.status, headers={
+                name: r.headers[name] for name in ("Content-Type", "Content-Length", "Content-Range", "Accept-Ranges")
+                if name in r.headers})
+            await response.prepare(req)
+            async for chunk in r.content.iter_chunked(self.MEDIA_CHUNK_SIZE):
+                self.metric_media_bytes_to_talks.inc(len(chunk))
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+
+    def authorized(self, req: Request) -> bool:
+        """
+        Accepts the `talks_api_key` bearer token and the `api_key` of the backend named by the `backend` query
+        parameter or, without it, of any backend
+        """
+        backend = self.talks_backends.get(req.query.get("backend"))
+        backends = (backend,) if backend is not None else self.talks_backends.values()
+        keys = {self.TALKS_API_KEY} | {candidate.client.api_key for candidate in backends}
+        authorization = req.headers.get("Authorization", "").encode("utf-8")
+        return any(hmac.compare_digest(authorization, f"Bearer {key}".encode("utf-8")) for key in keys)
+
+    async def fetch_messages(self, backend) -> object:
+        """
+        Also the health check of the backend: when its circuit breaker is open, the first fetch after the open
+        timeout is the probe call that closes it again
+        """
         messages = None
 
         try:
-            r = await self.get(self.TALKS_GET_MESSAGES)
+            if self.TALKS_DELIVERY_MODE == self.DeliveryMode.LONG_POLL:
+                params = {"wait": self.TALKS_LONG_POLL_WAIT, **(self.shard_params() or {})}
+                r = await backend.client.get(backend.get_messages_url, params=params,
+                                             extra_timeout=self.TALKS_LONG_POLL_WAIT)
+            else:
+                r = await self.get(backend, backend.get_messages_url, params=self.shard_params())
             if 400 <= r.status_code < 500:
                 self.log.warning(f"talks_get_messages: status_code={r.status_code}")
             elif r.status_code != 200:
                 raise BridgeException(f"status={r.status_code} description={r.json()['description']}")
             else:
                 # self.log.debug("GetMessages response: %s", r.text)
-                messages = r.json()["messages"]
+                messages = TalksResponse.from_json(r.text).messages
 
         except BridgeException as e:
-            self.log.error("%s: %s, will retry.", self.TALKS_GET_MESSAGES, e.message)
+            self.log.error("%s: %s, will retry.", backend.get_messages_url, e.message)
+        except CircuitOpenError as e:
+            self.log.debug("%s: %s", backend.get_messages_url, e)
         except Exception as e:
-            self.log.error("Can not access %s, will retry: %s", self.TALKS_GET_MESSAGES, e)
+            self.log.error("Can not access %s, will retry: %s", backend.get_messages_url, e)
 
         return messages
 
-    async def propagate_messages(self, messages):
-        if len(messages) == 0:
-            return list()
+    def dispatch_messages(self, backend, messages):
+        """
+        Appends the fetched messages to their room propagator queues, skipping the ones still
+        being propagated or confirmed (Talks returns them until they are confirmed) and, with sharding,
+        the ones of rooms owned by other instances, which are left unconfirmed for them.
+        Messages propagated already are confirmed again with their stored event ID instead of being sent again
+        :return: the newly dispatched messages
+        """
+        dispatched = list()
 
-        messages_per_room = defaultdict(list)
         for message in messages:
-            room_id = message["roomId"]
-            messages_per_room[room_id].append(message)
-
-        tasks = list()
-        for room_id, messages_in_room in messages_per_room.items():
-            task = asyncio.create_task(self.message_propagator_per_room_task(room_id, messages_in_room))
-            tasks.append(task)
-
-        done, pending = await asyncio.wait(tasks)
-        results = [task.result() for task in done]
-        id_triples = [triple for triples in results for triple in triples]
-
-        return id_triples
-
-    async def message_propagator_per_room_task(self, room_id, messages):
-        id_triples = []
-
-        for idx, message in enumerate(messages):
-            if idx > 0:
-                message_propagator_delay = self.config["message_propagator_delay"]
-                await asyncio.sleep(message_propagator_delay)
-
-            event_id, url = await self.propagate_message(message)
-            id_triples.append((message["id"], event_id, url))
+            if (backend.name, message.id) in self.message_ids_in_flight:
+                id_triple = backend.unconfirmed.get(message.id)
+                if id_triple is not None:
+                    # propagated already, Talks did not get the confirmation yet
+                    self.metric_outbound_redelivered.inc()
+                    if backend.confirm_retry_handle is None:
+                        self.confirm_message(backend, id_triple)
+                continue
+            if not self.owns_room(message.roomId):
+                continue
+            self.message_ids_in_flight.add((backend.name, message.id))
+            backend.metric_messages_from_talks.inc()
+            room_id = message.roomId
+            if room_id not in self.message_propagator_queues:
+                self.message_propagator_queues[room_id] = deque()
+                task = asyncio.create_task(self.message_propagator_per_room_task(room_id))
+                self.message_propagator_tasks[room_id] = task
+            self.message_propagator_queues[room_id].append((backend, message))
+            self.cancel_pending_hints(room_id)
+            dispatched.append(message)
+
+        return dispatched
+
+    async def message_propagator_per_room_task(self, room_id):
+        """
+        Propagates the room messages in order, paced by the outbound scheduler. Ends when the room queue is empty
+        """
+        queue = self.message_propagator_queues[room_id]
 
-        return id_triples
+        while len(queue) > 0:
+            backend, message = queue.popleft()
+            try:
+                event_id, url = await self.propagate_message(message)
+            except Exception as e:
+                self.log.error("Can not propagate message %s, propagation cancelled: %s", message.id, e)
+                event_id, url = None, None
+            if self.durable_store is not None:
+                self.durable_store.add_outbound(message.id, event_id, url, backend.name)
+            self.confirm_message(backend, (message.id, event_id, url))
+
+        del self.message_propagator_queues[room_id]
+        del self.message_propagator_tasks[room_id]
+        self.outbound_scheduler.release(room_id)
+        self.release_room_sequence(room_id)
+
+    def release_room_sequence(self, room_id):
+        """
+        Forgets the message count of a room once nothing compares with it any more: no message of the room being
+        propagated and no hints waiting for their timer or being sent, so `room_sequences` only holds active rooms
+        """
+        if room_id not in self.message_propagator_queues and room_id not in self.pending_hints \
+                and room_id not in self.hints_in_flight:
+            self.room_sequences.pop(room_id, None)
 
     async def propagate_message(self, message):
         event_id = None
         event_type: EventType = EventType.ROOM_MESSAGE
         content, url = await self.build_message_content(message)
-        actions = message["actions"]
+        actions = message.actions
+        sequence = self.room_sequences[message.roomId] = self.room_sequences.get(message.roomId, 0) + 1
+        self.cancel_pending_hints(message.roomId)
 
         if content is not None:
             try:
-                event_id = await self.client.send_message_event(message["roomId"], event_type, content)
-                self.log.debug("Propagated message %s -> %s", message["id"], event_id)
+                started = time.perf_counter()
+                event_id = await self.send_event(message.roomId, event_type, content, url=url)
+                self.metric_propagate_send.observe(time.perf_counter() - started)
+                self.log.debug("Propagated message %s -> %s", message.id, event_id)
             except Exception as e:
-                self.log.error("Can not propagate message %s, propagation cancelled: %s", message["id"], e)
+                self.log.error("Can not propagate message %s, propagation cancelled: %s", message.id, e)
 
         if self.hints and actions is not None and len(actions) > 0:
             try:
-                hints_content = await self.build_hints_content(actions)
+                hints_content = await self.build_hints_content(message.roomId, actions)
                 hints_delay = self.config["hints_delay"]
-                await asyncio.sleep(hints_delay)
-                await self.client.send_message_event(message["roomId"], event_type, hints_content)
-                self.log.debug("Sent hints for message %s", message["id"])
+                handle = asyncio.get_running_loop().call_later(hints_delay, self.send_pending_hints, message.roomId)
+                self.pending_hints[message.roomId] = (handle, message.id, sequence, hints_content)
             except Exception as e:
-                self.log.error("Can not send hints for message %s, propagation cancelled: %s", message["id"], e)
+                self.log.error("Can not build hints for message %s, propagation cancelled: %s", message.id, e)
 
         return event_id, url
 
+    def cancel_pending_hints(self, room_id):
+        """
+        Drops the hints of an older message of the room not sent yet, as its options are stale
+        """
+        pending = self.pending_hints.pop(room_id, None)
+        if pending is not None:
+            handle, message_id, _, _ = pending
+            handle.cancel()
+            self.log.debug("Cancelled stale hints for message %s", message_id)
+            self.release_room_sequence(room_id)
+
+    def send_pending_hints(self, room_id):
+        """
+        Fired by the event loop timer `hints_delay` seconds after the message, so waiting for it holds no task
+        """
+        pending = self.pending_hints.pop(room_id, None)
+        if pending is None:
+            return
+        handle, message_id, sequence, hints_content = pending
+        handle.cancel()
+        self.hints_in_flight[room_id] = self.hints_in_flight.get(room_id, 0) + 1
+        task = asyncio.create_task(self.send_hints(room_id, message_id, sequence, hints_content))
+        self.hints_tasks.add(task)
+        task.add_done_callback(self.hints_tasks.discard)
+
+    async def send_hints(self, room_id, message_id, sequence, hints_content):
+        """
+        The hints may wait in `send_event` for the rate limits, past the point where `cancel_pending_hints` can
+        stop them, so they are dropped there if a newer message of the room was propagated meanwhile
+        :param sequence: the number of the message in the room, see `room_sequences`
+        """
+        try:
+            started = time.perf_counter()
+            event_id = await self.send_event(room_id, EventType.ROOM_MESSAGE, hints_content,
+                                             current=lambda: self.room_sequences.get(room_id) == sequence)
+            if event_id is None:
+                self.log.debug("Dropped stale hints for message %s", message_id)
+                return
+            self.metric_propagate_hints.observe(time.perf_counter() - started)
+            self.log.debug("Sent hints for message %s", message_id)
+        except Exception as e:
+            self.log.error("Can not send hints for message %s, propagation cancelled: %s", message_id, e)
+        finally:
+            if self.hints_in_flight[room_id] > 1:
+                self.hints_in_flight[room_id] -= 1
+            else:
+                del self.hints_in_flight[room_id]
+                self.release_room_sequence(room_id)
+
+    async def send_event(self, room_id, event_type, content, url=None, current=None):
+        """
+        Sends an event to a room once the outbound scheduler allows it. When the homeserver rate limits the bot,
+        sending pauses for all rooms for the `retry_after_ms` of the 429 response, or with exponential backoff if
+        it does not say, at most `outbound_rate_limit_max_pause` seconds, and the event is sent again with the same
+        transaction ID instead of being dropped.
+        The echo of the event is registered right before each attempt, so waiting for the rate limits can not make
+        it outlive `echo_cache_ttl`, and dropped again when the homeserver rejects the attempt
+        :param url: the mxc URI of media events, part of the echo key
+        :param current: called once the rate limits allow the event, which is not sent if it returns False
+        :return: the event ID, None if the event was not sent because it was no longer current
+        """
+        body = getattr(content, "body", None)
+        echo_key = self.echo_cache.key(room_id, body, url) if body is not None else None
+        attempt = 0
+        txn_id = self.client.api.get_txn_id()
+        encrypted = await self.room_is_encrypted(room_id)
+        while True:
+            self.metric_outbound_throttle_wait.observe(await self.outbound_scheduler.acquire(room_id))
+            if current is not None and not current():
+                return None
+            if echo_key is not None:
+                self.echo_cache.add(echo_key)
+            try:
+                if encrypted:
+                    return await self.client.send_message_event(room_id, event_type, content, txn_id=txn_id)
+                return await self.put_room_event(room_id, event_type, content, txn_id)
+            except MatrixRequestError as e:
+                if echo_key is not None:
+                    self.echo_cache.discard(echo_key)
+                if (e.http_status != 429 and e.errcode != "M_LIMIT_EXCEEDED") or not self.running:
+                    raise
+                max_pause = self.config["outbound_rate_limit_max_pause"]
+                if isinstance(e, HomeserverRateLimited) and e.retry_after_ms is not None:
+                    delay = min(max_pause, e.retry_after_ms / 1000)
+                else:
+                    delay = min(max_pause, 2.0 ** attempt)
+                attempt += 1
+                self.metric_outbound_rate_limited.inc()
+                self.log.warning("Rate limited by the homeserver sending to room %s, pausing for %s seconds",
+                                 room_id, delay)
+                self.outbound_scheduler.pause(delay)
+
+    async def room_is_encrypted(self, room_id) -> bool:
+        if getattr(self.client, "crypto", None) is None:
+            return False
+        return await self.client.state_store.is_encrypted(room_id)
+
+    async def put_room_event(self, room_id, event_type, content, txn_id) -> EventID:
+        """
+        Sends an event with a plain client API request, since the errors raised by the mautrix client do not keep
+        the `retry_after_ms` of the 429 responses. Events of encrypted rooms go through the client, which encrypts them
+        """
+        api = self.client.api
+        url = api.base_url / "_matrix" / "client" / "v3" / "rooms" / room_id / "send" / str(event_type) / txn_id
+        body = content.serialize() if hasattr(content, "serialize") else content
+        async with api.session.put(url, json=body, headers={"Authorization": f"Bearer {api.token}"}) as r:
+            text = await r.text()
+            retry_after = r.headers.get("Retry-After")
+        try:
+            data = json.loads(text)
+        except ValueError:
+            data = dict()
+        if not isinstance(data, dict):
+            data = dict()
+        if 200 <= r.status < 300:
+            return EventID(data["event_id"])
+        if r.status == 429 or data.get("errcode") == "M_LIMIT_EXCEEDED":
+            retry_after_ms = data.get("retry_after_ms")
+            if retry_after_ms is None and retry_after is not None and retry_after.isdigit():
+                retry_after_ms = int(retry_after) * 1000
+            raise HomeserverRateLimited(retry_after_ms, data.get("error", ""))
+        raise make_request_error(http_status=r.status, text=text, errcode=data.get("errcode"),
+                                 message=data.get("error"))
+
     async def build_message_content(self, message):
         if message is None:
             pass
 
-        body_log = message["body"] if message["body"] and message["messageType"] and (message["messageType"] == "m.text") else "N/A"
-        self.log.debug(f"outgoing message: roomId=[{message['roomId']}] messageType=[{message['messageType']}] bodyType=[{message['bodyType']}] mimeType=[{message['mimeType']}] body=[{body_log}]")
+        body_log = message.body if message.body and message.messageType and (message.messageType == "m.text") else "N/A"
+        self.log.debug(f"outgoing message: roomId=[{message.roomId}] messageType=[{message.messageType}] bodyType=[{message.bodyType}] mimeType=[{message.mimeType}] body=[{body_log}]")
 
         content = None
-        built = False
 
-        body_type = message["bodyType"]
+        body_type = message.bodyType
         url = None
 
         if body_type == "TEXT":
-            content = TextMessageEventContent(msgtype=MessageType.NOTICE, body=message["body"])
-            built = True
+            content = TextMessageEventContent(msgtype=MessageType.NOTICE, body=message.body)
 
         elif body_type == "HTML":
-            content = TextMessageEventContent(msgtype=MessageType.NOTICE, body=message["body"])
+            content = TextMessageEventContent(msgtype=MessageType.NOTICE, body=message.body)
             content.format = Format.HTML
-            formatted_body = self.html_format(content.body)
-            content.body, content.formatted_body = await parse_formatted(
-                formatted_body, render_markdown=False, allow_html=True
-            )
-            built = True
+            content.body, content.formatted_body = await self.render_html(content.body)
 
         elif body_type == "GEO_URI":
-            content = LocationMessageEventContent(msgtype=MessageType.LOCATION, geo_uri=message["body"])
-            built = True
+            content = LocationMessageEventContent(msgtype=MessageType.LOCATION, geo_uri=message.body)
 
         elif body_type in ("IMAGE", "AUDIO", "VIDEO", "FILE"):
-            url = message["mxcUri"]
-            base64bytes = message["body"]
+            url = message.mxcUri
+            base64bytes = message.body
             if base64bytes is None and url is not None:
                 try:
-                    raw_bytes = await self.download_media_content(url)
-                    info = await self._upload_and_get_media_info(body_type, "filename", raw_bytes, uri=url)
+                    info = await self.get_media_info_by_uri(body_type, "filename", url)
                     self.log.debug(f"outgoing message: mxc_uri (pre-existing): {url}")
                     content = MediaMessageEventContent(url=url, body="filename",
                                                        msgtype=self.build_message_type(body_type),
                                                        info=await self.build_media_info(body_type, info))
-                    built = True
                 except Exception as e:
                     self.log.error("Can not download %s content from URI %s for message %s, propagation cancelled: %s",
-                                   body_type, url, message["id"], e)
+                                   body_type, url, message.id, e)
             elif base64bytes is not None:
                 try:
                     raw_bytes = base64.b64decode(base64bytes)
-                    filename = message["filename"]
+                    filename = message.filename
                     info = await self._upload_and_get_media_info(body_type, filename, raw_bytes)
                     url = info.mxc_uri
                     self.log.debug(f"outgoing message: mxc_uri (new): {url}")
                     content = MediaMessageEventContent(url=url, body=info.file_name,
                                                        msgtype=self.build_message_type(body_type),
                                                        info=await self.build_media_info(body_type, info))
-                    built = True
                 except Exception as e:
                     self.log.error("Can not upload %s content for message %s, propagation cancelled: %s",
-                                   body_type, message["id"], e)
+                                   body_type, message.id, e)
             else:
                 raise Exception("Empty body in Talks response")
 
         elif body_type == 'DELETE_MESSAGE':
-            room_id = message["roomId"]
-            message_id = message["body"]
+            room_id = message.roomId
+            message_id = message.body
             try:
                 redact_evt_id = await self.client.redact(
                     room_id,
@@ -719,14 +1924,10 @@ class BridgeBot(Plugin):
                 )
                 redact_evt = await self.client.get_event(room_id, redact_evt_id)
                 redact_content = redact_evt["content"]
-                self.cache_body(redact_content)
-                built = True
+                self.cache_body(room_id, f"{redact_content}")
             except Exception as e:
                 self.log.error("Can not redact message %s in room %s from DELETE_MESSAGE %s",
-                               message_id, room_id, message["id"], e)
-
-        if built and content is not None:
-            self.cache_body(content["body"], url=url)
+                               message_id, room_id, message.id, e)
 
         return content, url
 
@@ -772,25 +1973,94 @@ class BridgeBot(Plugin):
         else:
             return {}
 
+    async def get_media_info_by_uri(self, type: str, file_name: str, uri) -> MediaCache:
+        """
+        Describes media already on the homeserver from the media metadata cache or, on a miss, from its first
+        `media_header_size` bytes (and the last page of OGG files), fetched with range requests.
+        The whole media is downloaded only if its beginning can not be inspected or its size is unknown
+        """
+        cached = self.media_upload_cache.get(self.media_upload_cache.uri_key(uri))
+        if cached is not None:
+            self.log.debug(f"media metadata cache hit for {uri}")
+            return self.media_cache(file_name=file_name, **cached)
+
+        status, head, size = await self.download_media_range(uri, 0, self.MEDIA_HEADER_SIZE - 1)
+        if size is None:
+            if len(head) >= self.MEDIA_HEADER_SIZE:
+                self.log.debug(f"size of {uri} unknown, downloading it")
+                raw_bytes = await self.download_media_content(uri)
+                return await self._upload_and_get_media_info(type, file_name, raw_bytes, uri=uri)
+            # the media ended before the header size, so it was read whole
+            size = len(head)
+        partial = size > len(head)
+        tail = None
+        tail_size = container_tail_size(head)
+        if partial and status == 206 and tail_size > 0:
+            status, tail, _ = await self.download_media_range(uri, max(len(head), size - tail_size))
+            if status != 206:
+                tail = None
+
+        loop = asyncio.get_running_loop()
+        try:
+            mime_type, width, height, duration = await loop.run_in_executor(self.media_inspection_executor,
+                                                                            self._inspect_media, type, head,
+                                                                            tail, partial)
+        except Exception as e:
+            self.log.debug(f"can not inspect the first {len(head)} bytes of {uri}, downloading it: {e}")
+            raw_bytes = await self.download_media_content(uri)
+            return await self._upload_and_get_media_info(type, file_name, raw_bytes, uri=uri)
+
+        cache = self.media_cache(mxc_uri=uri, file_name=file_name,
+                                 mime_type=mime_type, width=width, height=height,
+                                 duration=duration,
+                                 size=size)
+        self.media_upload_cache.put(self.media_upload_cache.uri_key(uri), **vars(cache))
+        return cache
+
     async def _upload_and_get_media_info(self, type: str, file_name: str, data: bytes, uri=None) -> MediaCache:
+        loop = asyncio.get_running_loop()
+        cache_key = None
+        if uri is None:
+            cache_key = await loop.run_in_executor(self.media_inspection_executor,
+                                                   self.media_upload_cache.key, type, data)
+            cached = self.media_upload_cache.get(cache_key)
+            if cached is not None:
+                self.log.debug(f"media upload cache hit for {cached['mxc_uri']}")
+                return self.media_cache(file_name=file_name, **cached)
+
+        mime_type, width, height, duration = await loop.run_in_executor(self.media_inspection_executor,
+                                                                        self._inspect_media, type, data)
+        if uri is None:
+            started = time.perf_counter()
+            uri = await self.client.upload_media(data, mime_type=mime_type)
+            self.metric_propagate_media_upload.observe(time.perf_counter() - started)
+            self.metric_media_bytes_to_matrix.inc(len(data))
+        cache = self.media_cache(mxc_uri=uri, file_name=file_name,
+                                 mime_type=mime_type, width=width, height=height,
+                                 duration=duration,
+                                 size=len(data))
+        if cache_key is not None:
+            self.media_upload_cache.put(cache_key, **vars(cache))
+        self.media_upload_cache.put(self.media_upload_cache.uri_key(uri), **vars(cache))
+        return cache
+
+    def _inspect_media(self, type: str, data: bytes, tail: Optional[bytes] = None, partial: bool = False):
+        """
+        CPU-bound media inspection, run in the media inspection executor
+        :param partial: True if `data` is only the beginning of the media, see `container_info`
+        """
         width = height = duration = mime_type = None
         if magic is not None:
             mime_type = magic.from_buffer(data, mime=True)
         if type == "IMAGE":
             width, height = self._get_image_info(data)
         elif type == "AUDIO":
-            duration = self._get_audio_info(data)
+            duration = self._get_audio_info(data, tail, partial)
         elif type == "VIDEO":
-            width, height, duration = self._get_video_info(data)
+            width, height, duration = self._get_video_info(data, tail, partial)
         elif type == "FILE":
             mime_type = self._get_file_info(data)
-        if uri is None:
-            uri = await self.client.upload_media(data, mime_type=mime_type)
-        cache = self.media_cache(mxc_uri=uri, file_name=file_name,
-                                 mime_type=mime_type, width=width, height=height,
-                                 duration=duration,
-                                 size=len(data))
-        return cache
+        return mime_type, width, height, duration
 
     def _get_image_info(self, data: bytes):
         width = height = None
@@ -799,14 +2069,12 @@ class BridgeBot(Plugin):
             width, height = image.size
         return width, height
 
-    def _get_audio_info(self, data: bytes):
-        duration = None
-        # TODO get audio duration
+    def _get_audio_info(self, data: bytes, tail: Optional[bytes] = None, partial: bool = False):
+        _, _, duration = container_info(data, tail, partial)
         return duration
 
-    def _get_video_info(self, data: bytes):
-        width = height = duration = None
-        # TODO
+    def _get_video_info(self, data: bytes, tail: Optional[bytes] = None, partial: bool = False):
+        width, height, duration = container_info(data, tail, partial)
         return width, height, duration
 
     def _get_file_info(self, data: bytes):
@@ -814,41 +2082,95 @@ class BridgeBot(Plugin):
         # TODO
         return mime_type
 
-    async def build_hints_content(self, actions):
-        hints = "<b>Options</b>:"
-        for hint, text in actions.items():
-            hints = hints + f"\n<b>{hint}</b> : {text}"
+    async def build_hints_content(self, room_id, actions):
+        hints = "<b>Options</b>:" + "".join(f"\n<b>{hint}</b> : {text}" for hint, text in actions.items())
 
         content = TextMessageEventContent(msgtype=MessageType.NOTICE, body=hints)
         content.format = Format.HTML
-        formatted_body = self.html_format(content.body)
-        content.body, content.formatted_body = await parse_formatted(
-            formatted_body, render_markdown=False, allow_html=True
-        )
-
-        self.cache_body(content.body)
+        content.body, content.formatted_body = await self.render_html(hints)
 
         return content
 
-    async def confirm_messages(self, message_ids):
+    def confirm_message(self, backend, id_triple):
+        """
+        Records a propagated message in the `unconfirmed` ledger of its backend and queues its confirmation
+        """
+        backend.unconfirmed[id_triple[0]] = id_triple
+        if id_triple[0] not in backend.confirmations_queued:
+            backend.confirmations_queued.add(id_triple[0])
+            backend.confirmations.append(id_triple)
+            backend.confirmations_ready.set()
+
+    async def message_confirmer_task(self, backend):
+        """
+        Confirms propagated messages to their Talks backend as they land, batching the ones that
+        accumulate while a /confirmMessages call is in progress. Messages stay in the `unconfirmed` ledger
+        until Talks accepts their confirmation; failed confirmations are retried in the background
+        """
+        while self.running or len(backend.confirmations) > 0:
+            await backend.confirmations_ready.wait()
+            backend.confirmations_ready.clear()
+            id_triples = backend.confirmations
+            backend.confirmations = list()
+            backend.confirmations_queued.clear()
+            if len(id_triples) > 0:
+                confirmed = await self.confirm_messages(backend, id_triples)
+                if confirmed:
+                    backend.confirm_retries = 0
+                    for id_triple in id_triples:
+                        backend.unconfirmed.pop(id_triple[0], None)
+                        self.message_ids_in_flight.discard((backend.name, id_triple[0]))
+                        if self.durable_store is not None:
+                            self.durable_store.remove_outbound(id_triple[0])
+                elif self.running:
+                    self.schedule_confirmations_retry(backend)
+
+    def schedule_confirmations_retry(self, backend):
+        """
+        Retries all the unconfirmed messages of the backend in one batch, with exponential backoff up to
+        `talks_confirm_retry_max_delay` seconds and no sooner than the shared retry budget allows
+        """
+        if backend.confirm_retry_handle is not None:
+            return
+        backend.confirm_retries += 1
+        delay = min(0.1 * 2 ** backend.confirm_retries, self.config["talks_confirm_retry_max_delay"])
+        delay = max(delay, self.retry_budget.delay(time.monotonic()))
+        self.retry_budget.take()
+        self.log.warning("%s: %s messages not confirmed, will retry in %s seconds", backend.confirm_messages_url,
+                         len(backend.unconfirmed), delay)
+        backend.confirm_retry_handle = asyncio.get_running_loop().call_later(delay, self.retry_confirmations, backend)
+
+    def retry_confirmations(self, backend):
+        backend.confirm_retry_handle = None
+        for id_triple in list(backend.unconfirmed.values()):
+            self.confirm_message(backend, id_triple)
+
+    async def confirm_messages(self, backend, message_ids) -> bool:
+        """
+        :return: False if the confirmation can be retried
+        """
         if len(message_ids) > 0:
             talks_confirm_messages_request = self.build_talks_confirm_messages_request(message_ids)
-            talks_confirm_messages_request_json = jsonpickle.encode(talks_confirm_messages_request, unpicklable=False)
-            self.log.debug("ConfirmMessages request: %s", talks_confirm_messages_request_json)
+            self.log.debug("ConfirmMessages request: %s", talks_confirm_messages_request.to_json())
 
             try:
-                r = await self.post(self.TALKS_CONFIRM_MESSAGES, talks_confirm_messages_request_json)
+                r = await self.post(backend, backend.confirm_messages_url, talks_confirm_messages_request,
+                                    params=self.shard_params())
                 if 400 <= r.status_code < 500:
-                    self.log.warning(f"talks_confirm_messages: status_code={r.status_code} for message_ids={','.join(message_ids)}")
+                    self.log.warning(f"talks_confirm_messages: status_code={r.status_code} for message_ids={','.join(f'{id_triple[0]}' for id_triple in message_ids)}")
                 elif r.status_code != 200:
                     raise BridgeException(f"status={r.status_code} description={r.json()['description']}")
                 else:
                     self.log.debug("ConfirmMessages response: %s", r.text)
 
             except BridgeException as e:
-                self.log.error("%s: %s, will retry.", self.TALKS_CONFIRM_MESSAGES, e.message)
+                self.log.error("%s: %s, will retry.", backend.confirm_messages_url, e.message)
+                return False
             except Exception as e:
-                self.log.error("Can not access %s, will retry: %s", self.TALKS_CONFIRM_MESSAGES, e)
+                self.log.error("Can not access %s, will retry: %s", backend.confirm_messages_url, e)
+                return False
+
+        return True
 
     @staticmethod
     def build_talks_confirm_messages_request(message_ids) -> TalksConfirmMessageRequest:
@@ -860,15 +2182,11 @@ class BridgeBot(Plugin):
 
         return TalksConfirmMessageRequest(messages)
 
-    async def get(self, url):
-        headers = {"Authorization": f"Bearer {self.TALKS_API_KEY}"}
-        loop = asyncio.get_event_loop()
-        r = await loop.run_in_executor(None, functools.partial(self.session.get, url, headers=headers))
-        return r
+    async def get(self, backend, url, params=None):
+        return await backend.client.get(url, params=params)
 
-    async def post(self, url, json_contents):
-        headers = {"Authorization": f"Bearer {self.TALKS_API_KEY}"}
-        loop = asyncio.get_event_loop()
-        r = await loop.run_in_executor(None, functools.partial(self.session.post, url, json=json_contents,
-                                                               headers=headers))
-        return r
+    async def post(self, backend, url, payload: TalksPayload, params=None):
+        body = payload.to_json()
+        if self.TALKS_DOUBLE_ENCODED_JSON:
+            body = json.dumps(body)
+        return await backend.client.post_data(url, body, params=params)
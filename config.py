@@ -9,7 +9,22 @@ class Config(BaseProxyConfig):
         helper.copy("talks_protocol")
         helper.copy("talks_receive_message")
         helper.copy("talks_receive_message_timeout")
+        helper.copy("talks_receive_message_workers")
+        helper.copy("talks_receive_message_batch")
+        helper.copy("talks_receive_message_batch_size")
+        helper.copy("talks_receive_message_batch_linger")
         helper.copy("talks_get_messages")
+        helper.copy("talks_double_encoded_json")
+        helper.copy("talks_backends")
+        helper.copy("talks_routes")
+        helper.copy("talks_unhealthy_after")
+        helper.copy("talks_circuit_open_timeout")
+        helper.copy("talks_circuit_max_open_timeout")
+        helper.copy("talks_drain_rate")
+        helper.copy("talks_retry_budget_rate")
+        helper.copy("talks_retry_budget_burst")
+        helper.copy("talks_confirm_retry_max_delay")
+        helper.copy("talks_backend_report_interval")
         helper.copy("talks_confirm_messages")
         helper.copy("talks_tag_room")
         helper.copy("bot_on_regex")
@@ -18,9 +33,45 @@ class Config(BaseProxyConfig):
         helper.copy("forward_bot_messages")
         helper.copy("room_tags")
         helper.copy("deduplication_cache_size")
+        helper.copy("deduplication_cache_ttl")
+        helper.copy("deduplication_cache_path")
+        helper.copy("deduplication_cache_snapshot_interval")
         helper.copy("echo_cache_size")
+        helper.copy("echo_cache_ttl")
         helper.copy("fixed_timeout")
+        helper.copy("talks_pool_size")
+        helper.copy("talks_timeouts")
+        helper.copy("talks_concurrency")
+        helper.copy("talks_delivery_mode")
+        helper.copy("talks_long_poll_wait")
+        helper.copy("talks_media_streaming")
+        helper.copy("talks_media_proxy")
+        helper.copy("media_chunk_size")
+        helper.copy("media_download_retries")
+        helper.copy("media_inflight_budget")
+        helper.copy("media_upload_cache_size")
+        helper.copy("media_upload_cache_path")
+        helper.copy("media_header_size")
+        helper.copy("media_proxy_cache_path")
+        helper.copy("media_proxy_cache_size")
+        helper.copy("media_inspection_workers")
+        helper.copy("durable_queue_path")
+        helper.copy("durable_queue_commit_interval")
         helper.copy("message_fetcher_delay")
-        helper.copy("message_propagator_delay")
+        helper.copy("message_fetcher_max_delay")
+        helper.copy("outbound_room_rate")
+        helper.copy("outbound_room_burst")
+        helper.copy("outbound_global_rate")
+        helper.copy("outbound_global_burst")
+        helper.copy("outbound_rate_limit_max_pause")
         helper.copy("hints_delay")
+        helper.copy("read_receipt_delay")
+        helper.copy("html_render_cache_size")
         helper.copy("talks_api_key")
+        helper.copy("metrics_enabled")
+        helper.copy("shard_instance")
+        helper.copy("shard_instances")
+        helper.copy("shard_handoff_delay")
+        helper.copy("shard_heartbeat_interval")
+        helper.copy("shard_lease_timeout")
+        helper.copy("shard_standby_size")
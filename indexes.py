@@ -0,0 +1,158 @@
+"""
+Bounded in-memory indexes used to filter Matrix events
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+
+class DeduplicationIndex:
+    """
+    Set of recently seen keys, split in up to `bucket_count` time buckets. New keys go to the newest bucket and the
+    oldest bucket is dropped as a whole once all its keys are older than `ttl`, or earlier when all buckets are in use
+    and the newest one is full, so expiry is O(1) per key and memory stays around `maxsize` keys.
+    Only used from the event loop, so it needs no locking
+    """
+
+    def __init__(self, maxsize: int, ttl: float, bucket_count: int = 8, path: Optional[str] = None):
+        self.ttl = ttl
+        self.bucket_span = ttl / bucket_count
+        self.bucket_count = bucket_count
+        self.bucket_size = max(1, maxsize // bucket_count)
+        self.path = path
+        self.buckets = deque()
+        # serializes the periodic saves from the executor with the final one on stop
+        self.save_lock = threading.Lock()
+
+    def expire(self, now: float):
+        while len(self.buckets) > 0 and self.buckets[0][0] + self.bucket_span + self.ttl <= now:
+            self.buckets.popleft()
+
+    def current_bucket(self, now: float) -> set:
+        if len(self.buckets) == 0 or self.buckets[-1][0] + self.bucket_span <= now \
+                or len(self.buckets[-1][1]) >= self.bucket_size:
+            if len(self.buckets) > self.bucket_count:
+                self.buckets.popleft()
+            self.buckets.append((now, set()))
+        return self.buckets[-1][1]
+
+    def __contains__(self, key) -> bool:
+        for _, keys in self.buckets:
+            if key in keys:
+                return True
+        return False
+
+    def __len__(self) -> int:
+        return sum(len(keys) for _, keys in self.buckets)
+
+    def check_and_add(self, key) -> bool:
+        """
+        :return: True if the key was already in the index
+        """
+        now = time.time()
+        self.expire(now)
+        if key in self:
+            return True
+        self.current_bucket(now).add(key)
+        return False
+
+    def load(self) -> int:
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        with open(self.path, "r") as f:
+            snapshot = json.load(f)
+        self.buckets = deque((start, set(keys)) for start, keys in snapshot["buckets"][-(self.bucket_count + 1):])
+        self.expire(time.time())
+        return len(self)
+
+    def snapshot(self) -> dict:
+        """
+        :return: a copy of the buckets that can be saved from another thread while the index keeps changing
+        """
+        return {"buckets": [(start, list(keys)) for start, keys in self.buckets]}
+
+    def save(self, snapshot: Optional[dict] = None) -> int:
+        if not self.path:
+            return 0
+        if snapshot is None:
+            snapshot = self.snapshot()
+        tmp_path = f"{self.path}.tmp"
+        with self.save_lock:
+            with open(tmp_path, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.path)
+        return sum(len(keys) for _, keys in snapshot["buckets"])
+
+
+class EchoIndex:
+    """
+    Counts the messages sent by the bridge that are still expected to come back as echo events, keyed by room,
+    a stable digest of the body and the mxc URI for media. Each registration is matched by a single echo, so N
+    identical messages sent to a room suppress N echoes, and identical messages sent to different rooms do not
+    interfere. Registrations expire after `ttl` seconds in insertion order, and the oldest ones are dropped when
+    `maxsize` registrations are pending, so expiry is O(1) per registration and memory is bounded
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.pending = dict()
+        self.expiries = deque()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(room_id: str, body: str, url: Optional[str] = None):
+        return room_id, hashlib.blake2b(body.encode("utf-8"), digest_size=16).digest(), url
+
+    def drop_oldest(self):
+        expires_at, key = self.expiries.popleft()
+        # the registration may have been matched already, then the key holds only later registrations
+        registrations = self.pending.get(key)
+        if registrations is not None and registrations[0] <= expires_at:
+            registrations.popleft()
+            if len(registrations) == 0:
+                del self.pending[key]
+
+    def expire(self, now: float):
+        while len(self.expiries) > 0 and self.expiries[0][0] <= now:
+            self.drop_oldest()
+
+    def add(self, key):
+        now = time.monotonic()
+        self.expire(now)
+        if len(self.expiries) >= self.maxsize:
+            self.drop_oldest()
+        expires_at = now + self.ttl
+        self.pending.setdefault(key, deque()).append(expires_at)
+        self.expiries.append((expires_at, key))
+
+    def discard(self, key):
+        """
+        Drops the latest registration of the key, e.g. when the message could not be sent after all
+        """
+        registrations = self.pending.get(key)
+        if registrations is not None:
+            registrations.pop()
+            if len(registrations) == 0:
+                del self.pending[key]
+
+    def match(self, key) -> bool:
+        """
+        :return: True if the key was registered, consuming one registration
+        """
+        self.expire(time.monotonic())
+        registrations = self.pending.get(key)
+        if registrations is None:
+            self.misses += 1
+            return False
+        registrations.popleft()
+        if len(registrations) == 0:
+            del self.pending[key]
+        self.hits += 1
+        return True
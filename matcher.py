@@ -0,0 +1,41 @@
+"""
+Compiled multi-pattern matching for the operator rules
+"""
+
+import re
+from typing import Optional
+
+
+class PatternMatcher:
+    """
+    Matches a text against an ordered list of regular expressions with `re.match` semantics and returns the index
+    of the first one that matches. The patterns are compiled once and, when they can be, combined into a single
+    alternation of named groups, so a text is matched in one pass instead of one `re.match` call per pattern.
+    Patterns with named groups, backreferences, conditional group references or global inline flags can not be
+    combined and are matched one by one
+    """
+
+    def __init__(self, patterns, flags=re.IGNORECASE):
+        self.patterns = [re.compile(pattern, flags) for pattern in patterns]
+        self.combined = None
+
+        if len(self.patterns) > 1 and all(self.combinable(pattern) for pattern in self.patterns):
+            alternation = "|".join(f"(?P<p{i}>{pattern.pattern})" for i, pattern in enumerate(self.patterns))
+            try:
+                self.combined = re.compile(alternation, flags)
+            except re.error:
+                self.combined = None
+
+    @staticmethod
+    def combinable(pattern: re.Pattern) -> bool:
+        return not pattern.groupindex and re.search(r"\\\d|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)", pattern.pattern) is None
+
+    def match(self, text: str) -> Optional[int]:
+        if self.combined is not None:
+            m = self.combined.match(text)
+            return int(m.lastgroup[1:]) if m is not None else None
+
+        for i, pattern in enumerate(self.patterns):
+            if pattern.match(text) is not None:
+                return i
+        return None
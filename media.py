@@ -0,0 +1,396 @@
+"""
+Media helpers for the bridge
+"""
+
+import asyncio
+import base64
+import collections
+import hashlib
+import json
+import os
+import struct
+from typing import AsyncIterator, Optional
+
+import cachetools
+
+
+class ByteBudget:
+    """
+    Caps the number of media bytes in flight across all rooms.
+    A single reservation larger than the budget is reduced to the whole budget, so it can still proceed alone
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    def reserve(self, size: int):
+        return ByteBudget.Reservation(self, min(size, self.limit))
+
+    async def acquire(self, size: int):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight + size <= self.limit)
+            self.in_flight += size
+
+    async def release(self, size: int):
+        async with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+    class Reservation:
+        def __init__(self, budget, size):
+            self.budget = budget
+            self.size = size
+
+        async def __aenter__(self):
+            await self.budget.acquire(self.size)
+            return self
+
+        async def __aexit__(self, exc_type, exc, tb):
+            await self.budget.release(self.size)
+
+
+async def base64_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Incremental base64 encoding: only a remainder of up to 2 bytes is kept between input chunks
+    """
+    remainder = b""
+    async for chunk in chunks:
+        data = remainder + chunk
+        cut = len(data) - len(data) % 3
+        remainder = data[cut:]
+        if cut > 0:
+            yield base64.b64encode(data[:cut])
+    if remainder:
+        yield base64.b64encode(remainder)
+
+
+async def streamed_json_body(fields: dict, bytes_field: str, chunks: AsyncIterator[bytes],
+                             double_encoded: bool = True) -> AsyncIterator[bytes]:
+    """
+    Streams `fields` as a JSON object whose last attribute `bytes_field` is the base64 encoding of `chunks`.
+    With `double_encoded`, the object is wrapped in a JSON string literal, as a `json=` body holding
+    an already encoded JSON string is sent on the wire
+    """
+    prefix = json.dumps(fields)[:-1] + (", " if fields else "") + json.dumps(bytes_field) + ': "'
+    suffix = '"}'
+    if double_encoded:
+        # base64 characters never need escaping inside a JSON string literal
+        prefix = json.dumps(prefix)[:-1]
+        suffix = json.dumps(suffix)[1:]
+
+    yield prefix.encode("utf-8")
+    async for encoded in base64_chunks(chunks):
+        yield encoded
+    yield suffix.encode("utf-8")
+
+
+class MediaUploadCache:
+    """
+    Cache of media metadata, with LRU eviction and optional persistence to a JSON file.
+    Uploaded media is keyed both by a digest of its bytes, mapping to the mxc URI and the metadata computed at upload
+    time, and by its mxc URI, so media already on the homeserver is described without downloading it again
+    """
+
+    FIELDS = ("mxc_uri", "mime_type", "width", "height", "duration", "size")
+
+    def __init__(self, maxsize: int, path: Optional[str] = None):
+        self.entries = cachetools.LRUCache(maxsize=maxsize)
+        self.path = path
+
+    @staticmethod
+    def key(media_type: str, data: bytes) -> str:
+        return f"{media_type}:{hashlib.sha256(data).hexdigest()}"
+
+    @staticmethod
+    def uri_key(mxc_uri: str) -> str:
+        return f"uri:{mxc_uri}"
+
+    def get(self, key: str) -> Optional[dict]:
+        return self.entries.get(key)
+
+    def put(self, key: str, **metadata):
+        self.entries[key] = {field: metadata.get(field) for field in self.FIELDS}
+
+    def load(self) -> int:
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        with open(self.path, "r") as f:
+            entries = json.load(f)
+        for key, metadata in entries.items():
+            self.put(key, **metadata)
+        return len(self.entries)
+
+    def save(self) -> int:
+        if not self.path:
+            return 0
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dict(self.entries.items()), f)
+        os.replace(tmp_path, self.path)
+        return len(self.entries)
+
+
+class MediaDiskCache:
+    """
+    Bounded cache of media files in a directory: once their total size exceeds `max_bytes`, the least recently used
+    files are deleted. Concurrent fills of the same media share a single download
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.files = collections.OrderedDict()
+        self.total_bytes = 0
+        self.filling = dict()
+
+    @staticmethod
+    def key(mxc_uri: str) -> str:
+        return hashlib.sha256(mxc_uri.encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def load(self) -> int:
+        """
+        Registers the files left in the directory by a previous run, from the least to the most recently written
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        entries = list()
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, key, size in sorted(entries):
+            self.add(key, size)
+        return len(self.files)
+
+    def get(self, key: str) -> Optional[str]:
+        if key not in self.files:
+            return None
+        self.files.move_to_end(key)
+        return self.path(key)
+
+    async def fill(self, key: str, chunks: AsyncIterator[bytes]) -> str:
+        """
+        Writes `chunks` to the file of `key`, or waits for the fill of `key` already in progress
+        :return: the path of the file
+        """
+        future = self.filling.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self.filling[key] = asyncio.get_running_loop().create_future()
+        try:
+            path = await self.write(key, chunks)
+            future.set_result(path)
+            return path
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # retrieved here, so it is not reported as never retrieved when nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            del self.filling[key]
+
+    async def write(self, key: str, chunks: AsyncIterator[bytes]) -> str:
+        path = self.path(key)
+        tmp_path = f"{path}.tmp"
+        size = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                async for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.add(key, size)
+        return path
+
+    def add(self, key: str, size: int):
+        self.total_bytes += size - self.files.pop(key, 0)
+        self.files[key] = size
+        while self.total_bytes > self.max_bytes and len(self.files) > 1:
+            evicted_key, evicted_size = self.files.popitem(last=False)
+            self.total_bytes -= evicted_size
+            try:
+                os.remove(self.path(evicted_key))
+            except FileNotFoundError:
+                pass
+
+
+# largest possible OGG page: header, 255 lacing values and 255 segments of 255 bytes
+OGG_MAX_PAGE_SIZE = 27 + 255 + 255 * 255
+
+
+def container_tail_size(data: bytes) -> int:
+    """
+    :param data: the beginning of a media file
+    :return: the number of bytes from the end of the file `container_info` also needs, 0 if none
+    """
+    return OGG_MAX_PAGE_SIZE if data[:4] == b"OggS" else 0
+
+
+def container_info(data: bytes, tail: Optional[bytes] = None, partial: bool = False):
+    """
+    Reads width, height and duration (in milliseconds) from the headers of MP4, OGG, WebM/Matroska and WAV
+    containers, without decoding the media. Values that can not be found are None
+    :param partial: True if `data` is only the beginning of the file, e.g. fetched with a range request,
+        and `tail` its last `container_tail_size(data)` bytes when there are any
+    """
+    try:
+        if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+            return _wav_info(data, partial)
+        elif data[:4] == b"OggS":
+            if partial:
+                return _ogg_info(data, tail) if tail else (None, None, None)
+            return _ogg_info(data, data)
+        elif data[:4] == b"\x1a\x45\xdf\xa3":
+            return _matroska_info(data)
+        elif data[4:8] == b"ftyp":
+            return _mp4_info(data)
+    except (struct.error, IndexError, ValueError, ZeroDivisionError):
+        pass
+    return None, None, None
+
+
+def _wav_info(data: bytes, partial: bool):
+    byte_rate = data_size = None
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id, chunk_size = struct.unpack_from("<4sI", data, pos)
+        if chunk_id == b"fmt ":
+            byte_rate = struct.unpack_from("<I", data, pos + 16)[0]
+        elif chunk_id == b"data":
+            data_size = chunk_size if partial else min(chunk_size, len(data) - pos - 8)
+            break
+        pos += 8 + chunk_size + chunk_size % 2
+    duration = data_size * 1000 // byte_rate if byte_rate and data_size is not None else None
+    return None, None, duration
+
+
+def _ogg_info(data: bytes, tail: bytes):
+    # the first page holds the codec identification header, the last page the final granule position
+    header = data[27 + data[26]:]
+    if header[:7] == b"\x01vorbis":
+        sample_rate = struct.unpack_from("<I", header, 12)[0]
+        pre_skip = 0
+    elif header[:8] == b"OpusHead":
+        sample_rate = 48000
+        pre_skip = struct.unpack_from("<H", header, 10)[0]
+    else:
+        return None, None, None
+    last_page = tail.rfind(b"OggS")
+    if last_page < 0:
+        return None, None, None
+    granule_position = struct.unpack_from("<q", tail, last_page + 6)[0]
+    if granule_position < 0:
+        return None, None, None
+    return None, None, max(granule_position - pre_skip, 0) * 1000 // sample_rate
+
+
+def _ebml_vint(data: bytes, pos: int, keep_marker: bool):
+    first = data[pos]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise ValueError("invalid EBML variable size integer")
+    value = first if keep_marker else first & (mask - 1)
+    for byte in data[pos + 1:pos + length]:
+        value = value << 8 | byte
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, pos + length, unknown
+
+
+def _ebml_elements(data: bytes, start: int, end: int):
+    pos = start
+    while pos < end:
+        element_id, pos, _ = _ebml_vint(data, pos, keep_marker=True)
+        size, pos, unknown = _ebml_vint(data, pos, keep_marker=False)
+        element_end = end if unknown else min(pos + size, end)
+        yield element_id, pos, element_end
+        pos = element_end
+
+
+_MATROSKA_SEGMENT = 0x18538067
+_MATROSKA_INFO = 0x1549A966
+_MATROSKA_TRACKS = 0x1654AE6B
+_MATROSKA_TRACK_ENTRY = 0xAE
+_MATROSKA_VIDEO = 0xE0
+_MATROSKA_TIMECODE_SCALE = 0x2AD7B1
+_MATROSKA_DURATION = 0x4489
+_MATROSKA_PIXEL_WIDTH = 0xB0
+_MATROSKA_PIXEL_HEIGHT = 0xBA
+_MATROSKA_CONTAINERS = (_MATROSKA_SEGMENT, _MATROSKA_INFO, _MATROSKA_TRACKS, _MATROSKA_TRACK_ENTRY, _MATROSKA_VIDEO)
+
+
+def _matroska_info(data: bytes):
+    values = dict()
+
+    def walk(start, end):
+        for element_id, element_start, element_end in _ebml_elements(data, start, end):
+            value = data[element_start:element_end]
+            if element_id in _MATROSKA_CONTAINERS:
+                walk(element_start, element_end)
+            elif element_id == _MATROSKA_DURATION:
+                values.setdefault(element_id, struct.unpack(">f" if len(value) == 4 else ">d", value)[0])
+            elif element_id in (_MATROSKA_TIMECODE_SCALE, _MATROSKA_PIXEL_WIDTH, _MATROSKA_PIXEL_HEIGHT):
+                values.setdefault(element_id, int.from_bytes(value, "big"))
+
+    walk(0, len(data))
+    duration = values.get(_MATROSKA_DURATION)
+    if duration is not None:
+        duration = int(duration * values.get(_MATROSKA_TIMECODE_SCALE, 1000000) / 1000000)
+    return values.get(_MATROSKA_PIXEL_WIDTH), values.get(_MATROSKA_PIXEL_HEIGHT), duration
+
+
+def _mp4_boxes(data: bytes, start: int, end: int):
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, pos)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, pos + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - pos
+        if size < header_size:
+            break
+        yield box_type, pos + header_size, min(pos + size, end)
+        pos += size
+
+
+def _mp4_info(data: bytes):
+    width = height = duration = None
+    for box_type, start, end in _mp4_boxes(data, 0, len(data)):
+        if box_type != b"moov":
+            continue
+        for child_type, child_start, child_end in _mp4_boxes(data, start, end):
+            if child_type == b"mvhd":
+                if data[child_start] == 1:
+                    timescale, mvhd_duration = struct.unpack_from(">IQ", data, child_start + 20)
+                else:
+                    timescale, mvhd_duration = struct.unpack_from(">II", data, child_start + 12)
+                duration = mvhd_duration * 1000 // timescale
+            elif child_type == b"trak" and width is None:
+                for track_box_type, track_box_start, _ in _mp4_boxes(data, child_start, child_end):
+                    if track_box_type == b"tkhd":
+                        offset = 88 if data[track_box_start] == 1 else 76
+                        track_width, track_height = struct.unpack_from(">II", data, track_box_start + offset)
+                        if track_width and track_height:
+                            width, height = track_width >> 16, track_height >> 16
+        break
+    return width, height, duration
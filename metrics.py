@@ -0,0 +1,99 @@
+"""
+Lightweight metrics rendered in the Prometheus text format
+"""
+
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    """
+    Histogram with its bucket counts preallocated, so an observation allocates nothing
+    """
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Holds the metric families of the bridge. Counters and histograms are created once, at registration time;
+    callback families compute their samples only when the metrics are rendered
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.families = dict()
+
+    def family(self, name, help_text, metric_type):
+        full_name = f"{self.prefix}_{name}"
+        if full_name not in self.families:
+            self.families[full_name] = {"help": help_text, "type": metric_type, "samples": list(), "callback": None}
+        return self.families[full_name]
+
+    def counter(self, name, help_text, **labels) -> Counter:
+        counter = Counter()
+        self.family(name, help_text, "counter")["samples"].append((labels, counter))
+        return counter
+
+    def histogram(self, name, help_text, bounds=DEFAULT_BUCKETS, **labels) -> Histogram:
+        histogram = Histogram(bounds)
+        self.family(name, help_text, "histogram")["samples"].append((labels, histogram))
+        return histogram
+
+    def callback(self, name, help_text, metric_type, callback):
+        """
+        :param callback: returns an iterable of `(labels, value)` pairs
+        """
+        self.family(name, help_text, metric_type)["callback"] = callback
+
+    @staticmethod
+    def format_labels(labels, extra=None):
+        items = list(labels.items())
+        if extra is not None:
+            items.append(extra)
+        if len(items) == 0:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in items)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + "}"
+
+    def render(self) -> str:
+        lines = list()
+        for name, family in self.families.items():
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['type']}")
+            for labels, metric in family["samples"]:
+                if isinstance(metric, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(metric.bounds, metric.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self.format_labels(labels, ('le', bound))} {cumulative}")
+                    lines.append(f"{name}_bucket{self.format_labels(labels, ('le', '+Inf'))} {metric.count}")
+                    lines.append(f"{name}_sum{self.format_labels(labels)} {metric.sum}")
+                    lines.append(f"{name}_count{self.format_labels(labels)} {metric.count}")
+                else:
+                    lines.append(f"{name}{self.format_labels(labels)} {metric.value}")
+            if family["callback"] is not None:
+                for labels, value in family["callback"]():
+                    lines.append(f"{name}{self.format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,104 @@
+"""
+Token-bucket pacing of the events sent to the homeserver
+"""
+
+import asyncio
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Holds up to `burst` tokens, refilled at `rate` tokens per second
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """
+        :return: seconds until a token is available
+        """
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class OutboundScheduler:
+    """
+    Paces the events sent to the homeserver with one token bucket per room and an optional global one.
+    A sender first waits for its room bucket, then queues in FIFO order for the global bucket, so rooms waiting
+    for the global budget are served in turn instead of all waking up together.
+    `pause()` holds every sender, e.g. while the homeserver is rate limiting the bot.
+    Room buckets that have refilled completely are equivalent to new ones and are dropped, so memory is
+    proportional to the recently active rooms
+    """
+
+    def __init__(self, room_rate: float, room_burst: float,
+                 global_rate: Optional[float] = None, global_burst: float = 1):
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.room_buckets = dict()
+        self.global_bucket = TokenBucket(global_rate, global_burst, time.monotonic()) if global_rate else None
+        self.global_lock = asyncio.Lock()
+        self.paused_until = 0.0
+        self.prune_threshold = 1024
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, room_id: str) -> float:
+        """
+        Waits until an event can be sent to the room
+        :return: the seconds waited
+        """
+        started = time.monotonic()
+        bucket = self.room_buckets.get(room_id)
+        if bucket is None:
+            bucket = self.room_buckets[room_id] = TokenBucket(self.room_rate, self.room_burst, started)
+
+        delay = bucket.delay(started)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = bucket.delay(time.monotonic())
+
+        async with self.global_lock:
+            while True:
+                now = time.monotonic()
+                delay = max(self.paused_until - now, bucket.delay(now),
+                            self.global_bucket.delay(now) if self.global_bucket is not None else 0.0)
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            bucket.take()
+            if self.global_bucket is not None:
+                self.global_bucket.take()
+
+        return time.monotonic() - started
+
+    def release(self, room_id: str):
+        """
+        Called when a room has nothing left to send
+        """
+        now = time.monotonic()
+        bucket = self.room_buckets.get(room_id)
+        if bucket is not None and bucket.full(now):
+            del self.room_buckets[room_id]
+        if len(self.room_buckets) > self.prune_threshold:
+            for full_room_id in [room_id for room_id, bucket in self.room_buckets.items() if bucket.full(now)]:
+                del self.room_buckets[full_room_id]
+            self.prune_threshold = max(1024, 2 * len(self.room_buckets))
@@ -0,0 +1,105 @@
+"""
+Room ownership across several bridge instances
+"""
+
+import hashlib
+import math
+from bisect import bisect
+from typing import Dict, List, Optional, Tuple
+
+
+# last heartbeat time, configured instances, live instances seen by the sender and since when
+Heartbeat = Tuple[float, List[str], Optional[List[str]], Optional[float]]
+
+
+class HashRing:
+    """
+    Consistent hashing of room IDs over the bridge instances, with `replicas` virtual nodes per instance so rooms
+    are spread evenly. Adding or removing an instance only moves the rooms of the ring arcs it gains or loses,
+    about 1/N of them, and every instance configured with the same instance list computes the same owners
+    """
+
+    def __init__(self, instances: List[str], replicas: int = 128):
+        self.instances = sorted(set(instances))
+        ring = sorted((self.hash(f"{instance}#{i}"), instance) for instance in self.instances for i in range(replicas))
+        self.points = [point for point, _ in ring]
+        self.owners = [instance for _, instance in ring]
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+    def owner(self, room_id: str) -> str:
+        i = bisect(self.points, self.hash(room_id))
+        return self.owners[i % len(self.owners)]
+
+
+class ShardMembership:
+    """
+    Tracks which of the configured instances are alive from the heartbeats they publish, so the rooms of an instance
+    that stopped are handed to the others by a ring over the live instances only.
+    An instance is alive while its last heartbeat is less than `lease_timeout` seconds old. For the first
+    `lease_timeout` seconds after start every configured instance is presumed alive, so instances starting together
+    do not claim each other's rooms before their first heartbeats are seen.
+    Each heartbeat also carries the live instances seen by its sender and since when, which tells a starting instance
+    when the others stopped handling its rooms
+    """
+
+    def __init__(self, instance: str, instances: List[str], lease_timeout: float, now: float):
+        self.instance = instance
+        self.instances = sorted(set(instances))
+        self.lease_timeout = lease_timeout
+        self.started = now
+        self.heartbeats = dict()
+        self.views = dict()
+        self.alive = list(self.instances)
+        self.alive_since = now
+        self.ring = HashRing(self.alive)
+
+    def mismatched(self, heartbeats: Dict[str, Heartbeat], now: float) -> List[str]:
+        """
+        :param heartbeats: the last heartbeat time, the configured instance list, and the live instances seen and
+            since when (None if unknown) of each other instance
+        :return: the live instances configured with another instance list
+        """
+        return sorted(name for name, (heartbeat, instances, _, _) in heartbeats.items()
+                      if name != self.instance and now - heartbeat < self.lease_timeout
+                      and sorted(set(instances)) != self.instances)
+
+    def last_heartbeat(self, instance: str) -> Optional[float]:
+        return self.heartbeats.get(instance)
+
+    def update(self, heartbeats: Dict[str, Heartbeat], now: float):
+        """
+        :return: the instances that joined and the ones that left since the previous update
+        """
+        for name, (heartbeat, _, alive, alive_since) in heartbeats.items():
+            if name in self.instances and heartbeat >= self.heartbeats.get(name, heartbeat):
+                self.heartbeats[name] = heartbeat
+                self.views[name] = (alive, alive_since)
+        presumed = now - self.started < self.lease_timeout
+        alive = [name for name in self.instances
+                 if name == self.instance or presumed or now - self.heartbeats.get(name, -math.inf) < self.lease_timeout]
+        joined = sorted(set(alive) - set(self.alive))
+        left = sorted(set(self.alive) - set(alive))
+        if joined or left:
+            self.alive = alive
+            self.alive_since = now
+            self.ring = HashRing(alive)
+        return joined, left
+
+    def handed_off_since(self, now: float) -> Optional[float]:
+        """
+        The live instances go on handling the rooms of a starting instance until they see its heartbeat
+        :return: since when every live instance counts this one alive, so handles none of its rooms any more, or None
+            while some live instance does not yet
+        """
+        since = self.started
+        for name in self.alive:
+            if name == self.instance or now - self.heartbeats.get(name, -math.inf) >= self.lease_timeout:
+                continue
+            alive, alive_since = self.views.get(name, (None, None))
+            if alive is None or alive_since is None or self.instance not in alive:
+                return None
+            since = max(since, alive_since)
+        return since
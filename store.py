@@ -0,0 +1,131 @@
+"""
+Durable SQLite store for the bridge queues
+"""
+
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+
+class DurableStore:
+    """
+    Append-only SQLite store, in WAL mode, for the inbound messages waiting to be sent to Talks, the
+    Talks messages propagated to Matrix but not confirmed yet and the rooms routed to a backend by a tag.
+    Writes are queued in memory and group-committed by a writer task every `commit_interval` seconds,
+    in a single transaction run in a dedicated thread, so callers on the event loop never block on disk
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS inbound (seq INTEGER PRIMARY KEY, room_id TEXT NOT NULL, "
+        "event TEXT NOT NULL, body TEXT)",
+        "CREATE TABLE IF NOT EXISTS outbound (talks_id TEXT PRIMARY KEY, event_id TEXT, mxc_uri TEXT, backend TEXT)",
+        "CREATE TABLE IF NOT EXISTS room_routes (room_id TEXT PRIMARY KEY, backend TEXT NOT NULL)",
+    )
+
+    def __init__(self, path: str, commit_interval: float, log):
+        self.path = path
+        self.log = log
+        self.commit_interval = commit_interval
+        self.connection: Optional[sqlite3.Connection] = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="durable_store")
+        self.pending = list()
+        self.pending_ready = asyncio.Event()
+        self.writer_task = None
+        self.running = False
+        self.last_seq = 0
+
+    async def start(self):
+        await self.run(self._open)
+        self.running = True
+        self.writer_task = asyncio.create_task(self.writer())
+
+    async def close(self):
+        self.running = False
+        self.pending_ready.set()
+        if self.writer_task is not None:
+            await asyncio.wait([self.writer_task])
+        await self.run(self.connection.close)
+        self.executor.shutdown(wait=False)
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def _open(self):
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            self.connection.execute(statement)
+        outbound_columns = [row[1] for row in self.connection.execute("PRAGMA table_info(outbound)")]
+        if "backend" not in outbound_columns:
+            self.connection.execute("ALTER TABLE outbound ADD COLUMN backend TEXT")
+        self.last_seq = self.connection.execute("SELECT COALESCE(MAX(seq), 0) FROM inbound").fetchone()[0]
+
+    def _load(self):
+        inbound = self.connection.execute("SELECT seq, room_id, event, body FROM inbound ORDER BY seq").fetchall()
+        outbound = self.connection.execute("SELECT talks_id, event_id, mxc_uri, backend FROM outbound").fetchall()
+        return inbound, outbound
+
+    def _load_room_routes(self):
+        return dict(self.connection.execute("SELECT room_id, backend FROM room_routes").fetchall())
+
+    async def load_room_routes(self):
+        """
+        :return: the backend each tagged room is routed to
+        """
+        return await self.run(self._load_room_routes)
+
+    async def load(self):
+        """
+        :return: the pending inbound rows `(seq, room_id, event, body)` in arrival order
+                 and the unconfirmed outbound rows `(talks_id, event_id, mxc_uri, backend)`
+        """
+        return await self.run(self._load)
+
+    def _commit(self, operations):
+        self.connection.execute("BEGIN")
+        try:
+            for sql, params in operations:
+                self.connection.execute(sql, params)
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    async def writer(self):
+        while self.running or len(self.pending) > 0:
+            await self.pending_ready.wait()
+            self.pending_ready.clear()
+            if self.running:
+                await asyncio.sleep(self.commit_interval)
+            operations = self.pending
+            self.pending = list()
+            if len(operations) > 0:
+                try:
+                    await self.run(self._commit, operations)
+                except Exception as e:
+                    self.log.error("Can not commit %s operations to durable store %s: %s", len(operations), self.path, e)
+
+    def write(self, sql, params):
+        self.pending.append((sql, params))
+        self.pending_ready.set()
+
+    def add_inbound(self, room_id: str, event: str, body: Optional[str]) -> int:
+        self.last_seq += 1
+        self.write("INSERT INTO inbound (seq, room_id, event, body) VALUES (?, ?, ?, ?)",
+                   (self.last_seq, room_id, event, body))
+        return self.last_seq
+
+    def remove_inbound(self, seq: int):
+        self.write("DELETE FROM inbound WHERE seq = ?", (seq,))
+
+    def add_outbound(self, talks_id: str, event_id: Optional[str], mxc_uri: Optional[str], backend: str):
+        self.write("INSERT OR REPLACE INTO outbound (talks_id, event_id, mxc_uri, backend) VALUES (?, ?, ?, ?)",
+                   (talks_id, event_id, mxc_uri, backend))
+
+    def remove_outbound(self, talks_id: str):
+        self.write("DELETE FROM outbound WHERE talks_id = ?", (talks_id,))
+
+    def set_room_route(self, room_id: str, backend: str):
+        self.write("INSERT OR REPLACE INTO room_routes (room_id, backend) VALUES (?, ?)", (room_id, backend))
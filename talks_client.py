@@ -0,0 +1,342 @@
+"""
+Native asyncio HTTP client for the Talks Hippy endpoints
+"""
+
+import asyncio
+import json
+import time
+from typing import Callable, List, Optional
+
+import aiohttp
+
+from metrics import Counter, Histogram, MetricsRegistry
+
+
+class TalksHttpResponse:
+    """
+    Fully read Talks response, so the pooled connection is released before the caller inspects it
+    """
+
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling Talks while the circuit breaker is open
+    """
+
+
+class RequestBodyError(Exception):
+    """
+    Raised when the source of a streamed request body fails, e.g. the homeserver download of media being sent to
+    Talks. The original error is its `__cause__`. It is not a failure of Talks, so it does not count against the
+    circuit breaker
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calling a Talks bot that keeps failing. Closed, calls go through and `failure_threshold` consecutive
+    failures (connection errors, timeouts or 5xx responses) open it. Open, calls fail right away with
+    `CircuitOpenError` for `open_timeout` seconds. Then a single probe call goes through: its success closes the
+    breaker and calls `on_close`, its failure opens it again for twice as long, up to `max_open_timeout` seconds
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, open_timeout: float, max_open_timeout: float,
+                 on_close: Optional[Callable[[], None]] = None):
+        self.failure_threshold = failure_threshold
+        self.open_timeout = open_timeout
+        self.max_open_timeout = max_open_timeout
+        self.on_close = on_close
+        self.state = self.CLOSED
+        self.failures = 0
+        self.current_open_timeout = open_timeout
+        self.retry_at = 0.0
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def closed(self) -> bool:
+        return self.state == self.CLOSED
+
+    def allow(self) -> bool:
+        """
+        :return: True if a call can go through, taking the probe slot when the open timeout is over
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() >= self.retry_at:
+            self.state = self.HALF_OPEN
+            return True
+        self.rejected += 1
+        return False
+
+    def seconds_to_probe(self) -> float:
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.retry_at - time.monotonic())
+
+    def record_success(self):
+        self.failures = 0
+        if self.state != self.CLOSED:
+            self.state = self.CLOSED
+            self.current_open_timeout = self.open_timeout
+            if self.on_close is not None:
+                self.on_close()
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self.current_open_timeout = min(self.current_open_timeout * 2, self.max_open_timeout)
+            self.open()
+        elif self.state == self.CLOSED and self.failures >= self.failure_threshold:
+            self.open()
+
+    def release_probe(self):
+        """
+        Gives the probe slot back when the probe call was cancelled before it had an outcome
+        """
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+
+    def open(self):
+        self.state = self.OPEN
+        self.retry_at = time.monotonic() + self.current_open_timeout
+        self.opened += 1
+
+
+class TalksEndpoint:
+    def __init__(self, url: str, timeout: float, concurrency: int):
+        self.url = url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.latency = Histogram()
+        self.errors = Counter()
+
+
+class TalksClient:
+    """
+    Keep-alive connection pool to a Talks Hippy bot, with a concurrency limit and a timeout per endpoint
+    """
+
+    RECEIVE_MESSAGE = "receive_message"
+    RECEIVE_MESSAGE_BATCH = "receive_message_batch"
+    GET_MESSAGES = "get_messages"
+    CONFIRM_MESSAGES = "confirm_messages"
+    TAG_ROOM = "tag_room"
+
+    def __init__(self, api_key: str, pool_size: int, default_timeout: float,
+                 timeouts: Optional[dict] = None, concurrency: Optional[dict] = None,
+                 metrics: Optional[MetricsRegistry] = None, labels: Optional[dict] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        """
+        :param labels: extra labels of the endpoint metrics, e.g. the backend name
+        :param breaker: circuit breaker guarding the calls to the registered endpoints
+        """
+        self.api_key = api_key
+        self.breaker = breaker
+        self.metrics = metrics
+        self.labels = labels or {}
+        self.pool_size = pool_size
+        self.default_timeout = default_timeout
+        self.timeouts = timeouts or {}
+        self.concurrency = concurrency or {}
+        self.endpoints = dict()
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def add_endpoint(self, name: str, url: str):
+        timeout = self.timeouts.get(name) or self.default_timeout
+        concurrency = self.concurrency.get(name) or self.pool_size
+        endpoint = self.endpoints[url] = TalksEndpoint(url, timeout, concurrency)
+        if self.metrics is not None:
+            endpoint.latency = self.metrics.histogram("talks_request_duration_seconds",
+                                                      "Talks calls duration, including the wait for a free slot",
+                                                      endpoint=name, **self.labels)
+            endpoint.errors = self.metrics.counter("talks_request_errors_total",
+                                                   "Talks calls that failed without an HTTP response", endpoint=name,
+                                                   **self.labels)
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.pool_size)
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        self.session = aiohttp.ClientSession(connector=connector, headers=headers,
+                                             timeout=aiohttp.ClientTimeout(total=self.default_timeout))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get(self, url, params=None, extra_timeout=None) -> TalksHttpResponse:
+        return await self.request("GET", url, params=params, extra_timeout=extra_timeout)
+
+    async def post_data(self, url, data, content_type="application/json", params=None) -> TalksHttpResponse:
+        """
+        :param data: the request body, either bytes or an async iterator of bytes, streamed as it is produced.
+            If the iterator fails, `RequestBodyError` is raised
+        """
+        if isinstance(data, (bytes, str)):
+            return await self.request("POST", url, data=data, params=params, headers={"Content-Type": content_type})
+
+        source_errors = list()
+
+        async def guarded(chunks):
+            try:
+                async for chunk in chunks:
+                    yield chunk
+            except Exception as e:
+                source_errors.append(e)
+                raise
+
+        return await self.request("POST", url, data=guarded(data), params=params,
+                                  headers={"Content-Type": content_type}, source_errors=source_errors)
+
+    async def request(self, method, url, extra_timeout=None, source_errors=None, **kwargs) -> TalksHttpResponse:
+        """
+        :param extra_timeout: seconds added to the endpoint timeout, e.g. the time a long-poll request is held open
+        :param source_errors: filled with the error of the streamed body source, if it fails
+        """
+        endpoint = self.endpoints.get(url)
+        if endpoint is None:
+            try:
+                async with self.session.request(method, url, **kwargs) as r:
+                    return TalksHttpResponse(r.status, await r.text())
+            except Exception:
+                if source_errors:
+                    raise RequestBodyError(f"request body of {url} failed") from source_errors[0]
+                raise
+
+        timeout = endpoint.timeout
+        if extra_timeout:
+            timeout = aiohttp.ClientTimeout(total=timeout.total + extra_timeout)
+
+        if self.breaker is not None and not self.breaker.allow():
+            raise CircuitOpenError(f"circuit open for {url}")
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        outcome = False
+        try:
+            async with endpoint.semaphore:
+                async with self.session.request(method, url, timeout=timeout, **kwargs) as r:
+                    response = TalksHttpResponse(r.status, await r.text())
+            outcome = True
+            if self.breaker is not None:
+                if response.status_code >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+            return response
+        except Exception:
+            if source_errors:
+                # the probe slot, if taken, is given back in finally
+                raise RequestBodyError(f"request body of {url} failed") from source_errors[0]
+            outcome = True
+            endpoint.errors.inc()
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            raise
+        finally:
+            endpoint.latency.observe(loop.time() - started)
+            if not outcome and self.breaker is not None:
+                self.breaker.release_probe()
+
+
+class TalksBatcher:
+    """
+    Gathers JSON items submitted concurrently into a single Talks call, up to `max_size` items or `linger`
+    seconds after the first one, and hands every submitter the result for its own item.
+    The call body is `{"messages": [item, ...]}` and a 200 response carries `{"results": [result, ...]}`
+    in the same order, each result with the `status` and `description` of its item. An item without a valid result
+    gets a 502 response, so it is retried rather than taken as delivered
+    """
+
+    MISSING_RESULT = json.dumps({"description": "no result for the message in the batch response"})
+
+    def __init__(self, client: TalksClient, url: str, max_size: int, linger: float):
+        self.client = client
+        self.url = url
+        self.max_size = max_size
+        self.linger = linger
+        self.pending = list()
+        self.flush_handle = None
+        self.tasks = set()
+
+    async def submit(self, item_json: str) -> TalksHttpResponse:
+        return (await self.submit_many([item_json]))[0]
+
+    async def submit_many(self, items_json: List[str]) -> List[TalksHttpResponse]:
+        """
+        Submits items that must be sent in order in the same call, e.g. the queued messages of a room,
+        at most `max_size` of them
+        :return: the result of each item
+        """
+        loop = asyncio.get_running_loop()
+        if len(self.pending) + len(items_json) > self.max_size:
+            self.flush()
+        futures = [loop.create_future() for _ in items_json]
+        self.pending.extend(zip(items_json, futures))
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.linger, self.flush)
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch = self.pending
+        self.pending = list()
+        if len(batch) > 0:
+            task = asyncio.create_task(self.send(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def send(self, batch):
+        body = '{"messages": [' + ", ".join(item_json for item_json, _ in batch) + ']}'
+        try:
+            r = await self.client.post_data(self.url, body)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        try:
+            if r.status_code != 200:
+                # the whole call failed, every item gets its response
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(r)
+                return
+
+            try:
+                results = r.json()["results"]
+            except (ValueError, KeyError, TypeError):
+                results = None
+            if not isinstance(results, list):
+                results = []
+            for (_, future), result in zip(batch, results):
+                if future.done() or not isinstance(result, dict):
+                    continue
+                status = result.get("status", 200)
+                if isinstance(status, int):
+                    future.set_result(TalksHttpResponse(status, json.dumps(result)))
+        finally:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(TalksHttpResponse(502, self.MISSING_RESULT))